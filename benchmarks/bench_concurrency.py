@@ -0,0 +1,89 @@
+"""
+Throughput of an ApplicationDispatcher with different concurrency windows.
+
+Messages are fed to the dispatcher the way vumi's AMQP consumer does it,
+waiting for each call to process_inbound to return before handing over
+the next one. Redis is a FakeRedis that answers each call after
+VUMI_FAKE_REDIS_WAIT seconds (default 0.002), so with a window of one
+message the dispatcher spends most of its time waiting for Redis.
+
+Usage: python benchmarks/bench_concurrency.py [users] [windows...]
+"""
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, succeed
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.message import TransportUserMessage
+
+from vxapprouter.router import ApplicationDispatcher
+
+
+CONFIG = {
+    'redis_manager': {'FAKE_REDIS': True},
+    'entries': [{'label': 'App', 'endpoint': 'app'}],
+    'routing_table': {
+        'transport': {
+            'app': ['app', 'default'],
+            'default': ['transport', 'default'],
+        },
+        'app': {'default': ['transport', 'default']},
+    },
+    'receive_inbound_connectors': ['transport'],
+    'receive_outbound_connectors': ['app'],
+}
+
+
+class BenchDispatcher(ApplicationDispatcher):
+
+    def start_publisher(self, publisher_class, prefix):
+        return succeed(MetricManager(prefix))
+
+    def publish_inbound(self, msg, connector_name, endpoint):
+        return succeed(None)
+
+    def publish_outbound(self, msg, connector_name, endpoint):
+        return succeed(None)
+
+
+def make_msgs(users):
+    # Users take turns, so each user's next message arrives after the
+    # previous one has been handed over.
+    for content, event in [(None, 'new'), ('1', 'resume'), ('hi', 'resume')]:
+        for i in xrange(users):
+            yield TransportUserMessage(
+                to_addr='*120*1#', from_addr='+2783%07d' % (i,),
+                content=content, session_event=event,
+                transport_name='transport', transport_type='ussd')
+
+
+@inlineCallbacks
+def run(window, users):
+    config = dict(
+        CONFIG, max_concurrent_messages=window,
+        amqp_prefetch_count=max(window, 20))
+    dispatcher = BenchDispatcher({}, config)
+    yield dispatcher.setup_dispatcher()
+    msg_config = yield dispatcher.get_config(None)
+    started = time.time()
+    for msg in make_msgs(users):
+        yield dispatcher.process_inbound(msg_config, msg, 'transport')
+    yield dispatcher.drain()
+    yield dispatcher.teardown_dispatcher()
+    elapsed = time.time() - started
+    print '%4d messages in flight: %8.0f msgs/s' % (
+        window, users * 3 / elapsed)
+
+
+@inlineCallbacks
+def main(users=1000, *windows):
+    for window in windows or (1, 10, 50, 200):
+        yield run(window, users)
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main, *[int(arg) for arg in sys.argv[1:]])
+    reactor.run()
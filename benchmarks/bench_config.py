@@ -0,0 +1,61 @@
+"""
+Micro-benchmark for per-message config resolution.
+
+Compares building an ApplicationDispatcherConfig for every message, as
+vumi's Worker.get_config does, with reusing a ConfigSnapshot. Each
+"message" reads the fields the router looks at when routing an inbound
+message.
+
+Usage: python benchmarks/bench_config.py [iterations]
+"""
+import sys
+import timeit
+
+from vxapprouter.router import ApplicationDispatcherConfig
+from vxapprouter.snapshot import ConfigSnapshot
+
+
+CONFIG = {
+    'menu_title': 'Please select a choice.',
+    'entries': [
+        {'label': 'App %s' % (i,), 'endpoint': 'app%s' % (i,)}
+        for i in range(10)],
+    'routing_table': dict(
+        ('app%s' % (i,), {'default': ['transport', 'default']})
+        for i in range(10)),
+    'receive_inbound_connectors': ['transport'],
+    'receive_outbound_connectors': ['app%s' % (i,) for i in range(10)],
+}
+
+
+def read_fields(config):
+    return (
+        config.menu_title, config.entries, config.menu_max_length,
+        config.more_label, config.back_label, config.session_expiry,
+        config.routing_table)
+
+
+def per_message():
+    read_fields(ApplicationDispatcherConfig(CONFIG))
+
+
+snapshot = ConfigSnapshot(ApplicationDispatcherConfig(CONFIG))
+
+
+def cached_snapshot():
+    read_fields(snapshot)
+
+
+def main(iterations=10000):
+    for name, func in [('per_message', per_message),
+                       ('snapshot', cached_snapshot)]:
+        seconds = timeit.timeit(func, number=iterations)
+        print '%-12s %10.2f us/message' % (name, seconds / iterations * 1e6)
+    seconds = timeit.timeit(
+        lambda: ConfigSnapshot(ApplicationDispatcherConfig(CONFIG)),
+        number=iterations)
+    print '%-12s %10.2f us/reload' % ('snapshot', seconds / iterations * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark for the sans-IO routing core.
+
+Runs a mix of new sessions, menu selections and session resumes through
+StateMachine.decide, one message at a time and in batches with
+decide_batch, without a reactor or Redis. This is the CPU cost of
+routing an inbound message, separate from the cost of the I/O that
+ApplicationDispatcher does around it.
+
+Usage: python benchmarks/bench_core.py [iterations] [batch_size]
+"""
+import sys
+import timeit
+
+from vumi.message import TransportUserMessage
+
+from vxapprouter.core import StateMachine
+from vxapprouter.router import ApplicationDispatcherConfig
+from vxapprouter.snapshot import ConfigSnapshot
+
+
+CONFIG = {
+    'entries': [
+        {'label': 'App %s' % (i,), 'endpoint': 'app%s' % (i,)}
+        for i in range(10)],
+    'routing_table': {},
+    'receive_inbound_connectors': ['transport'],
+    'receive_outbound_connectors': ['app%s' % (i,) for i in range(10)],
+}
+
+
+def make_msg(user, content, session_event):
+    return TransportUserMessage(
+        to_addr='*120*1#', from_addr='+2783%07d' % (user,), content=content,
+        session_event=session_event, transport_name='transport',
+        transport_type='ussd')
+
+
+def make_workload(machine, config, count):
+    version = machine.get_menu_plan(config).version
+    select = {'state': 'select', 'menu_page': '0', 'menu_version': version}
+    selected = {'state': 'selected', 'active_endpoint': 'app1'}
+    workload = []
+    for user in xrange(count):
+        kind = user % 3
+        if kind == 0:
+            workload.append((make_msg(user, None, 'new'), {}))
+        elif kind == 1:
+            workload.append((make_msg(user, '2', 'resume'), dict(select)))
+        else:
+            workload.append((make_msg(user, 'hi', 'resume'), dict(selected)))
+    return workload
+
+
+def main(iterations=10000, batch_size=50):
+    machine = StateMachine()
+    machine.setup_state_machine()
+    config = ConfigSnapshot(ApplicationDispatcherConfig(CONFIG))
+    workload = make_workload(machine, config, iterations)
+    msgs = [msg for msg, _ in workload]
+    sessions = [session for _, session in workload]
+
+    def single():
+        for msg, session in workload:
+            machine.decide(config, msg, session)
+
+    def batched():
+        for i in xrange(0, len(workload), batch_size):
+            machine.decide_batch(
+                config, msgs[i:i + batch_size], sessions[i:i + batch_size])
+
+    for name, func in [('decide', single), ('decide_batch', batched)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print '%-15s %8.2f us/msg' % (name, seconds / iterations * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark for ApplicationDispatcher.forwarded_message.
+
+Compares the current implementation against rebuilding the message with
+``TransportUserMessage(**msg.payload)``, which shares all nested metadata
+with the original, and against rebuilding it from a deep copy. Reports
+the time per forward and the number of garbage collected objects each
+forward allocates.
+
+Usage: python benchmarks/bench_forwarded_message.py [iterations]
+"""
+import copy
+import gc
+import sys
+import timeit
+
+from vumi.message import TransportUserMessage
+
+from vxapprouter.router import ApplicationDispatcher
+
+
+def rebuild(msg, **kwargs):
+    forwarded = TransportUserMessage(**msg.payload)
+    for k, v in kwargs.items():
+        forwarded[k] = v
+    return forwarded
+
+
+def rebuild_deepcopy(msg, **kwargs):
+    return rebuild(TransportUserMessage(**copy.deepcopy(msg.payload)),
+                   **kwargs)
+
+
+def forward(msg, **kwargs):
+    return ApplicationDispatcher.forwarded_message.im_func(None, msg, **kwargs)
+
+
+def make_msg():
+    return TransportUserMessage(
+        to_addr='*120*123#', from_addr='+27831234567', content='1',
+        transport_name='ussd', transport_type='ussd',
+        session_event=TransportUserMessage.SESSION_RESUME,
+        helper_metadata={'session': {'id': 'abc', 'history': range(20)}},
+        transport_metadata={'session_id': 'abc', 'network': 'net'})
+
+
+def allocations(func, msg, count=1000):
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        kept = [func(msg, content=None, session_event='new')
+                for _ in xrange(count)]
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    del kept
+    return (after - before - 1) / float(count)
+
+
+def main(iterations=100000):
+    msg = make_msg()
+    for name, func in [('rebuild', rebuild),
+                       ('rebuild_deepcopy', rebuild_deepcopy),
+                       ('forwarded_message', forward)]:
+        seconds = timeit.timeit(
+            lambda: func(msg, content=None, session_event='new'),
+            number=iterations)
+        print '%-20s %8.2f us/forward %6.1f objects/forward' % (
+            name, seconds / iterations * 1e6, allocations(func, msg))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,92 @@
+"""
+Throughput of partitioned ApplicationDispatchers on 1 to N cores.
+
+Each partition runs in its own process with FakeRedis and no AMQP, and
+routes a USSD session (dial in, choose an app, send a message) for each
+of the users it owns. The total number of users stays fixed. Throughput
+is measured from the first partition starting to the last one finishing
+and should grow almost linearly with the number of partitions, up to the
+number of cores.
+
+Usage: python benchmarks/bench_partition.py [max_partitions] [users]
+"""
+import multiprocessing
+import sys
+import time
+
+from twisted.internet.defer import succeed
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.message import TransportUserMessage
+
+from vxapprouter.partition import partition_for
+from vxapprouter.router import ApplicationDispatcher
+
+
+CONFIG = {
+    'redis_manager': {'FAKE_REDIS': True},
+    'entries': [{'label': 'App', 'endpoint': 'app'}],
+    'routing_table': {
+        'transport': {
+            'app': ['app', 'default'],
+            'default': ['transport', 'default'],
+        },
+        'app': {'default': ['transport', 'default']},
+    },
+    'receive_inbound_connectors': ['transport'],
+    'receive_outbound_connectors': ['app'],
+}
+
+
+class BenchDispatcher(ApplicationDispatcher):
+
+    def start_publisher(self, publisher_class, prefix):
+        return succeed(MetricManager(prefix))
+
+    def publish_inbound(self, msg, connector_name, endpoint):
+        return succeed(None)
+
+    def publish_outbound(self, msg, connector_name, endpoint):
+        return succeed(None)
+
+
+def run_partition(args):
+    index, count, users = args
+    config = dict(CONFIG, partition={'index': index, 'count': count})
+    dispatcher = BenchDispatcher({}, config)
+    dispatcher.setup_dispatcher()
+    msg_config = dispatcher.get_config(None).result
+    owned = [
+        '+2783%07d' % (i,) for i in xrange(users)
+        if partition_for('+2783%07d' % (i,), count) == index]
+    started = time.time()
+    for user_id in owned:
+        for content, event in [(None, 'new'), ('1', 'resume'),
+                               ('hi', 'resume')]:
+            msg = TransportUserMessage(
+                to_addr='*120*1#', from_addr=user_id, content=content,
+                session_event=event, transport_name='transport',
+                transport_type='ussd')
+            dispatcher.process_inbound(msg_config, msg, 'transport')
+    return len(owned) * 3, started, time.time()
+
+
+def main(max_partitions=multiprocessing.cpu_count(), users=3000):
+    baseline = None
+    for count in range(1, max_partitions + 1):
+        pool = multiprocessing.Pool(count)
+        results = pool.map(
+            run_partition, [(i, count, users) for i in range(count)])
+        pool.close()
+        pool.join()
+        messages = sum(n for n, _, _ in results)
+        started = min(start for _, start, _ in results)
+        elapsed = max(end for _, _, end in results) - started
+        throughput = messages / elapsed
+        baseline = baseline or throughput
+        print '%2d partitions: %8.0f msgs/s (%.2fx)' % (
+            count, throughput, throughput / baseline)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,140 @@
+"""
+Redis memory held by sessions, with and without per-state session expiry.
+
+Replays a workload of USSD dials through an ApplicationDispatcher on
+FakeRedis and a simulated clock, once with only session_expiry and once
+with session_state_expiry. Most dials see the menu and are abandoned
+without a session close; the rest pick an application, send a few
+messages and close the session. The session keys held in Redis are
+sampled every simulated second until they have all expired.
+
+Usage: python benchmarks/bench_session_expiry.py [dials] [abandon_ratio]
+"""
+import random
+import sys
+from collections import defaultdict
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+
+from vumi.message import TransportUserMessage
+from vumi.persist import fake_redis
+
+from vxapprouter.capacity import PlanningDispatcher
+
+
+CONFIG = {
+    'redis_manager': {'FAKE_REDIS': True},
+    'entries': [
+        {'label': 'App %s' % (i,), 'endpoint': 'app%s' % (i,)}
+        for i in range(5)],
+    'routing_table': {
+        'transport': dict(
+            [('app%s' % (i,), ['app', 'default']) for i in range(5)] +
+            [('default', ['transport', 'default'])]),
+        'app': {'default': ['transport', 'default']},
+    },
+    'receive_inbound_connectors': ['transport'],
+    'receive_outbound_connectors': ['app'],
+}
+
+STATE_EXPIRY = {'start': 60, 'select': 60, 'bad_input': 60, 'selected': 300}
+
+
+def make_workload(dials, abandon_ratio, rate=5, seed=0):
+    """
+    Return the inbound messages of ``dials`` sessions started at ``rate``
+    a second, as ``(user_id, content, session_event)`` tuples keyed by
+    the second they are sent in.
+    """
+    rng = random.Random(seed)
+    workload = defaultdict(list)
+    for i in range(dials):
+        user_id = '+2783%07d' % (i,)
+        t = i // rate
+        workload[t].append((user_id, None, 'new'))
+        if rng.random() < abandon_ratio:
+            continue
+        t += rng.randint(3, 10)
+        workload[t].append((user_id, '1', 'resume'))
+        for j in range(3):
+            t += rng.randint(5, 30)
+            workload[t].append((user_id, 'Hello', 'resume'))
+        t += rng.randint(5, 30)
+        workload[t].append((user_id, None, 'close'))
+    return workload
+
+
+def session_bytes(client, prefix):
+    """
+    Return the number of session keys and the size of their keys, fields
+    and values in bytes.
+    """
+    keys = [key for key in client._data if key.startswith(prefix)]
+    size = 0
+    for key in keys:
+        size += len(key) + sum(
+            len(field) + len(str(value))
+            for field, value in client._data[key].items())
+    return len(keys), size
+
+
+@inlineCallbacks
+def replay(workload, session_state_expiry):
+    clock = Clock()
+    config = dict(CONFIG, session_state_expiry=session_state_expiry)
+    dispatcher = PlanningDispatcher({}, config)
+    dispatcher.clock = clock
+    yield dispatcher.setup_dispatcher()
+    client = dispatcher.redis._client
+    client.clock = clock
+    prefix = '%s:session:' % (dispatcher.redis.get_key_prefix(),)
+    samples = []
+    end = max(workload) + dispatcher.get_static_config().session_expiry
+    for t in range(end + 1):
+        ds = []
+        for user_id, content, session_event in workload.get(t, []):
+            msg = TransportUserMessage(
+                to_addr='*120*1#', from_addr=user_id, content=content,
+                session_event=session_event, transport_name='transport',
+                transport_type='ussd')
+            config = yield dispatcher.get_config(msg)
+            ds.append(dispatcher.handle_inbound(config, msg, 'transport'))
+        yield gatherResults(ds)
+        del dispatcher.published[:]
+        samples.append(session_bytes(client, prefix))
+        clock.advance(1)
+    yield dispatcher.teardown_dispatcher()
+    keys = [count for count, _ in samples]
+    sizes = [size for _, size in samples]
+    returnValue((
+        sum(keys) / float(len(samples)), max(keys),
+        sum(sizes) / float(len(samples)), max(sizes)))
+
+
+@inlineCallbacks
+def main(dials=1000, abandon_ratio=0.7):
+    # Redis calls are delayed by a real 2ms by default, which adds up
+    # over simulated hours.
+    fake_redis.FAKE_REDIS_WAIT = 0
+    workload = make_workload(dials, abandon_ratio)
+    print '%d dials, %d%% abandoned at the menu' % (
+        dials, abandon_ratio * 100)
+    print '%-22s %10s %10s %12s %12s' % (
+        'config', 'mean keys', 'peak keys', 'mean bytes', 'peak bytes')
+    try:
+        for name, session_state_expiry in [
+                ('session_expiry', {}),
+                ('session_state_expiry', STATE_EXPIRY)]:
+            result = yield replay(workload, session_state_expiry)
+            print '%-22s %10.1f %10d %12.1f %12d' % ((name,) + result)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:2]]
+    args.extend(float(arg) for arg in sys.argv[2:3])
+    reactor.callWhenRunning(main, *args)
+    reactor.run()
@@ -0,0 +1,87 @@
+"""
+Startup time of an ApplicationDispatcher, broken down by phase.
+
+Import times are measured in fresh interpreters, one module at a time,
+so that each number includes everything the module pulls in. The
+dispatcher is then set up with FakeRedis and no AMQP, and the time
+spent in each phase of setup_dispatcher is reported along with the
+time it takes to route the first message.
+
+Usage: python benchmarks/bench_startup.py [entries]
+"""
+import subprocess
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, succeed
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.message import TransportUserMessage
+
+from vxapprouter.router import ApplicationDispatcher
+
+
+IMPORTS = ['twisted.internet.reactor', 'vumi.dispatchers.endpoint_dispatchers',
+           'vxapprouter.router']
+
+
+def import_time(module):
+    script = ('import time; started = time.time(); import %s; '
+              'print time.time() - started' % (module,))
+    return float(subprocess.check_output([sys.executable, '-c', script]))
+
+
+def make_config(entries):
+    return {
+        'redis_manager': {'FAKE_REDIS': True},
+        'entries': [
+            {'label': 'App %s' % (i,), 'endpoint': 'app%s' % (i,)}
+            for i in range(entries)],
+        'menu_max_length': 140,
+        'routing_table': {
+            'transport': dict(
+                ('app%s' % (i,), ['app', 'default'])
+                for i in range(entries)),
+            'app': {'default': ['transport', 'default']},
+        },
+        'receive_inbound_connectors': ['transport'],
+        'receive_outbound_connectors': ['app'],
+    }
+
+
+class BenchDispatcher(ApplicationDispatcher):
+
+    def start_publisher(self, publisher_class, prefix):
+        return succeed(MetricManager(prefix))
+
+    def publish_inbound(self, msg, connector_name, endpoint):
+        return succeed(None)
+
+    def publish_outbound(self, msg, connector_name, endpoint):
+        return succeed(None)
+
+
+@inlineCallbacks
+def main(entries=50):
+    for module in IMPORTS:
+        print 'import %-40s %8.3fs' % (module, import_time(module))
+    dispatcher = BenchDispatcher({}, make_config(entries))
+    yield dispatcher.setup_dispatcher()
+    for phase, seconds in dispatcher.startup_timings.items():
+        print 'phase %-41s %8.3fs' % (phase, seconds)
+    msg = TransportUserMessage(
+        to_addr='*120*1#', from_addr='+27831234567', content=None,
+        session_event='new', transport_name='transport',
+        transport_type='ussd')
+    started = time.time()
+    config = yield dispatcher.get_config(msg)
+    yield dispatcher.process_inbound(config, msg, 'transport')
+    print 'first message %41.3fs' % (time.time() - started,)
+    yield dispatcher.teardown_dispatcher()
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main, *[int(arg) for arg in sys.argv[1:]])
+    reactor.run()
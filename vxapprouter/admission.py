@@ -0,0 +1,84 @@
+# -*- test-case-name: vxapprouter.tests.test_admission -*-
+from vumi.message import TransportUserMessage
+
+
+class AdmissionController(object):
+    """
+    Decides whether the dispatcher has capacity to start new sessions.
+
+    The controller counts the inbound messages being processed and keeps
+    an exponentially weighted moving average of Redis call latency. New
+    sessions are refused while more than ``max_in_flight`` messages are
+    in flight or while the average latency exceeds ``max_redis_latency``
+    seconds. Latency samples older than ``latency_window`` seconds are
+    disregarded so that an idle dispatcher does not stay overloaded.
+
+    Messages that continue an existing session are always admitted.
+    """
+
+    def __init__(self, clock, max_in_flight=None, max_redis_latency=None,
+                 latency_window=10, smoothing=0.2):
+        self.clock = clock
+        self.max_in_flight = max_in_flight
+        self.max_redis_latency = max_redis_latency
+        self.latency_window = latency_window
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self._latency = None
+        self._sampled_at = None
+
+    @classmethod
+    def from_config(cls, clock, config):
+        return cls(clock, **config)
+
+    @property
+    def redis_latency(self):
+        if (self._sampled_at is None or
+                self.clock.seconds() - self._sampled_at > self.latency_window):
+            return 0.0
+        return self._latency
+
+    def record_latency(self, seconds):
+        if self.redis_latency == 0.0:
+            self._latency = seconds
+        else:
+            self._latency += self.smoothing * (seconds - self._latency)
+        self._sampled_at = self.clock.seconds()
+
+    def timed(self, d):
+        """
+        Record the time it takes the Redis call ``d`` to complete.
+        """
+        started = self.clock.seconds()
+
+        def record(result):
+            self.record_latency(self.clock.seconds() - started)
+            return result
+
+        return d.addBoth(record)
+
+    def track(self, d):
+        """
+        Count ``d`` as an in-flight message until it completes.
+        """
+        self.in_flight += 1
+
+        def done(result):
+            self.in_flight -= 1
+            return result
+
+        return d.addBoth(done)
+
+    def overloaded(self):
+        if (self.max_in_flight is not None and
+                self.in_flight >= self.max_in_flight):
+            return True
+        if (self.max_redis_latency is not None and
+                self.redis_latency > self.max_redis_latency):
+            return True
+        return False
+
+    def admit(self, msg):
+        if msg['session_event'] != TransportUserMessage.SESSION_NEW:
+            return True
+        return not self.overloaded()
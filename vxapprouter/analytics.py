@@ -0,0 +1,183 @@
+# -*- test-case-name: vxapprouter.tests.test_analytics -*-
+"""
+Routing analytics, counted in memory and flushed to Redis periodically.
+
+For each endpoint and time bucket, the router counts menu selections and
+forwarded messages, and the unique users it forwarded messages for.
+The menu itself is counted as the ``menu`` endpoint, with its bad input
+and the reasons sessions were ended.
+
+Usage: python -m vxapprouter.analytics <config-file.yaml> [--hours N]
+"""
+import sys
+import time
+from collections import defaultdict
+
+import yaml
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.internet.task import react
+from twisted.python import usage
+
+from vumi.persist.txredis_manager import TxRedisManager
+
+from vxapprouter.core import StateMachine
+
+
+class RoutingAnalytics(object):
+    """
+    Counts routing decisions in memory, per endpoint and per
+    ``bucket_size`` seconds, until :meth:`flush` adds them to Redis.
+
+    Counts are added to a hash per bucket and users to a HyperLogLog per
+    bucket and endpoint, which Redis keeps in at most 12kB no matter how
+    many users there are. Only the users seen since the last flush are
+    held in memory. The Redis keys expire ``ttl`` seconds after they were
+    last written. Counts that fail to flush are logged and dropped.
+    """
+
+    MENU = 'menu'
+
+    def __init__(self, clock, redis, bucket_size=3600, ttl=90 * 24 * 3600):
+        self.clock = clock
+        self.redis = redis
+        self.bucket_size = bucket_size
+        self.ttl = ttl
+        self.counts = defaultdict(int)
+        self.users = defaultdict(set)
+
+    def bucket(self, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock.seconds()
+        return int(timestamp // self.bucket_size * self.bucket_size)
+
+    def count(self, endpoint, name, amount=1):
+        self.counts[(self.bucket(), endpoint, name)] += amount
+
+    def record(self, decision):
+        """
+        Count what happened in a routing ``decision``. Forwarded messages
+        are counted separately, with :meth:`forwarded`.
+        """
+        if 'active_endpoint' in decision.session_update:
+            self.count(decision.session_update['active_endpoint'], 'selected')
+        state = decision.session_update.get('state')
+        if state == StateMachine.STATE_BAD_INPUT:
+            self.count(self.MENU, 'bad_input')
+        if decision.end_reason is not None:
+            self.count(self.MENU, 'ended.%s' % (decision.end_reason,))
+
+    def forwarded(self, endpoint, user_id):
+        self.count(endpoint, 'forwarded')
+        self.users[(self.bucket(), endpoint)].add(user_id)
+
+    def counts_key(self, bucket):
+        return 'counts:%s' % (bucket,)
+
+    def users_key(self, bucket, endpoint):
+        return 'users:%s:%s' % (bucket, endpoint)
+
+    def flush(self):
+        """
+        Add everything counted since the last flush to Redis. The requests
+        are sent concurrently, so they are pipelined on the connection.
+        """
+        counts, self.counts = self.counts, defaultdict(int)
+        users, self.users = self.users, defaultdict(set)
+        keys = set()
+        ds = []
+        for (bucket, endpoint, name), amount in counts.items():
+            key = self.counts_key(bucket)
+            keys.add(key)
+            ds.append(self.redis.hincrby(
+                key, '%s:%s' % (endpoint, name), amount))
+        for (bucket, endpoint), user_ids in users.items():
+            key = self.users_key(bucket, endpoint)
+            keys.add(key)
+            ds.append(self.redis.pfadd(key, *user_ids))
+        ds.extend(self.redis.expire(key, self.ttl) for key in keys)
+        return gatherResults(ds)
+
+    @inlineCallbacks
+    def query(self, start, end):
+        """
+        Return the counts for the buckets from ``start`` up to ``end``,
+        as a dict of ``{bucket: {endpoint: {name: count}}}``. The number
+        of unique users is included as ``users``.
+        """
+        buckets = range(
+            self.bucket(start), self.bucket(end) + 1, self.bucket_size)
+        hashes = yield gatherResults(
+            [self.redis.hgetall(self.counts_key(b)) for b in buckets])
+        results = {}
+        unique = []
+        for bucket, fields in zip(buckets, hashes):
+            if not fields:
+                continue
+            endpoints = results[bucket] = {}
+            for field, value in fields.items():
+                endpoint, name = field.split(':', 1)
+                endpoints.setdefault(endpoint, {})[name] = int(value)
+            for endpoint in endpoints:
+                if endpoint != self.MENU:
+                    unique.append((bucket, endpoint))
+        counts = yield gatherResults([
+            self.redis.pfcount(self.users_key(bucket, endpoint))
+            for bucket, endpoint in unique])
+        for (bucket, endpoint), count in zip(unique, counts):
+            results[bucket][endpoint]['users'] = count
+        returnValue(results)
+
+
+class Options(usage.Options):
+
+    synopsis = "<config-file.yaml>"
+
+    longdesc = "Print the routing analytics of an ApplicationDispatcher."
+
+    optParameters = [
+        ["hours", "H", "24", "The number of hours to report on."],
+        ["bucket-size", "b", "3600",
+         "The analytics bucket size in seconds, as configured."],
+    ]
+
+    def parseArgs(self, config_file):
+        with open(config_file) as f:
+            self['config'] = yaml.safe_load(f)
+
+    def postOptions(self):
+        self['hours'] = int(self['hours'])
+        self['bucket-size'] = int(self['bucket-size'])
+
+
+@inlineCallbacks
+def main(reactor, options):
+    # Imported here because the router imports this module.
+    from vxapprouter.router import ApplicationDispatcher
+    manager = yield TxRedisManager.from_config(
+        options['config'].get('redis_manager', {}))
+    analytics = RoutingAnalytics(
+        reactor, manager.sub_manager(ApplicationDispatcher.worker_name)
+        .sub_manager('analytics'), options['bucket-size'])
+    now = time.time()
+    try:
+        results = yield analytics.query(now - options['hours'] * 3600, now)
+    finally:
+        yield manager.close_manager()
+    for bucket in sorted(results):
+        print time.strftime('%Y-%m-%d %H:%M', time.gmtime(bucket))
+        for endpoint in sorted(results[bucket]):
+            print '  %s: %s' % (endpoint, ', '.join(
+                '%s=%s' % item for item in sorted(
+                    results[bucket][endpoint].items())))
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    react(main, [options])
@@ -0,0 +1,79 @@
+# -*- test-case-name: vxapprouter.tests.test_batch -*-
+from twisted.internet.defer import Deferred, DeferredList, fail
+from twisted.python.failure import Failure
+
+
+class Batcher(object):
+    """
+    Collects items into batches of up to ``max_size`` items.
+
+    A batch is passed to ``flush`` once it is full or once its first item
+    has waited ``max_delay`` seconds. ``flush`` is called with a list of
+    items and must return a list with a deferred for each of them. Only
+    one batch is flushed at a time, and items that arrive in the meantime
+    are collected for the next one.
+    """
+
+    def __init__(self, clock, flush, max_size=50, max_delay=0.01):
+        self.clock = clock
+        self.flush = flush
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.flushing = False
+        self._delayed = None
+
+    def add(self, item):
+        """
+        Add ``item`` to the next batch. Returns a deferred that fires with
+        the result of processing it.
+        """
+        d = Deferred()
+        self.pending.append((item, d))
+        self._schedule()
+        return d
+
+    def _schedule(self):
+        if self.flushing or not self.pending:
+            return
+        if len(self.pending) >= self.max_size:
+            self._flush()
+        elif self._delayed is None:
+            self._delayed = self.clock.callLater(self.max_delay, self._flush)
+
+    def _flush(self):
+        if self._delayed is not None:
+            if self._delayed.active():
+                self._delayed.cancel()
+            self._delayed = None
+        batch = self.pending[:self.max_size]
+        self.pending = self.pending[self.max_size:]
+        self.flushing = True
+        items = [item for item, _ in batch]
+        try:
+            results = self.flush(items)
+        except Exception:
+            failure = Failure()
+            results = [fail(failure) for _ in items]
+        for (_, d), result in zip(batch, results):
+            result.chainDeferred(d)
+        done = DeferredList(results)
+        done.addCallback(self._flushed)
+        return done
+
+    def _flushed(self, _):
+        self.flushing = False
+        self._schedule()
+
+    def stop(self):
+        """
+        Flush everything still waiting without waiting for the batch delay.
+        Returns a deferred that fires once it has all been processed.
+        """
+        waiting = [d for _, d in self.pending]
+        if self._delayed is not None:
+            self._delayed.cancel()
+            self._delayed = None
+            self._flush()
+        self.max_delay = 0
+        return DeferredList(waiting)
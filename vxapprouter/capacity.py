@@ -0,0 +1,397 @@
+# -*- test-case-name: vxapprouter.tests.test_capacity -*-
+"""
+Plan the Redis memory and command rates an ApplicationDispatcher needs.
+
+Sample sessions are run through a dispatcher with the given config
+against a scratch Redis server, with publishing to AMQP left out. The
+commands the dispatcher sends and the keys its sessions create are
+recorded, each key is measured with MEMORY USAGE and its TTL is read
+back, and the results are projected to the given traffic.
+
+The Redis server is given with ``--redis`` and the config's
+``redis_manager`` is ignored, apart from its key prefix, so that a
+production server is never used by accident. The sample sessions are
+for users in the unassigned +999 country code, and the keys they create
+are removed afterwards. Keys that already existed are left alone.
+
+Usage: python -m vxapprouter.capacity <config-file.yaml>
+       --redis <host:port[/db]> [--sessions N]
+"""
+import sys
+from collections import Counter, namedtuple
+
+import yaml
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, maybeDeferred, returnValue, succeed)
+from twisted.internet.task import react
+from twisted.python import usage
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.message import TransportEvent, TransportUserMessage
+
+from vxapprouter.redisutils import send_command
+from vxapprouter.router import ApplicationDispatcher
+
+
+KeyUsage = namedtuple('KeyUsage', ['keys', 'bytes', 'ttl'])
+
+
+class CommandCounter(object):
+    """
+    Wraps a Redis client and counts the commands sent through it, and the
+    keys starting with ``prefix`` that did not exist when they were first
+    touched.
+
+    The first command for each key is sent after an EXISTS for it, which
+    is not counted. Commands are answered in the order they are sent, so
+    the EXISTS sees the key as it was before any command from the
+    wrapped client.
+    """
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+        self.commands = Counter()
+        self.touched = set()
+        self.keys = set()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kw):
+            self.commands[name] += 1
+            if not (args and isinstance(args[0], basestring) and
+                    args[0].startswith(self.prefix) and
+                    args[0] not in self.touched):
+                return attr(*args, **kw)
+            key = args[0]
+            self.touched.add(key)
+
+            def check(existed):
+                if not existed:
+                    self.keys.add(key)
+                return attr(*args, **kw)
+            return maybeDeferred(self.client.exists, key).addCallback(check)
+        return call
+
+
+class PlanningDispatcher(ApplicationDispatcher):
+    """
+    An ApplicationDispatcher that does not publish anything, and records
+    the messages it would have published.
+    """
+
+    def __init__(self, *args, **kw):
+        super(PlanningDispatcher, self).__init__(*args, **kw)
+        self.published = []
+
+    def start_publisher(self, publisher_class, prefix):
+        return succeed(MetricManager(prefix))
+
+    def publish_inbound(self, msg, connector_name, endpoint):
+        self.published.append(('inbound', msg, connector_name))
+        return succeed(None)
+
+    def publish_outbound(self, msg, connector_name, endpoint):
+        self.published.append(('outbound', msg, connector_name))
+        return succeed(None)
+
+    def publish_event(self, event, connector_name, endpoint):
+        return succeed(None)
+
+
+class CapacityPlanner(object):
+    """
+    Measures the Redis cost of a session on ``dispatcher``, which must be
+    set up.
+
+    Each sample session starts with a new session message and picks the
+    first menu entry until it reaches an application. The rest of its
+    ``messages_per_session`` inbound messages are forwarded to that
+    application, which replies to each of them. Every outbound message,
+    from the menu or the application, gets ``events_per_message`` acks.
+    Sessions are left open, so session keys are measured as they are just
+    before they are closed or expire. Only the keys the sample sessions
+    created are measured and removed.
+    """
+
+    def __init__(self, dispatcher, messages_per_session=5,
+                 events_per_message=1, samples=100):
+        self.dispatcher = dispatcher
+        self.messages_per_session = messages_per_session
+        self.events_per_message = events_per_message
+        self.samples = samples
+        config = dispatcher.get_static_config()
+        self.transport_connector = config.receive_inbound_connectors[0]
+        self.redis = dispatcher.redis
+        self.prefix = self.redis.get_key_prefix() + ':'
+        self.counter = None
+        self.outbound_messages = 0
+        self.events = 0
+
+    def user_id(self, sample):
+        return '+999%09d' % (sample,)
+
+    @inlineCallbacks
+    def inbound(self, user_id, content, session_event):
+        msg = TransportUserMessage(
+            to_addr='*120*1#', from_addr=user_id, content=content,
+            session_event=session_event,
+            transport_name=self.transport_connector, transport_type='ussd')
+        config = yield self.dispatcher.get_config(msg)
+        yield self.dispatcher.handle_inbound(
+            config, msg, self.transport_connector)
+
+    @inlineCallbacks
+    def outbound(self, msg, connector_name):
+        reply = msg.reply('Sample reply')
+        config = yield self.dispatcher.get_config(reply)
+        yield self.dispatcher.send_outbound(config, reply, connector_name)
+
+    @inlineCallbacks
+    def ack(self, msg):
+        event = TransportEvent(
+            event_type='ack', user_message_id=msg['message_id'],
+            sent_message_id=msg['message_id'],
+            transport_name=self.transport_connector)
+        config = yield self.dispatcher.get_config(event)
+        yield self.dispatcher.handle_event(
+            config, event, self.transport_connector)
+
+    @inlineCallbacks
+    def run_session(self, user_id):
+        published = self.dispatcher.published
+        yield self.inbound(user_id, None, TransportUserMessage.SESSION_NEW)
+        forwarded = False
+        for i in range(self.messages_per_session - 1):
+            start = len(published)
+            if forwarded:
+                yield self.inbound(
+                    user_id, 'Sample', TransportUserMessage.SESSION_RESUME)
+            else:
+                yield self.inbound(
+                    user_id, '1', TransportUserMessage.SESSION_RESUME)
+            for direction, msg, connector_name in published[start:]:
+                if direction == 'inbound':
+                    forwarded = True
+                    yield self.outbound(msg, connector_name)
+        for direction, msg, _ in published:
+            if direction != 'outbound':
+                continue
+            self.outbound_messages += 1
+            for i in range(self.events_per_message):
+                self.events += 1
+                yield self.ack(msg)
+        del published[:]
+
+    @inlineCallbacks
+    def run(self):
+        """
+        Run the sample sessions, measure the keys they created and remove
+        them. Returns the :class:`KeyUsage` of each kind of key, named
+        by the first part of the key after the dispatcher's prefix.
+        """
+        proxy = self.redis._client_proxy
+        client = proxy.client
+        self.counter = proxy.client = CommandCounter(client, self.prefix)
+        try:
+            for sample in range(self.samples):
+                yield self.run_session(self.user_id(sample))
+        finally:
+            proxy.client = client
+        usages = yield self.measure(sorted(self.counter.keys))
+        returnValue(usages)
+
+    @inlineCallbacks
+    def measure(self, keys):
+        client = self.counter.client
+        exists = yield gatherResults([
+            maybeDeferred(client.exists, key) for key in keys])
+        keys = [key for key, found in zip(keys, exists) if found]
+        sizes = yield gatherResults([self.memory_usage(key) for key in keys])
+        ttls = yield gatherResults([
+            maybeDeferred(client.ttl, key) for key in keys])
+        yield gatherResults([
+            maybeDeferred(client.delete, key) for key in keys])
+        kinds = {}
+        for key, size, ttl in zip(keys, sizes, ttls):
+            kind = key[len(self.prefix):].split(':', 1)[0]
+            kinds.setdefault(kind, []).append((size, ttl))
+        usages = {}
+        for kind, measured in kinds.items():
+            ttls = [ttl for _, ttl in measured]
+            usages[kind] = KeyUsage(
+                keys=len(measured) / float(self.samples),
+                bytes=sum(size for size, _ in measured) / len(measured),
+                ttl=None if None in ttls else max(ttls))
+        returnValue(usages)
+
+    def memory_usage(self, key):
+        return send_command(self.counter.client, 'MEMORY', 'USAGE', key)
+
+    def command_rates(self, sessions_per_second):
+        """
+        Return the number of each Redis command sent per second at
+        ``sessions_per_second`` new sessions a second.
+        """
+        return dict(
+            (name, count * sessions_per_second / float(self.samples))
+            for name, count in self.counter.commands.items())
+
+
+def project_memory(usages, sessions_per_second, session_duration):
+    """
+    Return the number of keys and bytes of each kind of key held at
+    ``sessions_per_second`` new sessions a second, as ``{kind: (keys,
+    bytes)}``. Session keys live for ``session_duration`` seconds at most,
+    since sessions are removed when they close, and other keys for their
+    TTL. Keys without a TTL are projected as ``None``.
+    """
+    projected = {}
+    for kind, key_usage in usages.items():
+        lifetime = key_usage.ttl
+        if kind == 'session' and lifetime is not None:
+            lifetime = min(lifetime, session_duration)
+        if lifetime is None:
+            projected[kind] = None
+            continue
+        keys = sessions_per_second * key_usage.keys * lifetime
+        projected[kind] = (keys, keys * key_usage.bytes)
+    return projected
+
+
+class Options(usage.Options):
+
+    synopsis = "<config-file.yaml>"
+
+    longdesc = """
+    Measure the Redis memory and commands used by sample sessions on an
+    ApplicationDispatcher, and project them to the given traffic. The
+    sample sessions are run on the scratch Redis server given with
+    --redis, not the one in the config.
+    """
+
+    optParameters = [
+        ["redis", "r", None,
+         "The host:port[/db] of a scratch Redis server to run the sample "
+         "sessions on. Required."],
+        ["sessions", "s", "10", "The number of new sessions per second."],
+        ["messages-per-session", "m", "5",
+         "The number of inbound messages per session."],
+        ["events-per-message", "e", "1",
+         "The number of events per outbound message."],
+        ["session-duration", "d", None,
+         "How long sessions last in seconds, if shorter than "
+         "session_expiry."],
+        ["samples", "n", "100", "The number of sample sessions to run."],
+    ]
+
+    def parseArgs(self, config_file):
+        with open(config_file) as f:
+            self['config'] = yaml.safe_load(f)
+
+    def postOptions(self):
+        self['sessions'] = float(self['sessions'])
+        self['messages-per-session'] = int(self['messages-per-session'])
+        self['events-per-message'] = int(self['events-per-message'])
+        self['samples'] = int(self['samples'])
+        if self['redis'] is None:
+            raise usage.UsageError(
+                "Please give a scratch Redis server with --redis.")
+        self['config']['redis_manager'] = self.redis_manager(
+            self['redis'], self['config'].get('redis_manager', {}))
+        if self['messages-per-session'] < 1:
+            raise usage.UsageError(
+                "A session needs at least one inbound message.")
+        if self['session-duration'] is not None:
+            self['session-duration'] = float(self['session-duration'])
+
+    def redis_manager(self, address, config):
+        """
+        Return the ``redis_manager`` config for the server at ``address``,
+        with the key prefix of ``config``.
+        """
+        address, _, db = address.partition('/')
+        host, _, port = address.partition(':')
+        try:
+            redis_manager = {
+                'host': host or '127.0.0.1', 'port': int(port or 6379),
+                'db': int(db or 0)}
+        except ValueError:
+            raise usage.UsageError("Invalid Redis server: %r" % (
+                self['redis'],))
+        if 'key_prefix' in config:
+            redis_manager['key_prefix'] = config['key_prefix']
+        return redis_manager
+
+
+def format_bytes(size):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fTB' % (size,)
+
+
+def print_plan(planner, usages, options):
+    sessions = options['sessions']
+    session_duration = options['session-duration']
+    if session_duration is None:
+        config = planner.dispatcher.get_static_config()
+        session_duration = config.session_expiry
+    projected = project_memory(usages, sessions, session_duration)
+    print "Per session: %s inbound, %.1f outbound messages, %.1f events." % (
+        planner.messages_per_session,
+        planner.outbound_messages / float(planner.samples),
+        planner.events / float(planner.samples))
+    print
+    print '%-12s %12s %10s %10s %12s %10s' % (
+        'key', 'keys/session', 'bytes/key', 'ttl', 'keys', 'memory')
+    total = 0
+    for kind in sorted(usages):
+        key_usage = usages[kind]
+        if projected[kind] is None:
+            keys, memory = 'unbounded', 'unbounded'
+        else:
+            keys, size = projected[kind]
+            total += size
+            keys, memory = '%d' % (keys,), format_bytes(size)
+        ttl = '-' if key_usage.ttl is None else '%ds' % (key_usage.ttl,)
+        print '%-12s %12.1f %10d %10s %12s %10s' % (
+            kind, key_usage.keys, key_usage.bytes, ttl, keys, memory)
+    print
+    print 'Memory: %s, before fragmentation and replication buffers.' % (
+        format_bytes(total),)
+    print
+    rates = planner.command_rates(sessions)
+    print 'Commands: %.1f/s' % (sum(rates.values()),)
+    for name, rate in sorted(rates.items(), key=lambda item: -item[1]):
+        print '  %-10s %10.1f/s' % (name, rate)
+
+
+@inlineCallbacks
+def main(reactor, options):
+    dispatcher = PlanningDispatcher({}, options['config'])
+    yield dispatcher.setup_dispatcher()
+    planner = CapacityPlanner(
+        dispatcher, options['messages-per-session'],
+        options['events-per-message'], options['samples'])
+    try:
+        usages = yield planner.run()
+    finally:
+        yield dispatcher.teardown_dispatcher()
+    print_plan(planner, usages, options)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    react(main, [options])
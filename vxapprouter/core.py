@@ -0,0 +1,449 @@
+# -*- test-case-name: vxapprouter.tests.test_core -*-
+"""
+The routing state machine, free of Redis and AMQP I/O.
+
+:meth:`StateMachine.decide` takes an inbound message and the sender's
+session and returns a :class:`Decision` describing what should be done:
+the session fields to write, the messages to forward to applications and
+the replies to send. The dispatcher loads sessions and carries out
+decisions.
+"""
+from vumi import log
+from vumi.message import TransportUserMessage
+
+from vxapprouter.menu import (
+    MenuPlan, compile_menu, menu_fingerprint, mkmenu)
+
+
+class StateResponse(object):
+    def __init__(self, state, session_update=None, inbound=(), outbound=(),
+                 end_reason='config_change'):
+        self.next_state = state
+        self.session_update = session_update or {}
+        self.inbound = inbound
+        self.outbound = outbound
+        # Why the session ended, if ``state`` is ``None``.
+        self.end_reason = end_reason
+
+
+def clean(content):
+    return (content or '').strip()
+
+
+class Decision(object):
+    """
+    What to do with an inbound message.
+
+    ``session`` is the user's session after the message. If ``created``
+    is set, it has to be stored as a new session; otherwise the fields in
+    ``session_update`` have to be written to the existing one. If
+    ``cleared`` is set, the session has to be removed instead, and
+    ``end_reason`` says why.
+
+    ``inbound`` holds ``(msg, endpoint)`` pairs to forward to applications
+    and ``outbound`` the replies to send to the user. ``closed`` is set
+    for a session close from the user, whose messages are forwarded
+    without rate limiting. ``quiet`` is set for decisions that are never
+    carried out, which are not logged.
+    """
+
+    def __init__(self, msg, state, session, created=False, closed=False,
+                 inbound=(), quiet=False):
+        self.msg = msg
+        self.user_id = msg['from_addr']
+        self.state = state
+        self.session = session
+        self.session_update = {}
+        self.created = created
+        self.cleared = closed
+        self.closed = closed
+        self.end_reason = 'close' if closed else None
+        self.inbound = list(inbound)
+        self.outbound = []
+        self.quiet = quiet
+
+    def update(self, fields):
+        self.session = dict(self.session, **fields)
+        self.session_update.update(fields)
+
+    def clear(self, reason):
+        self.cleared = True
+        self.end_reason = reason
+        self.session_update = {}
+
+
+class StateMachine(object):
+    """
+    The router's menu state machine.
+
+    This is a mixin for the dispatcher, but it does no I/O and can be used
+    on its own after calling :meth:`setup_state_machine`. All the
+    built-in state handlers are synchronous.
+    """
+
+    STATE_START = "start"
+    STATE_SELECT = "select"
+    STATE_SELECTED = "selected"
+    STATE_BAD_INPUT = "bad_input"
+    STATE_RETURNING = "returning"
+    STATE_CONTINUE = "continue"
+
+    RESUME_PROMPT = "prompt"
+    RESUME_ROUTE = "route"
+
+    MAX_CACHED_MENU_PLANS = 16
+
+    def setup_state_machine(self):
+        self.handlers = {
+            self.STATE_START: self.handle_state_start,
+            self.STATE_SELECT: self.handle_state_select,
+            self.STATE_SELECTED: self.handle_state_selected,
+            self.STATE_BAD_INPUT: self.handle_state_bad_input,
+            self.STATE_RETURNING: self.handle_state_returning,
+            self.STATE_CONTINUE: self.handle_state_continue,
+        }
+        self._menu_plans = {}
+
+    def is_new_session(self, msg, session):
+        return (not session or
+                msg['session_event'] == TransportUserMessage.SESSION_NEW)
+
+    def begin(self, config, msg, session, last_endpoint=None):
+        """
+        Return the decision for ``msg`` before its state handler has run.
+        Session close messages need no handler and are fully decided.
+
+        ``last_endpoint`` is the endpoint the user selected in their
+        previous session, if it is remembered. New sessions for returning
+        users start in the returning state instead of the start state.
+        """
+        user_id = msg['from_addr']
+        session_event = msg['session_event']
+        quiet = not self.logs_decisions(config)
+        if self.is_new_session(msg, session):
+            self.log_msg(config, "Creating session for user %s" % user_id)
+            if last_endpoint is not None:
+                return Decision(
+                    msg, self.STATE_RETURNING,
+                    {'last_endpoint': last_endpoint}, created=True,
+                    quiet=quiet)
+            return Decision(
+                msg, self.STATE_START, {}, created=True, quiet=quiet)
+        if session_event == TransportUserMessage.SESSION_CLOSE:
+            inbound = []
+            if (session.get('state', None) == self.STATE_SELECTED and
+                    session['active_endpoint'] in
+                    self.target_endpoints(config)):
+                inbound = [(msg, session['active_endpoint'])]
+            return Decision(msg, session.get('state'), session, closed=True,
+                            inbound=inbound, quiet=quiet)
+        self.log_msg(
+            config, "Loading session for user %s: %s" % (user_id, session,))
+        return Decision(msg, session['state'], session, quiet=quiet)
+
+    def conclude(self, decision, state_resp):
+        """
+        Complete ``decision`` with the response of its state handler.
+        """
+        if state_resp.next_state is None:
+            # Session terminated, because of an administrator-initiated
+            # configuration change or an unavailable endpoint.
+            decision.clear(state_resp.end_reason)
+        else:
+            if decision.state != state_resp.next_state and not decision.quiet:
+                log.msg("State transition for user %s: %s => %s" % (
+                    decision.user_id, decision.state, state_resp.next_state))
+            decision.update(state_resp.session_update)
+            decision.update({'state': state_resp.next_state})
+        decision.inbound = list(state_resp.inbound)
+        decision.outbound = list(state_resp.outbound)
+        return decision
+
+    def logs_decisions(self, config):
+        """
+        Return whether decisions made with ``config`` are logged. They are
+        not for configs with a false ``log_decisions`` attribute, such as
+        the candidate config of a shadow evaluation.
+        """
+        return getattr(config, 'log_decisions', True)
+
+    def log_msg(self, config, message):
+        if self.logs_decisions(config):
+            log.msg(message)
+
+    def fail(self, config, decision):
+        """
+        Turn ``decision`` into one that ends the session with the error
+        message. Must be called while handling the exception.
+        """
+        log.err()
+        decision.clear('error')
+        decision.inbound = []
+        decision.outbound = [self.make_error_reply(decision.msg, config)]
+        return decision
+
+    def decide(self, config, msg, session, last_endpoint=None):
+        decision = self.begin(config, msg, session, last_endpoint)
+        if decision.closed:
+            return decision
+        try:
+            state_resp = self.handlers[decision.state](
+                config, decision.session, msg)
+            return self.conclude(decision, state_resp)
+        except Exception:
+            return self.fail(config, decision)
+
+    def decide_batch(self, config, messages, sessions, last_endpoints=None):
+        """
+        Decide a batch of messages, given the sessions loaded for their
+        senders and, optionally, the endpoints they last selected.
+        Messages from the same user are decided in order, each one seeing
+        the session left by the one before.
+        """
+        if last_endpoints is None:
+            last_endpoints = [None] * len(messages)
+        latest = {}
+        decisions = []
+        for msg, session, last_endpoint in zip(
+                messages, sessions, last_endpoints):
+            user_id = msg['from_addr']
+            if user_id in latest:
+                session = latest[user_id]
+            decision = self.decide(config, msg, session, last_endpoint)
+            latest[user_id] = {} if decision.cleared else decision.session
+            decisions.append(decision)
+        return decisions
+
+    def forwarded_message(self, msg, **kwargs):
+        """
+        Return a copy of ``msg`` with the fields in ``kwargs`` replaced.
+
+        The copy is not revalidated. Its metadata dicts are copied so that
+        routing and middleware can update them without affecting ``msg``,
+        but anything nested inside them is shared.
+        """
+        payload = dict(msg.payload)
+        for key, value in msg.payload.iteritems():
+            if isinstance(value, dict):
+                payload[key] = dict(value)
+        payload.update(kwargs)
+        copy = msg.__class__.__new__(msg.__class__)
+        copy.payload = payload
+        return copy
+
+    def get_menu_plan(self, config, exclude=None):
+        """
+        Return the compiled menu for this config. Plans are compiled once
+        and cached for as long as the menu configuration stays the same.
+
+        Endpoints in ``exclude`` are left out of the menu. By default,
+        these are the endpoints returned by :meth:`hidden_endpoints`.
+
+        Plans for a :class:`ConfigSnapshot` are also cached on the
+        snapshot, keyed only by ``exclude``, so that looking them up does
+        not need the menu fingerprint.
+        """
+        if exclude is None:
+            exclude = self.hidden_endpoints()
+        exclude = frozenset(exclude)
+        snapshot_plans = getattr(config, '_menu_plans', None)
+        if snapshot_plans is not None:
+            plan = snapshot_plans.get(exclude)
+            if plan is not None:
+                return plan
+        args = (config.menu_title, config.entries, config.menu_max_length,
+                config.more_label, config.back_label, exclude)
+        key = menu_fingerprint(*args)
+        plan = self._menu_plans.get(key)
+        if plan is None:
+            if len(self._menu_plans) >= self.max_cached_menu_plans():
+                self._menu_plans.clear()
+            plan = self._menu_plans[key] = compile_menu(*args)
+        if snapshot_plans is not None:
+            if len(snapshot_plans) >= self.max_cached_menu_plans():
+                snapshot_plans.clear()
+            snapshot_plans[exclude] = plan
+        return plan
+
+    def max_cached_menu_plans(self):
+        return self.MAX_CACHED_MENU_PLANS
+
+    def target_endpoints(self, config):
+        """
+        Make sure the currently active endpoint is still valid.
+        """
+        return self.get_menu_plan(config, exclude=()).endpoints
+
+    def hidden_endpoints(self):
+        return frozenset()
+
+    def endpoint_available(self, endpoint):
+        return True
+
+    def resume_mode(self):
+        """
+        Return what to do with a new session for a user whose last
+        endpoint is remembered: :attr:`RESUME_PROMPT` to offer it before
+        the menu, :attr:`RESUME_ROUTE` to forward the session to it
+        straight away, or ``None`` to show the menu.
+        """
+        return None
+
+    def get_menu_transition(self, config, session, msg):
+        """
+        Retrieves the transition for the user's numeric choice on the menu
+        page stored in their session.
+        """
+        plan = self.get_menu_plan(config)
+        page = plan.page(session.get('menu_page'))
+        if page is None:
+            return None
+        choice = self.get_menu_choice(msg, (1, len(page.labels)))
+        if choice is None:
+            return None
+        return plan.choose(page.page_id, choice)
+
+    def get_menu_choice(self, msg, valid_range):
+        """
+        Parse user input for selecting a numeric menu choice
+        """
+        try:
+            value = int(clean(msg['content']))
+        except ValueError:
+            return None
+        else:
+            if not valid_range[0] <= value <= valid_range[1]:
+                return None
+            return value
+
+    def make_first_reply(self, config, session, msg):
+        return self.make_menu_reply(
+            config, session, msg, self.get_menu_plan(config).root)
+
+    def make_menu_reply(self, config, session, msg, page):
+        return msg.reply(page.text)
+
+    def make_continue_reply(self, config, session, msg, label):
+        return msg.reply(config.continue_title % {'label': label} + "\n" +
+                         mkmenu([config.continue_label, config.menu_label]))
+
+    def make_invalid_input_reply(self, config, session, msg):
+        return msg.reply('%s\n\n1. %s' % (
+            config.invalid_input_message, config.try_again_message))
+
+    def handle_state_start(self, config, session, msg):
+        """
+        When presenting the menu, we also store the id of the page shown
+        and the version of the compiled menu in the session data. Later,
+        in the select state, we look up the user's choice on that page.
+        """
+        reply_msg = self.make_first_reply(config, session, msg)
+        return StateResponse(self.STATE_SELECT, {
+            'menu_page': MenuPlan.ROOT,
+            'menu_version': self.get_menu_plan(config).version,
+        }, outbound=[reply_msg])
+
+    def handle_state_select(self, config, session, msg):
+        plan = self.get_menu_plan(config)
+        if session.get('menu_version') != plan.version:
+            self.log_msg(config, "Router configuration change restarted "
+                         "menu for user %s" % msg['from_addr'])
+            return self.handle_state_start(config, session, msg)
+
+        transition = self.get_menu_transition(config, session, msg)
+        if transition is None:
+            reply_msg = self.make_invalid_input_reply(config, session, msg)
+            return StateResponse(self.STATE_BAD_INPUT, outbound=[reply_msg])
+
+        if transition.action == MenuPlan.PAGE:
+            page = plan.page(transition.target)
+            reply_msg = self.make_menu_reply(config, session, msg, page)
+            return StateResponse(
+                self.STATE_SELECT, {'menu_page': page.page_id},
+                outbound=[reply_msg])
+
+        return self.select_endpoint(config, msg, transition.target)
+
+    def select_endpoint(self, config, msg, endpoint):
+        if not self.endpoint_available(endpoint):
+            self.log_msg(config, "Endpoint '%s' unavailable for user %s" %
+                         (endpoint, msg['from_addr']))
+            reply_msg = self.make_unavailable_reply(msg, config)
+            return StateResponse(
+                None, outbound=[reply_msg], end_reason='unavailable')
+
+        forwarded_msg = self.forwarded_message(
+            msg, content=None,
+            session_event=TransportUserMessage.SESSION_NEW)
+        self.log_msg(config, "Switched to endpoint '%s' for user %s" %
+                     (endpoint, msg['from_addr']))
+        return StateResponse(
+            self.STATE_SELECTED, {'active_endpoint': endpoint},
+            inbound=[(forwarded_msg, endpoint)])
+
+    def handle_state_selected(self, config, session, msg):
+        active_endpoint = session['active_endpoint']
+        if active_endpoint not in self.target_endpoints(config):
+            self.log_msg(config, "Router configuration change forced "
+                         "session termination for user %s" %
+                         msg['from_addr'])
+            error_reply_msg = self.make_error_reply(msg, config)
+            return StateResponse(None, outbound=[error_reply_msg])
+        else:
+            return StateResponse(
+                self.STATE_SELECTED, inbound=[(msg, active_endpoint)])
+
+    def handle_state_returning(self, config, session, msg):
+        """
+        A new session for a user whose last endpoint is remembered. If it
+        is still on the menu and available, it is offered to the user or
+        selected for them, depending on :meth:`resume_mode`. Otherwise
+        the menu is shown as usual.
+        """
+        endpoint = session['last_endpoint']
+        plan = self.get_menu_plan(config)
+        mode = self.resume_mode()
+        if (mode is None or endpoint not in plan.endpoints or
+                not self.endpoint_available(endpoint)):
+            return self.handle_state_start(config, session, msg)
+        if mode == self.RESUME_ROUTE:
+            self.log_msg(config, "Resumed endpoint '%s' for user %s" %
+                         (endpoint, msg['from_addr']))
+            return self.select_endpoint(config, msg, endpoint)
+        reply_msg = self.make_continue_reply(
+            config, session, msg, plan.labels[endpoint])
+        return StateResponse(
+            self.STATE_CONTINUE, {'last_endpoint': endpoint},
+            outbound=[reply_msg])
+
+    def handle_state_continue(self, config, session, msg):
+        """
+        The user was asked whether to continue with their last endpoint.
+        The first choice selects it, anything else shows the menu.
+        """
+        if self.get_menu_choice(msg, (1, 1)) is None:
+            return self.handle_state_start(config, session, msg)
+        endpoint = session['last_endpoint']
+        if endpoint not in self.target_endpoints(config):
+            return self.handle_state_start(config, session, msg)
+        return self.select_endpoint(config, msg, endpoint)
+
+    def handle_state_bad_input(self, config, session, msg):
+        choice = self.get_menu_choice(msg, (1, 1))
+        if choice is None:
+            reply_msg = self.make_invalid_input_reply(config, session, msg)
+            return StateResponse(self.STATE_BAD_INPUT, outbound=[reply_msg])
+        else:
+            return self.handle_state_start(config, session, msg)
+
+    def create_menu(self, config):
+        return self.get_menu_plan(config).root.text
+
+    def make_error_reply(self, msg, config):
+        return msg.reply(config.error_message, continue_session=False)
+
+    def make_unavailable_reply(self, msg, config):
+        return msg.reply(config.unavailable_message, continue_session=False)
+
+    def make_busy_reply(self, msg, config):
+        return msg.reply(config.busy_message, continue_session=False)
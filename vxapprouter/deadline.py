@@ -0,0 +1,70 @@
+# -*- test-case-name: vxapprouter.tests.test_deadline -*-
+from functools import partial
+
+from twisted.internet.defer import CancelledError, fail, maybeDeferred
+from twisted.python.failure import Failure
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call does not complete before the message deadline."""
+
+
+class Deadline(object):
+    """
+    The time budget for processing a single message.
+
+    Calls made through :meth:`call` are cancelled and fail with
+    :class:`DeadlineExceeded` if they have not completed when the budget
+    runs out. Calls made after it has run out fail immediately. A
+    deadline without a ``timeout`` never expires.
+    """
+
+    def __init__(self, clock, timeout=None):
+        self.clock = clock
+        self.expires_at = None
+        if timeout is not None:
+            self.expires_at = clock.seconds() + timeout
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - self.clock.seconds()
+
+    def call(self, func, *args, **kw):
+        remaining = self.remaining()
+        if remaining is None:
+            return maybeDeferred(func, *args, **kw)
+        if remaining <= 0:
+            return fail(DeadlineExceeded())
+
+        d = maybeDeferred(func, *args, **kw)
+        timeout = self.clock.callLater(remaining, d.cancel)
+
+        def finished(result):
+            if timeout.active():
+                timeout.cancel()
+            elif isinstance(result, Failure) and result.check(CancelledError):
+                raise DeadlineExceeded()
+            return result
+
+        return d.addBoth(finished)
+
+    def bind(self, obj):
+        """
+        Return a proxy for ``obj`` whose method calls are subject to this
+        deadline.
+        """
+        return DeadlineProxy(self, obj)
+
+
+class DeadlineProxy(object):
+
+    def __init__(self, deadline, obj):
+        self._deadline = deadline
+        self._obj = obj
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        return partial(self._deadline.call, attr)
@@ -0,0 +1,145 @@
+# -*- test-case-name: vxapprouter.tests.test_dedup -*-
+import hashlib
+import math
+import struct
+
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+
+from vumi.persist.fake_redis import FakeRedis
+
+from vxapprouter.redisutils import send_command
+
+
+class BloomFilter(object):
+    """
+    A fixed size Bloom filter sized to hold ``capacity`` keys with a false
+    positive rate of about ``error_rate``.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, key):
+        return all(
+            self.bits[i // 8] & (1 << (i % 8)) for i in self._indexes(key))
+
+    def add(self, key):
+        for i in self._indexes(key):
+            self.bits[i // 8] |= 1 << (i % 8)
+        self.count += 1
+
+    def full(self):
+        return self.count >= self.capacity
+
+
+class RecentIds(set):
+    """
+    An exact set of keys, for when :class:`BloomFilter` false positives
+    are not acceptable, which is full once it holds ``capacity`` keys.
+    """
+
+    def __init__(self, capacity):
+        super(RecentIds, self).__init__()
+        self.capacity = capacity
+
+    def full(self):
+        return len(self) >= self.capacity
+
+
+def set_new_key(redis, key, value, ttl):
+    """
+    Set ``key`` to ``value``, expiring in ``ttl`` seconds, if it does not
+    exist yet, with a single ``SET key value NX EX ttl``. Returns a
+    deferred that fires with ``True`` if the key was set.
+    """
+    key = redis._key(key)
+    client = redis._client
+    if isinstance(client, FakeRedis):
+        # FakeRedis has no SET options, but runs each command right
+        # away, so nothing can come between these two.
+        added = FakeRedis.setnx.sync(client, key, value)
+        if added:
+            FakeRedis.expire.sync(client, key, ttl)
+        return succeed(bool(added))
+    d = send_command(client, 'SET', key, value, 'NX', 'EX', ttl)
+    return d.addCallback(lambda result: result == 'OK')
+
+
+class Deduplicator(object):
+    """
+    Detects messages that have already been seen in the last ``ttl``
+    seconds.
+
+    If ``redis`` is given, message ids are recorded there, so that a
+    retransmission handled by another worker is also detected, and Redis
+    alone decides whether a message is a duplicate. Otherwise they are
+    remembered in two generations of :class:`RecentIds` that are rotated
+    every ``ttl`` seconds, or sooner if the current one holds ``capacity``
+    ids.
+
+    If ``approximate`` is set, the generations are Bloom filters instead,
+    which take much less memory, but a false positive in them, at a rate
+    of about ``error_rate``, drops a message that was not a duplicate.
+    """
+
+    def __init__(self, clock, ttl=60, capacity=100000, error_rate=0.001,
+                 redis=None, approximate=False):
+        self.clock = clock
+        self.ttl = ttl
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.redis = redis
+        self.approximate = approximate and redis is None
+        self.current = self._generation()
+        self.previous = None
+        self.rotated_at = clock.seconds()
+
+    @classmethod
+    def from_config(cls, clock, config, redis=None):
+        config = dict(config)
+        if not config.pop('shared', True):
+            redis = None
+        return cls(clock, redis=redis, **config)
+
+    def _rotate(self):
+        if (self.current.full() or
+                self.clock.seconds() - self.rotated_at >= self.ttl):
+            self.previous = self.current
+            self.current = self._generation()
+            self.rotated_at = self.clock.seconds()
+
+    def _generation(self):
+        if self.approximate:
+            return BloomFilter(self.capacity, self.error_rate)
+        return RecentIds(self.capacity)
+
+    def seen_locally(self, key):
+        return key in self.current or (
+            self.previous is not None and key in self.previous)
+
+    @inlineCallbacks
+    def is_duplicate(self, message_id):
+        """
+        Record ``message_id`` and return a deferred that fires with
+        ``True`` if it has been seen before.
+        """
+        if self.redis is not None:
+            added = yield set_new_key(self.redis, message_id, 1, self.ttl)
+            returnValue(not added)
+        self._rotate()
+        key = message_id.encode('utf-8')
+        if self.seen_locally(key):
+            returnValue(True)
+        self.current.add(key)
+        returnValue(False)
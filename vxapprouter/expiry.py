@@ -0,0 +1,199 @@
+# -*- test-case-name: vxapprouter.tests.test_expiry -*-
+import json
+import math
+
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, maybeDeferred, returnValue)
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+
+
+def expiry_key(tenant, user_id):
+    """
+    Return the key the session of ``user_id`` is tracked under, for
+    ``tenant`` or, if it is ``None``, for the default config.
+    """
+    if tenant is None:
+        return user_id
+    return json.dumps([tenant, user_id])
+
+
+class TimerWheel(object):
+    """
+    A hashed timing wheel of ``slots`` slots of ``resolution`` seconds.
+
+    Scheduling and cancelling a key are constant time, and advancing the
+    wheel only looks at the slots for the ticks that have passed. Keys
+    are due at the first tick at or after their deadline, so they may
+    fire up to ``resolution`` seconds late.
+    """
+
+    def __init__(self, now, resolution=1.0, slots=512):
+        self.resolution = resolution
+        self.slots = [{} for _ in range(slots)]
+        self.ticks = {}
+        self.tick = int(now // resolution)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __contains__(self, key):
+        return key in self.ticks
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        tick = max(int(math.ceil(deadline / self.resolution)), self.tick + 1)
+        self.slots[tick % len(self.slots)][key] = tick
+        self.ticks[key] = tick
+
+    def cancel(self, key):
+        tick = self.ticks.pop(key, None)
+        if tick is not None:
+            del self.slots[tick % len(self.slots)][key]
+
+    def advance(self, now):
+        """
+        Advance the wheel to ``now`` and return the keys that are due.
+        """
+        target = int(now // self.resolution)
+        start = max(self.tick + 1, target - len(self.slots) + 1)
+        due = []
+        for tick in range(start, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key, key_tick in slot.items():
+                if key_tick <= target:
+                    del slot[key]
+                    del self.ticks[key]
+                    due.append(key)
+        self.tick = max(self.tick, target)
+        return due
+
+
+class SessionExpiry(object):
+    """
+    Tracks when sessions expire, so that the applications they were
+    routed to can be told.
+
+    Deadlines are kept in a :class:`TimerWheel` in memory and in a sorted
+    set in ``redis``, along with a JSON record for each session in a hash.
+    When a deadline in the wheel passes, the session is claimed by
+    removing it from the sorted set, and ``expired`` is called with its
+    key and record. Deadlines that are moved or removed by other workers
+    are checked in Redis before claiming them, so each expired session is
+    claimed once.
+
+    Every ``recovery_interval`` seconds, sessions that are more than
+    ``grace`` seconds overdue in Redis, such as those tracked by a worker
+    that has stopped, are claimed too. Sessions are claimed and expired
+    in batches of ``batch_size``.
+    """
+
+    DEADLINES_KEY = 'deadlines'
+    SESSIONS_KEY = 'sessions'
+
+    def __init__(self, clock, redis, expired, resolution=1.0, slots=512,
+                 grace=10, recovery_interval=60, batch_size=100):
+        self.clock = clock
+        self.redis = redis
+        self.expired = expired
+        self.resolution = resolution
+        self.grace = grace
+        self.recovery_interval = recovery_interval
+        self.batch_size = batch_size
+        self.wheel = TimerWheel(clock.seconds(), resolution, slots)
+        self._tick = LoopingCall(self.tick)
+        self._tick.clock = clock
+        self._recover = LoopingCall(self.recover)
+        self._recover.clock = clock
+
+    @classmethod
+    def from_config(cls, clock, config, redis, expired):
+        return cls(clock, redis, expired, **config)
+
+    def start(self):
+        self._tick.start(self.resolution, now=False).addErrback(
+            log.err, "Session expiry stopped")
+        self._recover.start(self.recovery_interval).addErrback(
+            log.err, "Session expiry recovery stopped")
+
+    def stop(self):
+        for call in (self._tick, self._recover):
+            if call.running:
+                call.stop()
+
+    def track(self, key, deadline, record):
+        """
+        Expire the session ``key`` at ``deadline``, with ``record``.
+        """
+        self.wheel.schedule(key, deadline)
+        return gatherResults([
+            self.redis.zadd(self.DEADLINES_KEY, **{key: deadline}),
+            self.redis.hset(self.SESSIONS_KEY, key, json.dumps(record)),
+        ])
+
+    def reschedule(self, key, deadline):
+        """
+        Move the deadline of the session ``key``, which must be tracked.
+        """
+        self.wheel.schedule(key, deadline)
+        return self.redis.zadd(self.DEADLINES_KEY, **{key: deadline})
+
+    def untrack(self, key):
+        self.wheel.cancel(key)
+        return gatherResults([
+            self.redis.zrem(self.DEADLINES_KEY, key),
+            self.redis.hdel(self.SESSIONS_KEY, key),
+        ])
+
+    def tick(self):
+        d = self.expire(self.wheel.advance(self.clock.seconds()))
+        d.addErrback(log.err, "Failed to expire sessions")
+        return d
+
+    @inlineCallbacks
+    def recover(self):
+        """
+        Claim and expire the sessions that are overdue in Redis.
+        """
+        try:
+            while True:
+                keys = yield self.redis.zrangebyscore(
+                    self.DEADLINES_KEY, '-inf',
+                    self.clock.seconds() - self.grace, 0, self.batch_size)
+                if keys:
+                    log.msg("Recovering %s overdue sessions" % (len(keys),))
+                    yield self.expire(keys)
+                if len(keys) < self.batch_size:
+                    break
+        except Exception:
+            log.err(None, "Failed to recover overdue sessions")
+
+    @inlineCallbacks
+    def expire(self, keys):
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            records = yield gatherResults([self.claim(key) for key in batch])
+            yield gatherResults([
+                maybeDeferred(self.expired, key, record).addErrback(
+                    log.err, "Failed to expire session %s" % (key,))
+                for key, record in zip(batch, records) if record is not None])
+
+    @inlineCallbacks
+    def claim(self, key):
+        """
+        Return the record of the session ``key`` if it has expired and
+        this worker removed it from Redis, or ``None``.
+        """
+        deadline = yield self.redis.zscore(self.DEADLINES_KEY, key)
+        if deadline is None:
+            returnValue(None)
+        if float(deadline) > self.clock.seconds():
+            self.wheel.schedule(key, float(deadline))
+            returnValue(None)
+        removed = yield self.redis.zrem(self.DEADLINES_KEY, key)
+        if not removed:
+            returnValue(None)
+        record = yield self.redis.hget(self.SESSIONS_KEY, key)
+        yield self.redis.hdel(self.SESSIONS_KEY, key)
+        returnValue(None if record is None else json.loads(record))
@@ -0,0 +1,162 @@
+# -*- test-case-name: vxapprouter.tests.test_health -*-
+from collections import OrderedDict, deque
+
+from vumi import log
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of messages sent to a single endpoint.
+
+    The circuit opens when at least ``minimum_requests`` outcomes were
+    recorded in the last ``window`` seconds and the fraction of failures
+    among them reaches ``failure_ratio``. An open circuit rejects
+    traffic for ``recovery_time`` seconds, after which a single probe
+    message is let through. The circuit closes again if the probe
+    succeeds and reopens if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, clock, window, failure_ratio, minimum_requests,
+                 recovery_time):
+        self.name = name
+        self.clock = clock
+        self.window = window
+        self.failure_ratio = failure_ratio
+        self.minimum_requests = minimum_requests
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.outcomes = deque()
+        self.failures = 0
+
+    def _trim(self, now):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            _, failed = self.outcomes.popleft()
+            self.failures -= failed
+
+    def _open(self, now):
+        log.warning("Circuit for endpoint '%s' opened." % (self.name,))
+        self.state = self.OPEN
+        self.opened_at = now
+        self.probing = False
+
+    def _close(self):
+        log.msg("Circuit for endpoint '%s' closed." % (self.name,))
+        self.state = self.CLOSED
+        self.probing = False
+        self.outcomes.clear()
+        self.failures = 0
+
+    def record(self, failed):
+        now = self.clock.seconds()
+        if self.state == self.HALF_OPEN:
+            if failed:
+                self._open(now)
+            else:
+                self._close()
+            return
+        if self.state == self.OPEN:
+            return
+        self.outcomes.append((now, int(failed)))
+        self.failures += int(failed)
+        self._trim(now)
+        if (len(self.outcomes) >= self.minimum_requests and
+                self.failures >= self.failure_ratio * len(self.outcomes)):
+            self._open(now)
+
+    def is_available(self):
+        if self.state == self.OPEN:
+            if self.clock.seconds() < self.opened_at + self.recovery_time:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            return not self.probing
+        return True
+
+    def request_sent(self):
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+
+class HealthMonitor(object):
+    """
+    Tracks the health of the endpoints messages are forwarded to.
+
+    Forwarded messages that do not get a reply within ``reply_timeout``
+    seconds count as failures, as do failed delivery events for the
+    endpoint's outbound messages. Each endpoint has its own
+    :class:`CircuitBreaker`.
+    """
+
+    def __init__(self, clock, reply_timeout=30, window=60, failure_ratio=0.5,
+                 minimum_requests=10, recovery_time=30,
+                 hide_unavailable=False):
+        self.clock = clock
+        self.reply_timeout = reply_timeout
+        self.window = window
+        self.failure_ratio = failure_ratio
+        self.minimum_requests = minimum_requests
+        self.recovery_time = recovery_time
+        self.hide_unavailable = hide_unavailable
+        self.circuits = {}
+        self.pending = OrderedDict()
+
+    @classmethod
+    def from_config(cls, clock, config):
+        return cls(clock, **config)
+
+    def circuit(self, endpoint):
+        circuit = self.circuits.get(endpoint)
+        if circuit is None:
+            circuit = self.circuits[endpoint] = CircuitBreaker(
+                endpoint, self.clock, self.window, self.failure_ratio,
+                self.minimum_requests, self.recovery_time)
+        return circuit
+
+    def expire_pending(self):
+        """
+        Count forwarded messages that have waited too long for a reply
+        as failures.
+        """
+        deadline = self.clock.seconds() - self.reply_timeout
+        while self.pending:
+            message_id, (endpoint, sent_at) = next(self.pending.iteritems())
+            if sent_at > deadline:
+                break
+            del self.pending[message_id]
+            self.circuit(endpoint).record(failed=True)
+
+    def message_forwarded(self, endpoint, message_id):
+        self.circuit(endpoint).request_sent()
+        self.pending[message_id] = (endpoint, self.clock.seconds())
+
+    def reply_received(self, message_id):
+        pending = self.pending.pop(message_id, None)
+        if pending is not None:
+            self.circuit(pending[0]).record(failed=False)
+
+    def event_received(self, endpoint, failed):
+        self.circuit(endpoint).record(failed)
+
+    def is_available(self, endpoint):
+        self.expire_pending()
+        return self.circuit(endpoint).is_available()
+
+    def unavailable_endpoints(self):
+        self.expire_pending()
+        return frozenset(
+            endpoint for endpoint, circuit in self.circuits.iteritems()
+            if not circuit.is_available())
+
+    def hidden_endpoints(self):
+        """
+        Endpoints that should be left out of menus.
+        """
+        if not self.hide_unavailable:
+            return frozenset()
+        return self.unavailable_endpoints()
@@ -0,0 +1,198 @@
+# -*- test-case-name: vxapprouter.tests.test_menu -*-
+import hashlib
+import json
+from collections import namedtuple
+from itertools import count
+
+
+MenuPage = namedtuple('MenuPage', ['page_id', 'title', 'labels', 'text'])
+Transition = namedtuple('Transition', ['action', 'target'])
+
+
+def mkmenu(options, start=1, format='%s) %s'):
+    items = [format % (idx, opt) for idx, opt in enumerate(options, start)]
+    return '\n'.join(items)
+
+
+def render_page(title, labels):
+    return title + "\n" + mkmenu(labels)
+
+
+class MenuPlan(object):
+    """
+    A menu compiled into pre-rendered pages and a transition table.
+
+    Pages are keyed by a short string id so that a session only needs
+    to store the id of the page the user is looking at. Transitions are
+    keyed by ``(page_id, choice)`` and are either a move to another page
+    or the selection of an endpoint. ``labels`` maps each endpoint to the
+    label of the first entry that selects it.
+
+    Plans are never modified after compilation and can be shared freely.
+    """
+
+    ROOT = '0'
+    PAGE = 'page'
+    ENDPOINT = 'endpoint'
+
+    def __init__(self, version, pages, transitions, endpoints, labels=None):
+        self.version = version
+        self.pages = pages
+        self.transitions = transitions
+        self.endpoints = endpoints
+        self.labels = labels or {}
+
+    @property
+    def root(self):
+        return self.pages[self.ROOT]
+
+    def page(self, page_id):
+        return self.pages.get(page_id)
+
+    def choose(self, page_id, choice):
+        return self.transitions.get((page_id, choice))
+
+    def page_path(self, page_id):
+        """
+        Return the labels chosen to reach ``page_id`` from the root page
+        by the shortest route, or ``None`` if it cannot be reached.
+        """
+        paths = {self.ROOT: ()}
+        queue = [self.ROOT]
+        for current in queue:
+            if current == page_id:
+                return paths[current]
+            for choice, label in enumerate(self.pages[current].labels, 1):
+                transition = self.choose(current, choice)
+                if (transition.action == self.PAGE and
+                        transition.target not in paths):
+                    paths[transition.target] = paths[current] + (label,)
+                    queue.append(transition.target)
+        return None
+
+    def follow_path(self, path):
+        """
+        Return the id of the page reached by choosing the entries labelled
+        ``path`` from the root page, or ``None`` if there is no such page.
+        """
+        page_id = self.ROOT
+        for label in path:
+            labels = self.pages[page_id].labels
+            if label not in labels:
+                return None
+            transition = self.choose(page_id, labels.index(label) + 1)
+            if transition.action != self.PAGE:
+                return None
+            page_id = transition.target
+        return page_id
+
+
+def menu_fingerprint(title, entries, max_length=None, more_label='More',
+                     back_label='Back', exclude=()):
+    """
+    Return a stable string identifying everything a compiled menu
+    depends on.
+    """
+    return json.dumps(
+        [title, entries, max_length, more_label, back_label,
+         sorted(exclude)],
+        sort_keys=True)
+
+
+def has_endpoints(entry, exclude=()):
+    if 'entries' in entry:
+        return any(has_endpoints(e, exclude) for e in entry['entries'])
+    return entry['endpoint'] not in exclude
+
+
+def paginate(title, entries, max_length, more_label, back_label,
+             first_has_back):
+    """
+    Split entries into chunks that each render within ``max_length``
+    characters, including the "more" and "back" options. Every chunk
+    holds at least one entry, even if that entry on its own is too long.
+    """
+    if not max_length or not entries:
+        return [entries]
+
+    def fits(chunk, more, back):
+        labels = [entry['label'] for entry in chunk]
+        if more:
+            labels.append(more_label)
+        if back:
+            labels.append(back_label)
+        return len(render_page(title, labels)) <= max_length
+
+    chunks = []
+    start = 0
+    while start < len(entries):
+        end = start + 1
+        back = first_has_back or bool(chunks)
+        while (end < len(entries) and
+               fits(entries[start:end + 1], end + 1 < len(entries), back)):
+            end += 1
+        chunks.append(entries[start:end])
+        start = end
+    return chunks
+
+
+def compile_menu(title, entries, max_length=None, more_label='More',
+                 back_label='Back', exclude=()):
+    """
+    Compile a list of menu entries into a :class:`MenuPlan`.
+
+    An entry is either ``{'label': ..., 'endpoint': ...}`` or a sub-menu
+    ``{'label': ..., 'entries': [...]}`` with an optional ``title``.
+    Pages that do not fit in ``max_length`` characters are split and
+    linked with a "more" option. Pages other than the first root page
+    get a "back" option that returns to the previous page. Endpoints in
+    ``exclude`` are left out, as are sub-menus that end up empty.
+    """
+    fingerprint = menu_fingerprint(
+        title, entries, max_length, more_label, back_label, exclude)
+    version = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:8]
+    page_ids = (str(i) for i in count())
+    pages = {}
+    transitions = {}
+    endpoints = set()
+    endpoint_labels = {}
+
+    def add_node(node_title, node_entries, back_to):
+        node_entries = [
+            entry for entry in node_entries if has_endpoints(entry, exclude)]
+        chunks = paginate(
+            node_title, node_entries, max_length, more_label, back_label,
+            back_to is not None)
+        chunk_ids = [next(page_ids) for _ in chunks]
+        for index, (chunk, page_id) in enumerate(zip(chunks, chunk_ids)):
+            labels = []
+            for entry in chunk:
+                labels.append(entry['label'])
+                if 'entries' in entry:
+                    transition = Transition(MenuPlan.PAGE, add_node(
+                        entry.get('title', entry['label']),
+                        entry['entries'], page_id))
+                else:
+                    transition = Transition(
+                        MenuPlan.ENDPOINT, entry['endpoint'])
+                    endpoints.add(entry['endpoint'])
+                    endpoint_labels.setdefault(
+                        entry['endpoint'], entry['label'])
+                transitions[(page_id, len(labels))] = transition
+            if index + 1 < len(chunk_ids):
+                labels.append(more_label)
+                transitions[(page_id, len(labels))] = Transition(
+                    MenuPlan.PAGE, chunk_ids[index + 1])
+            previous = chunk_ids[index - 1] if index else back_to
+            if previous is not None:
+                labels.append(back_label)
+                transitions[(page_id, len(labels))] = Transition(
+                    MenuPlan.PAGE, previous)
+            pages[page_id] = MenuPage(
+                page_id, node_title, tuple(labels),
+                render_page(node_title, labels))
+        return chunk_ids[0]
+
+    add_node(title, entries, None)
+    return MenuPlan(
+        version, pages, transitions, frozenset(endpoints), endpoint_labels)
@@ -0,0 +1,259 @@
+# -*- test-case-name: vxapprouter.tests.test_migrate -*-
+"""
+Move the sessions of an ApplicationDispatcher to new endpoints in bulk.
+
+When an endpoint is renamed or removed, users with a session on it are
+otherwise told about it one message at a time, with the error message.
+This rewrites their ``active_endpoint`` instead, or removes the session
+so that they get the menu the next time.
+
+Usage: python -m vxapprouter.migrate <config-file.yaml> old=new [old= ...]
+"""
+import json
+import sys
+import time
+
+import yaml
+from twisted.internet.defer import gatherResults, inlineCallbacks, succeed
+from twisted.internet.task import deferLater, react
+from twisted.python import usage
+
+from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.txredis_manager import TxRedisManager
+
+from vxapprouter.expiry import SessionExpiry, expiry_key
+from vxapprouter.router import ApplicationDispatcher
+
+
+MOVE_SESSION_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'active_endpoint') ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+    if ARGV[3] ~= '' then
+        redis.call('HDEL', KEYS[2], ARGV[3])
+        redis.call('ZREM', KEYS[3], ARGV[3])
+    end
+    return 1
+end
+redis.call('HSET', KEYS[1], 'active_endpoint', ARGV[2])
+if ARGV[3] ~= '' then
+    local record = redis.call('HGET', KEYS[2], ARGV[3])
+    if record then
+        record = cjson.decode(record)
+        if record['endpoint'] == ARGV[1] then
+            record['endpoint'] = ARGV[2]
+            redis.call('HSET', KEYS[2], ARGV[3], cjson.encode(record))
+        end
+    end
+end
+return 1
+"""
+
+
+def move_session(redis, key, old, new, expiry=None, expiry_field=None):
+    """
+    Set the ``active_endpoint`` of the session ``key`` to ``new``, or
+    remove the session if ``new`` is ``None``, if it is still ``old``.
+    Returns a deferred that fires with ``True`` if the session was
+    changed.
+
+    If ``expiry`` is given, the record :class:`SessionExpiry` keeps for
+    the session under ``expiry_field`` in it is moved to ``new`` too, or
+    removed along with the session.
+
+    The check and the change are made by a single script, so a session
+    that ended or moved in the meantime is left alone, and a session that
+    is changed keeps its expiry.
+    """
+    key = redis._key(key)
+    sessions_key = deadlines_key = ''
+    if expiry is None:
+        expiry_field = None
+    else:
+        sessions_key = expiry._key(SessionExpiry.SESSIONS_KEY)
+        deadlines_key = expiry._key(SessionExpiry.DEADLINES_KEY)
+    client = redis._client
+    if isinstance(client, FakeRedis):
+        # FakeRedis has no scripting, but runs each command right away,
+        # so nothing can come between these.
+        if FakeRedis.hget.sync(client, key, 'active_endpoint') != old:
+            return succeed(False)
+        if new is None:
+            FakeRedis.delete.sync(client, key)
+        else:
+            FakeRedis.hset.sync(client, key, 'active_endpoint', new)
+        if expiry_field is None:
+            return succeed(True)
+        record = FakeRedis.hget.sync(client, sessions_key, expiry_field)
+        if new is None:
+            FakeRedis.hdel.sync(client, sessions_key, expiry_field)
+            FakeRedis.zrem.sync(client, deadlines_key, expiry_field)
+        elif record is not None:
+            record = json.loads(record)
+            if record['endpoint'] == old:
+                record['endpoint'] = new
+                FakeRedis.hset.sync(
+                    client, sessions_key, expiry_field, json.dumps(record))
+        return succeed(True)
+    d = client.eval(
+        MOVE_SESSION_SCRIPT, [key, sessions_key, deadlines_key],
+        [old, new or '', expiry_field or ''])
+    return d.addCallback(bool)
+
+
+class SessionMigrator(object):
+    """
+    Rewrites the ``active_endpoint`` of sessions according to ``mapping``.
+    Sessions on an endpoint mapped to ``None`` are removed.
+
+    Session keys are found with SCAN, ``batch_size`` at a time, and the
+    sessions in a batch are read and written with concurrent requests,
+    which are pipelined on the Redis connection. Sessions are only
+    changed if they are still on the endpoint they were read with, see
+    :func:`move_session`, and only those are counted. At most ``max_rate``
+    sessions are processed per second, if it is set, so that live traffic
+    is not starved.
+
+    If ``expiry`` is given, it is the Redis manager of the dispatcher's
+    :class:`SessionExpiry`, and the records it keeps for the sessions of
+    ``tenant`` are changed along with them.
+    """
+
+    def __init__(self, clock, redis, mapping, batch_size=100, max_rate=None,
+                 dry_run=False, progress=None, expiry=None, tenant=None):
+        self.clock = clock
+        self.redis = redis
+        self.mapping = mapping
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.dry_run = dry_run
+        self.progress = progress or (lambda migrator: None)
+        self.expiry = expiry
+        self.tenant = tenant
+        self.scanned = 0
+        self.migrated = 0
+        self.removed = 0
+
+    @inlineCallbacks
+    def run(self):
+        started = self.clock.seconds()
+        cursor = None
+        while True:
+            cursor, keys = yield self.redis.scan(
+                cursor, match='session:*', count=self.batch_size)
+            yield self.migrate_batch(keys)
+            self.progress(self)
+            if cursor is None or cursor == '0':
+                break
+            if self.max_rate:
+                delay = (started + self.scanned / float(self.max_rate) -
+                         self.clock.seconds())
+                if delay > 0:
+                    yield deferLater(self.clock, delay, lambda: None)
+
+    @inlineCallbacks
+    def migrate_batch(self, keys):
+        sessions = yield gatherResults(
+            [self.redis.hgetall(key) for key in keys])
+        moves = []
+        for key, session in zip(keys, sessions):
+            endpoint = session.get('active_endpoint')
+            if endpoint in self.mapping:
+                moves.append((key, endpoint, self.mapping[endpoint]))
+        if self.dry_run:
+            moved = [True] * len(moves)
+        else:
+            moved = yield gatherResults([
+                move_session(
+                    self.redis, key, old, new, self.expiry,
+                    expiry_key(self.tenant, key[len('session:'):]))
+                for key, old, new in moves])
+        for (key, old, new), changed in zip(moves, moved):
+            if not changed:
+                continue
+            if new is None:
+                self.removed += 1
+            else:
+                self.migrated += 1
+        self.scanned += len(keys)
+
+
+class Options(usage.Options):
+
+    synopsis = "<config-file.yaml> <old-endpoint>=[<new-endpoint>] ..."
+
+    longdesc = """
+    Move ApplicationDispatcher sessions from old endpoints to new ones. A
+    mapping with no new endpoint removes the sessions on the old one.
+    Partitioned workers cache the sessions of their users, so restart them
+    after a migration.
+    """
+
+    optParameters = [
+        ["tenant", "t", None, "Migrate the sessions of this tenant."],
+        ["batch-size", "b", "100", "The number of keys to scan at a time."],
+        ["max-rate", "r", "1000",
+         "The maximum number of sessions to process per second, or 0 for no "
+         "limit."],
+    ]
+
+    optFlags = [
+        ["dry-run", "n", "Count the sessions, but do not change them."],
+    ]
+
+    def parseArgs(self, config_file, *mappings):
+        if not mappings:
+            raise usage.UsageError("Please specify an endpoint mapping.")
+        with open(config_file) as f:
+            self['config'] = yaml.safe_load(f)
+        self['mapping'] = {}
+        for mapping in mappings:
+            if '=' not in mapping:
+                raise usage.UsageError("Invalid mapping: %r" % (mapping,))
+            old, new = mapping.split('=', 1)
+            self['mapping'][old] = new or None
+
+    def postOptions(self):
+        self['batch-size'] = int(self['batch-size'])
+        self['max-rate'] = int(self['max-rate'])
+
+
+def emit_progress(migrator):
+    print "%s sessions scanned, %s migrated, %s removed." % (
+        migrator.scanned, migrator.migrated, migrator.removed)
+
+
+@inlineCallbacks
+def main(reactor, options):
+    manager = yield TxRedisManager.from_config(
+        options['config'].get('redis_manager', {}))
+    redis = manager.sub_manager(ApplicationDispatcher.worker_name)
+    expiry = None
+    if options['config'].get('session_close_on_expiry'):
+        expiry = redis.sub_manager('expiry')
+    if options['tenant'] is not None:
+        redis = redis.sub_manager('tenants').sub_manager(options['tenant'])
+    migrator = SessionMigrator(
+        reactor, redis, options['mapping'], options['batch-size'],
+        options['max-rate'], options['dry-run'], emit_progress, expiry,
+        options['tenant'])
+    started = time.time()
+    try:
+        yield migrator.run()
+    finally:
+        yield manager.close_manager()
+    print "Done in %.1fs." % (time.time() - started,)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    react(main, [options])
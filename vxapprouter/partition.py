@@ -0,0 +1,225 @@
+# -*- test-case-name: vxapprouter.tests.test_partition -*-
+import math
+import zlib
+from collections import OrderedDict
+
+from twisted.internet.defer import (
+    DeferredList, DeferredLock, gatherResults, inlineCallbacks, returnValue)
+
+from vumi.config import ConfigList
+from vumi.dispatchers.endpoint_dispatchers import Dispatcher
+
+
+def partition_for(user_id, count):
+    """
+    Return the partition in ``range(count)`` that owns ``user_id``.
+    """
+    if isinstance(user_id, unicode):
+        user_id = user_id.encode('utf-8')
+    return (zlib.crc32(user_id or '') & 0xffffffff) % count
+
+
+class PartitionDispatcherConfig(Dispatcher.CONFIG_CLASS):
+    partition_connectors = ConfigList(
+        ("Connectors to the ApplicationDispatcher partitions, in partition "
+         "order. These must also be listed as receive_outbound_connectors."),
+        required=True, static=True)
+
+
+class PartitionDispatcher(Dispatcher):
+    """
+    Front-end that spreads users across partitioned ApplicationDispatchers.
+
+    Inbound messages are forwarded to the partition that owns their
+    ``from_addr``, so all of a user's messages are handled by the same
+    process. Events do not name the user, but any partition can handle
+    them, so they are spread by ``user_message_id``. Outbound messages from
+    the partitions go back to the inbound connector named by their
+    ``transport_name``, or to the first inbound connector.
+    """
+
+    CONFIG_CLASS = PartitionDispatcherConfig
+    worker_name = 'partition_dispatcher'
+
+    def setup_dispatcher(self):
+        self.partitions = self.get_static_config().partition_connectors
+
+    def partition_connector(self, key):
+        return self.partitions[partition_for(key, len(self.partitions))]
+
+    def process_inbound(self, config, msg, connector_name):
+        return self.publish_inbound(
+            msg, self.partition_connector(msg['from_addr']),
+            msg.get_routing_endpoint())
+
+    def process_event(self, config, event, connector_name):
+        return self.publish_event(
+            event, self.partition_connector(event['user_message_id']),
+            event.get_routing_endpoint())
+
+    def process_outbound(self, config, msg, connector_name):
+        connectors = self.get_configured_ri_connectors()
+        target = msg['transport_name']
+        if target not in connectors:
+            target = connectors[0]
+        return self.publish_outbound(
+            msg, target, msg.get_routing_endpoint())
+
+
+class LocalSessionCache(object):
+    """
+    An in-memory cache of up to ``size`` sessions, in front of a
+    SessionManager.
+
+    This is only safe for users whose messages are all handled by this
+    process; ``owns`` is called with a user id to check that. Sessions of
+    other users are always read from Redis.
+    """
+
+    def __init__(self, clock, size=10000, owns=None):
+        self.clock = clock
+        self.size = size
+        self.owns = owns or (lambda user_id: True)
+        self.sessions = OrderedDict()
+
+    def get(self, user_id):
+        entry = self.sessions.pop(user_id, None)
+        if entry is None:
+            return None
+        expires_at, session = entry
+        if expires_at is not None and self.clock.seconds() >= expires_at:
+            return None
+        self.sessions[user_id] = entry
+        return dict(session)
+
+    def put(self, user_id, session, expires_at=None):
+        self.sessions.pop(user_id, None)
+        self.sessions[user_id] = (expires_at, dict(session))
+        if len(self.sessions) > self.size:
+            self.sessions.popitem(last=False)
+
+    def expires_at(self, user_id):
+        entry = self.sessions.get(user_id)
+        return entry[0] if entry is not None else None
+
+    def discard(self, user_id):
+        self.sessions.pop(user_id, None)
+
+    def wrap(self, session_manager):
+        return CachedSessionManager(self, session_manager)
+
+
+class CachedSessionManager(object):
+    """
+    A SessionManager that reads sessions from a :class:`LocalSessionCache`
+    and writes them through to Redis.
+
+    Other partitions may still clear a session, when an application they
+    received a reply from closes it. Writing through a cached session
+    therefore also resets its expiry to the time it has left. If that
+    finds the session gone, the fields that were just written are removed
+    and the session is dropped from the cache, so a cleared session is
+    never brought back as a partial hash without an expiry.
+    """
+
+    def __init__(self, cache, session_manager):
+        self.cache = cache
+        self.session_manager = session_manager
+
+    @inlineCallbacks
+    def load_session(self, user_id):
+        if not self.cache.owns(user_id):
+            returnValue((yield self.session_manager.load_session(user_id)))
+        session = self.cache.get(user_id)
+        if session is not None:
+            returnValue(session)
+        session, ttl = yield gatherResults([
+            self.session_manager.load_session(user_id),
+            self.session_manager.redis.ttl('session:%s' % (user_id,)),
+        ])
+        expires_at = None
+        if ttl is not None and ttl >= 0:
+            expires_at = self.cache.clock.seconds() + ttl
+        self.cache.put(user_id, session, expires_at)
+        returnValue(session)
+
+    @inlineCallbacks
+    def create_session(self, user_id, **kwargs):
+        session = yield self.session_manager.create_session(
+            user_id, **kwargs)
+        if self.cache.owns(user_id):
+            expires_at = None
+            timeout = self.session_manager.max_session_length
+            if timeout:
+                expires_at = self.cache.clock.seconds() + int(timeout)
+            self.cache.put(user_id, session, expires_at)
+        returnValue(session)
+
+    @inlineCallbacks
+    def save_session(self, user_id, session):
+        cached = self.cache.get(user_id)
+        expires_at = self.cache.expires_at(user_id)
+        ds = []
+        if cached is not None and expires_at is not None:
+            # Sent before the fields, on the same connection, so that it
+            # sees whether the session still exists.
+            ttl = int(math.ceil(expires_at - self.cache.clock.seconds()))
+            ds.append(self.session_manager.schedule_session_expiry(
+                user_id, max(1, ttl)))
+        ds.append(self.session_manager.save_session(user_id, session))
+        results = yield DeferredList(ds, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                self.cache.discard(user_id)
+                result.raiseException()
+        if len(results) > 1 and not results[0][1]:
+            self.cache.discard(user_id)
+            yield self.session_manager.clear_session(user_id)
+            returnValue(session)
+        if cached is None:
+            self.cache.discard(user_id)
+        else:
+            # Redis stores hash values as strings.
+            cached.update(
+                (k, v if isinstance(v, basestring) else str(v))
+                for k, v in session.items())
+            self.cache.put(user_id, cached, self.cache.expires_at(user_id))
+        returnValue(session)
+
+    @inlineCallbacks
+    def clear_session(self, user_id):
+        self.cache.discard(user_id)
+        result = yield self.session_manager.clear_session(user_id)
+        returnValue(result)
+
+    def schedule_session_expiry(self, user_id, timeout):
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            self.cache.put(
+                user_id, cached, self.cache.clock.seconds() + timeout)
+        return self.session_manager.schedule_session_expiry(user_id, timeout)
+
+
+class UserSerializer(object):
+    """
+    Runs the work for each user one call at a time, in the order it was
+    submitted, while work for different users runs concurrently.
+    """
+
+    def __init__(self):
+        self.locks = {}
+
+    def __len__(self):
+        return len(self.locks)
+
+    def run(self, user_id, func, *args, **kw):
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = DeferredLock()
+        return lock.run(func, *args, **kw).addBoth(
+            self._release, user_id, lock)
+
+    def _release(self, result, user_id, lock):
+        if not lock.locked and self.locks.get(user_id) is lock:
+            del self.locks[user_id]
+        return result
@@ -0,0 +1,85 @@
+# -*- test-case-name: vxapprouter.tests.test_preferences -*-
+import zlib
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+
+class PreferenceStore(object):
+    """
+    Remembers the endpoint each user last selected, for longer than their
+    sessions last.
+
+    Users are spread over ``buckets`` Redis hashes by a hash of their
+    user id, and each user's field holds a small integer index instead of
+    the endpoint's name. Redis keeps hashes with fewer than
+    ``hash-max-ziplist-entries`` fields (128 by default) in a compact
+    encoding, so ``buckets`` should be at least the number of users
+    divided by that. A bucket expires ``ttl`` seconds after a user in it
+    last selected an endpoint.
+
+    Endpoint indexes are assigned the first time an endpoint is
+    remembered and stored in Redis, so that every worker sharing it maps
+    them the same way.
+    """
+
+    ENDPOINTS_KEY = 'endpoints'
+    NEXT_INDEX_KEY = 'next_index'
+
+    def __init__(self, redis, buckets=1024, ttl=90 * 24 * 3600):
+        self.redis = redis
+        self.buckets = buckets
+        self.ttl = ttl
+        self.indexes = {}
+        self.endpoints = {}
+
+    @classmethod
+    def from_config(cls, redis, config):
+        config = dict(config)
+        config.pop('mode', None)
+        return cls(redis, **config)
+
+    def bucket_key(self, user_id):
+        bucket = (zlib.crc32(user_id.encode('utf-8')) & 0xffffffff) % (
+            self.buckets)
+        return 'last:%s' % (bucket,)
+
+    @inlineCallbacks
+    def load_endpoints(self):
+        stored = yield self.redis.hgetall(self.ENDPOINTS_KEY)
+        self.indexes = dict(
+            (endpoint, int(index)) for endpoint, index in stored.items())
+        self.endpoints = dict(
+            (index, endpoint) for endpoint, index in self.indexes.items())
+
+    @inlineCallbacks
+    def endpoint_index(self, endpoint):
+        if endpoint not in self.indexes:
+            index = yield self.redis.incr(self.NEXT_INDEX_KEY)
+            # Another worker may have assigned an index first, in which
+            # case this one is left unused.
+            yield self.redis.hsetnx(self.ENDPOINTS_KEY, endpoint, index)
+            yield self.load_endpoints()
+        returnValue(self.indexes[endpoint])
+
+    @inlineCallbacks
+    def get(self, user_id):
+        """
+        Return the endpoint ``user_id`` last selected, or ``None``.
+        """
+        index = yield self.redis.hget(self.bucket_key(user_id), user_id)
+        if index is None:
+            returnValue(None)
+        index = int(index)
+        if index not in self.endpoints:
+            yield self.load_endpoints()
+        returnValue(self.endpoints.get(index))
+
+    @inlineCallbacks
+    def remember(self, user_id, endpoint):
+        """
+        Remember that ``user_id`` selected ``endpoint``.
+        """
+        index = yield self.endpoint_index(endpoint)
+        key = self.bucket_key(user_id)
+        yield self.redis.hset(key, user_id, index)
+        yield self.redis.expire(key, self.ttl)
@@ -0,0 +1,112 @@
+# -*- test-case-name: vxapprouter.tests.test_profiling -*-
+import os
+import signal
+from collections import Counter, deque
+
+from vumi import log
+
+
+def collapse(frame):
+    """
+    Return the stack ending in ``frame`` as a line of semicolon separated
+    function names, outermost first, as used by flamegraph.pl.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%s)' % (
+            code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    """
+    Samples the Python stack every ``interval`` seconds of CPU time.
+
+    Sampling is driven by SIGPROF, so the process is only interrupted
+    while it is using CPU and the cost is one stack walk per sample.
+    Samples are counted per collapsed stack.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = False
+        self._previous_handler = None
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks = Counter()
+        self._previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        """
+        Stop sampling and return the sample counts.
+        """
+        if self.running:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(
+                signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+            self.running = False
+        return self.stacks
+
+    def sample(self, signum, frame):
+        self.stacks[collapse(frame)] += 1
+
+    def dump(self, path):
+        """
+        Write the samples to ``path`` in the collapsed stack format read by
+        flamegraph.pl and speedscope.
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %s\n' % (stack, count))
+
+
+class StageTimer(object):
+    """
+    Records how long each stage of processing a message takes. Each call
+    to :meth:`mark` ends a stage.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.started = self.last = clock.seconds()
+        self.stages = []
+
+    def mark(self, stage):
+        now = self.clock.seconds()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.started
+
+
+class SlowMessageLog(object):
+    """
+    Logs the stage breakdown of messages that take ``threshold`` seconds
+    or longer, and keeps the last ``size`` of them.
+    """
+
+    def __init__(self, clock, threshold, size=100):
+        self.clock = clock
+        self.threshold = threshold
+        self.messages = deque(maxlen=size)
+
+    def timer(self):
+        return StageTimer(self.clock)
+
+    def record(self, msg, timer):
+        if timer.total < self.threshold:
+            return
+        self.messages.append((msg['message_id'], timer.total, timer.stages))
+        log.warning("Slow message %s took %.3fs (%s)" % (
+            msg['message_id'], timer.total, ', '.join(
+                '%s: %.3fs' % stage for stage in timer.stages)))
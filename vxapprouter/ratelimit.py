@@ -0,0 +1,160 @@
+# -*- test-case-name: vxapprouter.tests.test_ratelimit -*-
+import math
+from collections import deque
+
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, maybeDeferred, returnValue, succeed)
+from twisted.python.failure import Failure
+
+
+class TokenBucket(object):
+    """
+    A token bucket holding up to ``burst`` tokens and refilled at
+    ``rate`` tokens per second.
+    """
+
+    def __init__(self, clock, rate, burst):
+        self.clock = clock
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        """
+        Seconds until the next token is available.
+        """
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of messages sent to a single target.
+
+    Messages that find the bucket empty wait in a queue of at most
+    ``queue_size`` messages and are released in order as tokens become
+    available. Messages that find the queue full are rejected.
+
+    If ``redis`` is given, every worker sharing it also counts messages
+    in per-second windows, and no more than ``rate`` (rounded up)
+    messages per second are allowed across all of them.
+
+    ``on_throttled`` is called with ``'queued'`` or ``'rejected'`` when a
+    message has to wait or is turned away. If counting a message in Redis
+    fails, the messages waiting in the queue fail with the error, as the
+    message being acquired would have.
+    """
+
+    SHARED_WINDOW_TTL = 5
+
+    def __init__(self, name, clock, rate, burst=None, queue_size=0,
+                 redis=None, on_throttled=None):
+        self.name = name
+        self.clock = clock
+        self.rate = rate
+        self.bucket = TokenBucket(clock, rate, burst or max(1, rate))
+        self.queue_size = queue_size
+        self.redis = redis
+        self.on_throttled = on_throttled or (lambda outcome: None)
+        self.waiting = deque()
+        self._delayed = None
+        self._releasing = False
+        self._retry_at = 0
+
+    @inlineCallbacks
+    def _take(self):
+        now = self.clock.seconds()
+        if now < self._retry_at or not self.bucket.consume():
+            returnValue(False)
+        if self.redis is None:
+            returnValue(True)
+        window = int(now)
+        key = '%s:%s' % (self.name, window)
+        count = yield self.redis.incr(key)
+        if count == 1:
+            yield self.redis.expire(key, self.SHARED_WINDOW_TTL)
+        if count > math.ceil(self.rate):
+            self._retry_at = window + 1
+            returnValue(False)
+        returnValue(True)
+
+    def acquire(self, max_wait=None):
+        """
+        Return a deferred that fires with ``True`` once the message may be
+        sent, or with ``False`` if it was rejected. Messages that would
+        have to wait longer than ``max_wait`` seconds are rejected straight
+        away. Cancelling the deferred takes the message out of the queue.
+        """
+        if self.waiting:
+            d = succeed(False)
+        else:
+            d = maybeDeferred(self._take)
+        return d.addCallback(self._acquired, max_wait)
+
+    def _acquired(self, taken, max_wait):
+        if taken:
+            return True
+        if (len(self.waiting) >= self.queue_size or
+                (max_wait is not None and self.expected_wait() > max_wait)):
+            self.on_throttled('rejected')
+            return False
+        self.on_throttled('queued')
+        d = Deferred(self.waiting.remove)
+        self.waiting.append(d)
+        self._schedule()
+        return d
+
+    def expected_wait(self):
+        """
+        Seconds until a message joining the queue now would be released.
+        """
+        return (
+            max(self.bucket.delay(), self._retry_at - self.clock.seconds()) +
+            len(self.waiting) / self.bucket.rate)
+
+    def _schedule(self):
+        if self._delayed is not None or self._releasing:
+            return
+        delay = max(
+            self.bucket.delay(), self._retry_at - self.clock.seconds())
+        self._delayed = self.clock.callLater(delay, self._release)
+
+    @inlineCallbacks
+    def _release(self):
+        self._delayed = None
+        self._releasing = True
+        try:
+            while self.waiting and (yield self._take()):
+                self.waiting.popleft().callback(True)
+        except Exception:
+            failure = Failure()
+            while self.waiting:
+                self.waiting.popleft().errback(failure)
+        finally:
+            self._releasing = False
+        if self.waiting:
+            self._schedule()
+
+    def stop(self):
+        """
+        Stop releasing messages and reject everything still waiting.
+        """
+        if self._delayed is not None:
+            self._delayed.cancel()
+            self._delayed = None
+        while self.waiting:
+            self.waiting.popleft().callback(False)
@@ -0,0 +1,15 @@
+# -*- test-case-name: vxapprouter.tests.test_redisutils -*-
+"""
+Redis commands that vumi's Redis managers and txredis have no methods for.
+"""
+
+
+def send_command(client, *args):
+    """
+    Send the command ``args`` on ``client``, a txredis client, and return a
+    deferred that fires with the reply.
+    """
+    # txredis sends the commands it has methods for like this, and replies
+    # come back in the order the commands were sent.
+    client._send(*args)
+    return client.getResponse()
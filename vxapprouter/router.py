@@ -1,17 +1,50 @@
 # -*- test-case-name: vxapprouter.tests.test_router -*-
 import json
+import math
+import os
+import signal
+import time
+from collections import OrderedDict
 from urlparse import urlunparse
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, DeferredList, gatherResults, inlineCallbacks, maybeDeferred,
+    returnValue, succeed)
+from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.blinkenlights.metrics import AVG, MAX, Count, Metric, MetricManager
 from vumi.components.session import SessionManager
 from vumi.config import (
-    ConfigDict, ConfigList, ConfigInt, ConfigText, ConfigUrl)
+    ConfigDict, ConfigError, ConfigFloat, ConfigList, ConfigInt, ConfigText,
+    ConfigUrl)
 from vumi.dispatchers.endpoint_dispatchers import Dispatcher
 from vumi.message import TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
 
+from vxapprouter.admission import AdmissionController
+from vxapprouter.analytics import RoutingAnalytics
+from vxapprouter.batch import Batcher
+# StateResponse, clean and mkmenu used to be defined in this module and
+# are still imported from it.
+from vxapprouter.core import StateMachine, StateResponse, clean  # noqa
+from vxapprouter.deadline import Deadline, DeadlineExceeded
+from vxapprouter.dedup import Deduplicator
+from vxapprouter.expiry import SessionExpiry, expiry_key
+from vxapprouter.health import HealthMonitor
+from vxapprouter.menu import mkmenu  # noqa
+from vxapprouter.partition import (
+    LocalSessionCache, UserSerializer, partition_for)
+from vxapprouter.preferences import PreferenceStore
+from vxapprouter.profiling import SamplingProfiler, SlowMessageLog
+from vxapprouter.ratelimit import RateLimiter
+from vxapprouter.shadow import ShadowEvaluator
+from vxapprouter.snapshot import ConfigSnapshot
+from vxapprouter.tenants import TenantRegistry
+from vxapprouter.tracing import HopTracer
+from vxapprouter.window import ConcurrencyWindow
+
 
 class ApplicationDispatcherConfig(Dispatcher.CONFIG_CLASS):
 
@@ -24,14 +57,199 @@ class ApplicationDispatcherConfig(Dispatcher.CONFIG_CLASS):
         ("Maximum amount of time in seconds to keep message data around. "
          "This is kept to handle async events. Defaults to 2 days."),
         default=60 * 60 * 24 * 2, static=True)
+    session_state_expiry = ConfigDict(
+        ("Time in seconds to keep sessions in particular states, keyed by "
+         "state ('start', 'select', 'bad_input', 'continue' or 'selected'). "
+         "The expiry is reset every time a session is saved in one of "
+         "these states, so menu sessions that are abandoned can be dropped "
+         "sooner than sessions with an application. Sessions that move to "
+         "any other state get back what is left of the 'session_expiry' "
+         "they were created with."),
+        default={}, static=True)
     redis_manager = ConfigDict(
         "Redis client configuration.", default={}, static=True)
+    circuit_breaker = ConfigDict(
+        ("Per-endpoint circuit breaker configuration. Disabled if empty. "
+         "Forwarded messages without a reply after 'reply_timeout' seconds "
+         "(default 30) and failed delivery events count as failures. An "
+         "endpoint's circuit opens when at least 'minimum_requests' "
+         "(default 10) outcomes in the last 'window' seconds (default 60) "
+         "include a 'failure_ratio' (default 0.5) of failures, and it is "
+         "retried after 'recovery_time' seconds (default 30). Set "
+         "'hide_unavailable' to leave open endpoints out of the menu."),
+        default={}, static=True)
+    metrics_prefix = ConfigText(
+        "Prefix for the names of metrics published by the dispatcher.",
+        default="vxapprouter.", static=True)
+    rate_limits = ConfigDict(
+        ("Token bucket rate limits for messages forwarded to applications. "
+         "Keys are target connector names, values are dicts mapping target "
+         "endpoint names to limits. A limit allows 'rate' messages per "
+         "second with bursts of up to 'burst' messages (default: rate). Up "
+         "to 'queue_size' messages (default 0) wait for capacity and any "
+         "more get the busy message. Waiting messages hold their slot in "
+         "the concurrency window, so they only wait if "
+         "'max_concurrent_messages' is larger than 1, and messages that "
+         "would wait past their deadline get the busy message straight "
+         "away. If 'shared' is true, the rate is also enforced across all "
+         "workers sharing the same Redis."),
+        default={}, static=True)
+    load_shedding = ConfigDict(
+        ("Load shedding configuration. New sessions are answered with the "
+         "busy message, without touching Redis, while at least "
+         "'max_in_flight' inbound messages are being processed or while "
+         "the moving average of Redis latency exceeds 'max_redis_latency' "
+         "seconds. Latency samples older than 'latency_window' seconds "
+         "(default 10) are disregarded. Only one message is processed at a "
+         "time unless 'max_concurrent_messages' is larger than 1, so "
+         "'max_in_flight' is ignored otherwise. Disabled if empty."),
+        default={}, static=True)
+    deadlines = ConfigDict(
+        ("Time budget for the Redis calls made while routing a message. "
+         "Calls still pending after 'timeout' seconds from the arrival of "
+         "the message are cancelled; set this below the transport's "
+         "session timeout. The outcome for a message that runs out of "
+         "time depends on its stage: 'inbound' may be 'error' (default) "
+         "to send the error message, 'drop', or 'route' to forward it to "
+         "the user's last known endpoint. 'outbound' may be 'route' "
+         "(default) to publish it anyway or 'drop'. Events are dropped. "
+         "Disabled if empty."),
+        default={}, static=True)
+    deduplication = ConfigDict(
+        ("Drop inbound messages with a message_id seen in the last 'ttl' "
+         "seconds (default 60). Ids are recorded in Redis, with one SET "
+         "NX EX per message, so that retransmissions handled by other "
+         "workers are detected too. If 'shared' is false, they are only "
+         "remembered in memory, up to 'capacity' ids (default 100000) at "
+         "a time. If 'approximate' is also true, they are kept in Bloom "
+         "filters, which take much less memory but drop a fraction "
+         "'error_rate' (default 0.001) of messages that are not "
+         "duplicates. These drops are counted in "
+         "'dedup.duplicates.approximate'. Disabled if empty."),
+        default={}, static=True)
+    tenancy = ConfigDict(
+        ("Multi-tenant mode. 'tenants' maps tenant names to router configs "
+         "(such as 'menu_title', 'entries' and 'routing_table') that "
+         "override this config for messages to or from any of the "
+         "tenant's 'to_addrs', or else from any of its 'transport_names'. "
+         "Each tenant's sessions are stored separately. More tenants can "
+         "be stored as JSON in the 'tenants:registry' Redis hash; every "
+         "worker reloads them every 'refresh_interval' seconds (default "
+         "30). Connectors used in tenants' routing tables must still be "
+         "listed in this config. Disabled if empty."),
+        default={}, static=True)
+    partition = ConfigDict(
+        ("Partitioned mode, for running 'count' workers behind a "
+         "PartitionDispatcher. This worker owns the users whose address "
+         "hashes to partition 'index'. Inbound messages from the same "
+         "user are processed one at a time, in order, and the sessions "
+         "of up to 'session_cache_size' (default 10000) owned users are "
+         "cached in memory. Disabled if empty."),
+        default={}, static=True)
+    batching = ConfigDict(
+        ("Process inbound messages in batches of up to 'max_size' messages "
+         "(default 50), collected for at most 'max_delay' seconds (default "
+         "0.01). The sessions for a batch are loaded together and its "
+         "messages are decided together, which saves Redis round trips "
+         "under bursty load. Batches are processed one at a time, so each "
+         "user's messages are processed in order. State handlers must be "
+         "synchronous. The consumer waits for each message before it "
+         "delivers the next one, so batching requires "
+         "'max_concurrent_messages' to be more than 1. Disabled if "
+         "empty."),
+        default={}, static=True)
+    max_concurrent_messages = ConfigInt(
+        ("The number of messages to process at the same time. By default, "
+         "messages from each connector are processed one at a time. Each "
+         "user's inbound messages are still processed in order. "
+         "'amqp_prefetch_count' should be at least as large as this."),
+        default=1, static=True)
+    drain_timeout = ConfigFloat(
+        ("Maximum amount of time in seconds to wait for in-flight messages "
+         "to be processed when shutting down. Defaults to 10 seconds."),
+        default=10, static=True)
+    tracing = ConfigDict(
+        ("Hop tracing. A 'sample_rate' fraction (default 0.01) of inbound "
+         "messages get a 'trace' in their helper_metadata with the times "
+         "they reached and left the router, as do the replies to them. The "
+         "round trip time and the time spent in the router are published "
+         "as 'tracing.<connector>.<endpoint>.round_trip' and "
+         "'tracing.<connector>.<endpoint>.router' metrics for the "
+         "connector and endpoint the message was forwarded to. Disabled if "
+         "empty."),
+        default={}, static=True)
+    profiling = ConfigDict(
+        ("Profiling of live workers. Sending the worker SIGUSR2 samples its "
+         "stack every 'interval' seconds of CPU time (default 0.005) for "
+         "'duration' seconds (default 30) and writes the samples in "
+         "collapsed stack format, for flamegraph.pl, to 'output_dir' "
+         "(default the current directory). Inbound messages that take "
+         "longer than 'slow_message_threshold' seconds, if set, are logged "
+         "with the time spent in each stage. Disabled if empty."),
+        default={}, static=True)
+    shadow = ConfigDict(
+        ("Shadow mode, for trying out a config change on live traffic. "
+         "Inbound messages are also decided with the fields in 'config' "
+         "merged over this config, without forwarding messages, sending "
+         "replies or writing sessions. Decisions that differ are counted "
+         "in 'shadow.divergence.<kind>' metrics, where the kind is "
+         "'target' (a different application), 'terminate' (the session "
+         "would be ended), 'reply' (a different reply) or 'error'. The CPU "
+         "time the candidate decisions take is published as "
+         "'shadow.seconds'. Multi-tenant and batched messages are not "
+         "evaluated. Disabled if empty."),
+        default={}, static=True)
+    analytics = ConfigDict(
+        ("Routing analytics. Selections, forwarded messages and unique "
+         "users per endpoint, and bad input and the reasons sessions ended, "
+         "are counted in memory per 'bucket_size' seconds (default 3600) "
+         "and added to Redis every 'flush_interval' seconds (default 10). "
+         "They are kept for 'ttl' seconds (default 90 days). Use "
+         "'python -m vxapprouter.analytics' to query them. Only routing "
+         "with the default config is counted, not that of tenants. "
+         "Disabled if empty."),
+        default={}, static=True)
+    session_close_on_expiry = ConfigDict(
+        ("Send a session close to the application when a session routed "
+         "to it expires, instead of only when the transport sends one. "
+         "Deadlines are checked every 'resolution' seconds (default 1) in "
+         "a timer wheel of 'slots' slots (default 512), and stored in "
+         "Redis so that sessions tracked by a worker that stops are closed "
+         "by another one once they are 'grace' seconds overdue (default "
+         "10), checked every 'recovery_interval' seconds (default 60). "
+         "Closes are sent in batches of up to 'batch_size' (default 100). "
+         "Disabled if empty."),
+        default={}, static=True)
+    preferences = ConfigDict(
+        ("Remember the endpoint each user last selected, for 'ttl' seconds "
+         "(default 90 days). New sessions for returning users then start "
+         "with 'continue_title' and a choice between that endpoint and the "
+         "menu if 'mode' is 'prompt' (default), or are forwarded to it "
+         "straight away if 'mode' is 'route'. Endpoints that are no longer "
+         "on the menu or are unavailable are skipped. Users are stored in "
+         "'buckets' Redis hashes (default 1024), which should be at least "
+         "the number of users divided by 100 to keep the hashes small. "
+         "Disabled if empty."),
+        default={}, static=True)
     # Dynamic, per-message configuration
     menu_title = ConfigText(
         "Content for the menu title", default="Please select a choice.")
     entries = ConfigList(
-        "A list of application endpoints and associated labels",
+        ("A list of application endpoints and associated labels. An entry "
+         "with a list of 'entries' instead of an 'endpoint' is shown as a "
+         "sub-menu, titled with its optional 'title' or its label."),
         default=[])
+    menu_max_length = ConfigInt(
+        ("Maximum length in characters of a menu page. Longer menus are "
+         "split across pages linked by a 'more' choice. Set to 0 to "
+         "disable pagination."),
+        default=160)
+    more_label = ConfigText(
+        "Label of the menu choice that shows the next page of a menu.",
+        default="More")
+    back_label = ConfigText(
+        "Label of the menu choice that returns to the previous page.",
+        default="Back")
     invalid_input_message = ConfigText(
         "Prompt to display when warning about an invalid choice",
         default=("That is an incorrect choice. Please enter the number "
@@ -44,166 +262,720 @@ class ApplicationDispatcherConfig(Dispatcher.CONFIG_CLASS):
          "an active session."),
         default=("Oops! We experienced a temporary error. "
                  "Please try and dial the line again."))
+    unavailable_message = ConfigText(
+        ("Prompt to display when the user selects an application that is "
+         "temporarily unavailable."),
+        default=("Sorry, this service is temporarily unavailable. "
+                 "Please try again later."))
+    continue_title = ConfigText(
+        ("Prompt offering a returning user the endpoint they last selected. "
+         "'%(label)s' is replaced with the endpoint's menu label."),
+        default="Welcome back! Continue with %(label)s?")
+    continue_label = ConfigText(
+        "Label of the choice that continues with the last endpoint.",
+        default="Continue")
+    menu_label = ConfigText(
+        "Label of the choice that shows the menu instead.",
+        default="Main menu")
+    busy_message = ConfigText(
+        ("Prompt to display when the selected application is receiving "
+         "more messages than it can handle."),
+        default=("Sorry, this service is very busy right now. "
+                 "Please try again later."))
     routing_table = ConfigDict(
         "Routing table. Keys are connector names, values are dicts mapping "
         "endpoint names to [connector, endpoint] pairs.", required=True)
 
 
-class StateResponse(object):
-    def __init__(self, state, session_update=None, inbound=(), outbound=()):
-        self.next_state = state
-        self.session_update = session_update or {}
-        self.inbound = inbound
-        self.outbound = outbound
+class ApplicationDispatcher(StateMachine, Dispatcher):
+    CONFIG_CLASS = ApplicationDispatcherConfig
+    worker_name = 'application_dispatcher'
+    clock = reactor
 
+    MAX_REMEMBERED_ENDPOINTS = 10000
 
-def mkmenu(options, start=1, format='%s) %s'):
-    items = [format % (idx, opt) for idx, opt in enumerate(options, start)]
-    return '\n'.join(items)
+    def __init__(self, *args, **kw):
+        super(ApplicationDispatcher, self).__init__(*args, **kw)
+        self.ready = Deferred()
+        self.startup_timings = OrderedDict()
 
+    def setup_worker(self):
+        d = super(ApplicationDispatcher, self).setup_worker()
+        d.addCallback(self.report_ready)
+        return d
 
-def clean(content):
-    return (content or '').strip()
+    def report_ready(self, _):
+        """
+        Log how long each startup phase took and fire :attr:`ready`. This
+        is called once the connectors have started consuming.
+        """
+        log.msg("Ready to process messages. Startup took %.3fs (%s)" % (
+            sum(self.startup_timings.values()), ', '.join(
+                '%s: %.3fs' % item for item in self.startup_timings.items())))
+        self.ready.callback(self.startup_timings)
 
+    def startup_phase(self, name, func, *args):
+        """
+        Call ``func`` and record how long it takes in
+        :attr:`startup_timings`.
+        """
+        started = self.clock.seconds()
 
-class ApplicationDispatcher(Dispatcher):
-    CONFIG_CLASS = ApplicationDispatcherConfig
-    worker_name = 'application_dispatcher'
+        def done(result):
+            self.startup_timings[name] = self.clock.seconds() - started
+            return result
 
-    STATE_START = "start"
-    STATE_SELECT = "select"
-    STATE_SELECTED = "selected"
-    STATE_BAD_INPUT = "bad_input"
+        return maybeDeferred(func, *args).addCallback(done)
 
     @inlineCallbacks
     def setup_dispatcher(self):
         yield super(ApplicationDispatcher, self).setup_dispatcher()
-        self.handlers = {
-            self.STATE_START: self.handle_state_start,
-            self.STATE_SELECT: self.handle_state_select,
-            self.STATE_SELECTED: self.handle_state_selected,
-            self.STATE_BAD_INPUT: self.handle_state_bad_input,
-        }
+        self.setup_state_machine()
+        self._config_snapshot = None
         config = self.get_static_config()
-        txrm = yield TxRedisManager.from_config(config.redis_manager)
-        self.redis = txrm.sub_manager(self.worker_name)
+        self.health = None
+        if config.circuit_breaker:
+            self.health = HealthMonitor.from_config(
+                self.clock, config.circuit_breaker)
+        self.redis_manager = yield self.startup_phase(
+            'redis', TxRedisManager.from_config, config.redis_manager)
+        self.redis = self.redis_manager.sub_manager(self.worker_name)
+        self.metrics = yield self.startup_phase(
+            'metrics', self.start_publisher, MetricManager,
+            config.metrics_prefix)
+        self.rate_limiters = self.setup_rate_limiters(
+            config.rate_limits, config.max_concurrent_messages > 1)
+        self.setup_profiling(config.profiling)
+        self.shadow = None
+        if config.shadow:
+            self.shadow = ShadowEvaluator(
+                self, self.CONFIG_CLASS, self.config,
+                config.shadow.get('config', {}))
+        self.setup_admission(config)
+        self.last_endpoints = OrderedDict()
+        self.in_flight = set()
+        self.tracer = None
+        if config.tracing:
+            self.tracer = HopTracer.from_config(self.clock, config.tracing)
+        self.dedup = None
+        if config.deduplication:
+            self.dedup = Deduplicator.from_config(
+                self.clock, config.deduplication,
+                self.redis.sub_manager('dedup'))
+        yield self.startup_phase('tenants', self.setup_tenants, config.tenancy)
+        self.setup_analytics(config.analytics)
+        self.setup_partition(config.partition)
+        self.setup_window(config)
+        self.setup_session_expiry(config.session_close_on_expiry)
+        self.batcher = None
+        if config.batching:
+            if config.max_concurrent_messages <= 1:
+                raise ConfigError(
+                    "Batching requires max_concurrent_messages to be more "
+                    "than 1")
+            self.batcher = Batcher(
+                self.clock, self.route_batch, **config.batching)
+        self.session_state_expiry = self.check_session_state_expiry(
+            config.session_state_expiry)
+        self.setup_preferences(config.preferences)
+        yield self.startup_phase('warm_up', self.warm_up)
 
-    def session_manager(self, config):
-        return SessionManager(
-            self.redis, max_session_length=config.session_expiry)
+    def warm_up(self):
+        """
+        Resolve the message configs, compile their menus and check their
+        routing before any messages arrive, so that the first messages do
+        not pay for it.
+        """
+        configs = [self.default_config()]
+        if self.tenants is not None:
+            configs.extend(self.tenants.configs.values())
+        if self.shadow is not None:
+            configs.append(self.shadow.config)
+        for config in configs:
+            plan = self.get_menu_plan(config)
+            self.check_routing(config, plan.endpoints)
 
-    def forwarded_message(self, msg, **kwargs):
-        copy = TransportUserMessage(**msg.payload)
-        for k, v in kwargs.items():
-            copy[k] = v
-        return copy
+    def check_routing(self, config, endpoints):
+        """
+        Raise a ConfigError if a route in ``config`` targets a connector
+        that does not exist, and log the menu ``endpoints`` that cannot be
+        reached from an inbound connector.
+        """
+        connectors = (set(config.receive_inbound_connectors) |
+                      set(config.receive_outbound_connectors))
+        for connector_name, routes in config.routing_table.items():
+            for endpoint, target in routes.items():
+                if len(target) != 2 or target[0] not in connectors:
+                    raise ConfigError(
+                        "Invalid target %r for endpoint '%s' on '%s'" % (
+                            target, endpoint, connector_name))
+        for connector_name in config.receive_inbound_connectors:
+            routes = config.routing_table.get(connector_name, {})
+            for endpoint in sorted(endpoints):
+                if endpoint not in routes:
+                    log.warning(
+                        "No routing information for endpoint '%s' on '%s'"
+                        % (endpoint, connector_name))
 
-    def target_endpoints(self, config):
+    def check_session_state_expiry(self, expiries):
         """
-        Make sure the currently active endpoint is still valid.
+        Raise a ConfigError if ``expiries`` has a state that does not
+        exist or an expiry that is not a positive number of seconds.
         """
-        return set([entry['endpoint'] for entry in config.entries])
+        for state, expiry in expiries.items():
+            if state not in self.handlers:
+                raise ConfigError(
+                    "Unknown session state '%s' in session_state_expiry" % (
+                        state,))
+            if not isinstance(expiry, (int, long)) or expiry <= 0:
+                raise ConfigError(
+                    "Invalid expiry %r for session state '%s'" % (
+                        expiry, state))
+        return expiries
+
+    def setup_profiling(self, profiling):
+        self.profiler = None
+        self.slow_messages = None
+        self.profiling = profiling
+        if not profiling:
+            return
+        self.profiler = SamplingProfiler(profiling.get('interval', 0.005))
+        self._profiling_stop = None
+        self._previous_sigusr2 = signal.signal(
+            signal.SIGUSR2, self.profile_signal_received)
+        if profiling.get('slow_message_threshold') is not None:
+            self.slow_messages = SlowMessageLog(
+                self.clock, profiling['slow_message_threshold'])
+
+    def teardown_profiling(self):
+        if self.profiler is None:
+            return
+        if self._profiling_stop is not None:
+            self._profiling_stop.cancel()
+            self.stop_profiling()
+        signal.signal(signal.SIGUSR2, self._previous_sigusr2)
 
-    def get_endpoint_for_choice(self, msg, session):
+    def profile_signal_received(self, signum, frame):
+        reactor.callFromThread(self.start_profiling)
+
+    def start_profiling(self):
         """
-        Retrieves the candidate endpoint based on the user's numeric choice
+        Profile the worker for the configured duration.
         """
-        endpoints = json.loads(session['endpoints'])
-        index = self.get_menu_choice(msg, (1, len(endpoints)))
-        if index is None:
-            return None
-        return endpoints[index - 1]
+        if self.profiler.running:
+            return
+        log.msg("Profiling for %s seconds" % (
+            self.profiling.get('duration', 30),))
+        self.profiler.start()
+        self._profiling_stop = self.clock.callLater(
+            self.profiling.get('duration', 30), self.stop_profiling)
 
-    def get_menu_choice(self, msg, valid_range):
+    def stop_profiling(self):
         """
-        Parse user input for selecting a numeric menu choice
+        Stop profiling and write the samples to a file. Returns its path.
         """
-        try:
-            value = int(clean(msg['content']))
-        except ValueError:
+        self._profiling_stop = None
+        self.profiler.stop()
+        path = os.path.join(
+            self.profiling.get('output_dir', '.'), '%s-%s-%d.collapsed' % (
+                self.worker_name, os.getpid(), time.time()))
+        self.profiler.dump(path)
+        log.msg("Wrote profile to %s" % (path,))
+        return path
+
+    def setup_partition(self, partition):
+        self.partition = None
+        self.session_cache = None
+        self.user_serializer = None
+        if not partition:
+            return
+        self.partition = (partition['index'], partition['count'])
+        self.session_cache = LocalSessionCache(
+            self.clock, partition.get('session_cache_size', 10000),
+            self.owns_user)
+        self.user_serializer = UserSerializer()
+
+    def setup_admission(self, config):
+        load_shedding = dict(config.load_shedding)
+        if ('max_in_flight' in load_shedding and
+                config.max_concurrent_messages == 1):
+            log.warning(
+                "Ignoring load_shedding max_in_flight, "
+                "max_concurrent_messages is 1")
+            del load_shedding['max_in_flight']
+        self.admission = AdmissionController.from_config(
+            self.clock, load_shedding)
+
+    def setup_window(self, config):
+        self.window = None
+        if config.max_concurrent_messages <= 1:
+            return
+        if config.amqp_prefetch_count < config.max_concurrent_messages:
+            log.warning(
+                "amqp_prefetch_count (%s) is smaller than "
+                "max_concurrent_messages (%s)" % (
+                    config.amqp_prefetch_count,
+                    config.max_concurrent_messages))
+        self.window = ConcurrencyWindow(config.max_concurrent_messages)
+        if self.user_serializer is None:
+            self.user_serializer = UserSerializer()
+
+    def windowed(self, func, *args):
+        """
+        Call ``func`` in the concurrency window, if there is one, and track
+        it as in flight until it is done.
+        """
+        if self.window is None:
+            return self.track_in_flight(func, *args)
+        return self.window.run(self.track_in_flight, func, *args)
+
+    def track_in_flight(self, func, *args):
+        d = maybeDeferred(func, *args)
+        self.in_flight.add(d)
+
+        def done(result):
+            self.in_flight.discard(d)
+            return result
+
+        return d.addBoth(done)
+
+    def owns_user(self, user_id):
+        if self.partition is None:
+            return True
+        index, count = self.partition
+        return partition_for(user_id, count) == index
+
+    def setup_analytics(self, analytics):
+        self.analytics = None
+        self._analytics_flush = None
+        if not analytics:
+            return
+        self.analytics = RoutingAnalytics(
+            self.clock, self.redis.sub_manager('analytics'),
+            analytics.get('bucket_size', 3600),
+            analytics.get('ttl', 90 * 24 * 3600))
+        self._analytics_flush = LoopingCall(self.flush_analytics)
+        self._analytics_flush.clock = self.clock
+        self._analytics_flush.start(
+            analytics.get('flush_interval', 10), now=False)
+
+    def analytics_for(self, config):
+        """
+        Return the analytics to count routing with ``config`` in, or
+        ``None``. Tenant routing is not counted.
+        """
+        if config.tenant is not None:
             return None
-        else:
-            if value not in range(valid_range[0], valid_range[1] + 1):
-                return None
-            return value
+        return self.analytics
 
-    def make_first_reply(self, config, session, msg):
-        return msg.reply(self.create_menu(config))
+    def flush_analytics(self):
+        d = self.analytics.flush()
+        d.addErrback(log.err, "Failed to flush analytics")
+        return d
 
-    def make_invalid_input_reply(self, config, session, msg):
-        return msg.reply('%s\n\n1. %s' % (
-            config.invalid_input_message, config.try_again_message))
-
-    def handle_state_start(self, config, session, msg):
-        """
-        When presenting the menu, we also store the list of endpoints
-        in the session data. Later, in the select state, we load
-        these endpoints and retrieve the candidate endpoint based
-        on the user's menu choice.
-        """
-        reply_msg = self.make_first_reply(config, session, msg)
-        endpoints = json.dumps(
-            [entry['endpoint'] for entry in config.entries]
-        )
-        return StateResponse(
-            self.STATE_SELECT, {'endpoints': endpoints}, outbound=[reply_msg])
-
-    def handle_state_select(self, config, session, msg):
-        endpoint = self.get_endpoint_for_choice(msg, session)
-        if endpoint is None:
-            reply_msg = self.make_invalid_input_reply(config, session, msg)
-            return StateResponse(self.STATE_BAD_INPUT, outbound=[reply_msg])
-
-        if endpoint not in self.target_endpoints(config):
-            log.msg(("Router configuration change forced session "
-                     "termination for user %s" % msg['from_addr']))
-            error_reply_msg = self.make_error_reply(msg, config)
-            return StateResponse(None, outbound=[error_reply_msg])
-
-        forwarded_msg = self.forwarded_message(
-            msg, content=None,
-            session_event=TransportUserMessage.SESSION_NEW)
-        log.msg("Switched to endpoint '%s' for user %s" %
-                (endpoint, msg['from_addr']))
-        return StateResponse(
-            self.STATE_SELECTED, {'active_endpoint': endpoint},
-            inbound=[(forwarded_msg, endpoint)])
-
-    def handle_state_selected(self, config, session, msg):
-        active_endpoint = session['active_endpoint']
-        if active_endpoint not in self.target_endpoints(config):
-            log.msg(("Router configuration change forced session "
-                     "termination for user %s" % msg['from_addr']))
-            error_reply_msg = self.make_error_reply(msg, config)
-            return StateResponse(None, outbound=[error_reply_msg])
-        else:
-            return StateResponse(
-                self.STATE_SELECTED, inbound=[(msg, active_endpoint)])
-
-    def handle_state_bad_input(self, config, session, msg):
-        choice = self.get_menu_choice(msg, (1, 1))
-        if choice is None:
-            reply_msg = self.make_invalid_input_reply(config, session, msg)
-            return StateResponse(self.STATE_BAD_INPUT, outbound=[reply_msg])
+    def setup_session_expiry(self, session_close_on_expiry):
+        self.session_expiry = None
+        if not session_close_on_expiry:
+            return
+        self.session_expiry = SessionExpiry.from_config(
+            self.clock, session_close_on_expiry,
+            self.redis.sub_manager('expiry'), self.session_expired)
+        self.session_expiry.start()
+
+    def expiry_key(self, config, user_id):
+        return expiry_key(getattr(config, 'tenant', None), user_id)
+
+    def remaining_session_expiry(self, config, session):
+        """
+        Return the number of seconds left of the ``session_expiry`` that
+        ``session`` was created with.
+        """
+        age = time.time() - float(session.get('created_at', time.time()))
+        return max(1, int(math.ceil(config.session_expiry - age)))
+
+    def session_deadline(self, config, session):
+        """
+        Return when the selected ``session`` expires, if it is not saved
+        again.
+        """
+        state_expiry = self.session_state_expiry.get(self.STATE_SELECTED)
+        if state_expiry is None:
+            # Sessions created while handling this message have not been
+            # reloaded, so they have no creation time yet.
+            state_expiry = self.remaining_session_expiry(config, session)
+        return self.clock.seconds() + state_expiry
+
+    def track_session_expiry(self, config, decision, connector_name,
+                             deadline):
+        """
+        Track the deadline of a session that is routed to an application,
+        if it changed. It is set when the application is selected, and
+        moved on every message if selected sessions have their own
+        expiry. The message is held up until ``deadline`` at most.
+        """
+        session = decision.session
+        if decision.cleared or session.get('state') != self.STATE_SELECTED:
+            return succeed(None)
+        key = self.expiry_key(config, decision.user_id)
+        state_expiry = self.session_state_expiry.get(self.STATE_SELECTED)
+        if 'active_endpoint' in decision.session_update:
+            msg = decision.msg
+            record = {
+                'endpoint': session['active_endpoint'],
+                'connector': connector_name,
+                'to_addr': msg['to_addr'],
+                'transport_name': msg['transport_name'],
+                'transport_type': msg['transport_type'],
+            }
+            d = self.session_expiry.track(
+                key, self.session_deadline(config, session), record)
+        elif state_expiry is not None:
+            d = self.session_expiry.reschedule(
+                key, self.clock.seconds() + state_expiry)
         else:
-            return self.handle_state_start(config, session, msg)
+            return succeed(None)
+        return self.wait_until(deadline, d, "track session expiry")
+
+    def untrack_session_expiry(self, config, decision, deadline):
+        """
+        Stop tracking the deadline of a session that has been removed, if
+        it was routed to an application.
+        """
+        if (decision.state != self.STATE_SELECTED and
+                'active_endpoint' not in decision.session_update):
+            return succeed(None)
+        return self.untrack_user_session_expiry(
+            config, decision.user_id, deadline)
+
+    def untrack_user_session_expiry(self, config, user_id, deadline):
+        d = self.session_expiry.untrack(self.expiry_key(config, user_id))
+        return self.wait_until(deadline, d, "untrack session expiry")
 
     @inlineCallbacks
-    def handle_session_close(self, config, session, msg, connector_name):
-        user_id = msg['from_addr']
-        if (session.get('state', None) == self.STATE_SELECTED and
-                session['active_endpoint'] in self.target_endpoints(config)):
-            target = self.find_target(config, msg, connector_name, session)
-            yield self.publish_inbound(msg, target[0], target[1])
+    def session_expired(self, key, record):
+        """
+        Send a session close to the application an expired session was
+        routed to.
+
+        If the session is still there, routed to the same endpoint, it has
+        not expired yet, and it is tracked again instead.
+        """
+        tenant, user_id = None, key
+        if key.startswith('['):
+            tenant, user_id = json.loads(key)
+        if tenant is None:
+            config = self.default_config()
+        else:
+            config = self.tenants.config(tenant)
+        if config is None:
+            log.warning("Expired session for unknown tenant '%s'" % (
+                tenant,))
+            return
         session_manager = yield self.session_manager(config)
-        yield session_manager.clear_session(user_id)
+        session = yield session_manager.load_session(user_id)
+        if (session.get('state') == self.STATE_SELECTED and
+                session.get('active_endpoint') == record['endpoint']):
+            yield self.session_expiry.track(
+                key, self.session_deadline(config, session), record)
+            return
+        msg = TransportUserMessage(
+            to_addr=record['to_addr'], from_addr=user_id, content=None,
+            session_event=TransportUserMessage.SESSION_CLOSE,
+            transport_name=record['transport_name'],
+            transport_type=record['transport_type'])
+        target = self.find_target(
+            config, msg, record['connector'],
+            {'active_endpoint': record['endpoint']})
+        if target is None:
+            return
+        log.msg("Session expired for user %s on endpoint '%s'" % (
+            user_id, record['endpoint']))
+        yield self.publish_inbound(msg, target[0], target[1])
+        self.increment_metric('sessions.expired')
+        analytics = self.analytics_for(config)
+        if analytics is not None:
+            analytics.count(RoutingAnalytics.MENU, 'ended.expired')
+
+    def setup_preferences(self, preferences):
+        self.preferences = None
+        self._preference_stores = {}
+        if not preferences:
+            return
+        mode = preferences.get('mode', self.RESUME_PROMPT)
+        if mode not in (self.RESUME_PROMPT, self.RESUME_ROUTE):
+            raise ConfigError("Invalid preferences mode '%s'" % (mode,))
+        self.preferences = preferences
+
+    def resume_mode(self):
+        if self.preferences is None:
+            return None
+        return self.preferences.get('mode', self.RESUME_PROMPT)
 
-    def create_menu(self, config):
-        labels = [entry['label'] for entry in config.entries]
-        return (config.menu_title + "\n" + mkmenu(labels))
+    def preference_store(self, config):
+        """
+        Return the :class:`PreferenceStore` for users of ``config``. Each
+        tenant's users are remembered separately.
+        """
+        tenant = getattr(config, 'tenant', None)
+        store = self._preference_stores.get(tenant)
+        if store is None:
+            redis = self.redis
+            if tenant is not None:
+                redis = self.tenants.namespace(tenant)
+            store = self._preference_stores[tenant] = (
+                PreferenceStore.from_config(
+                    redis.sub_manager('preferences'), self.preferences))
+        return store
+
+    def get_last_endpoint(self, config, msg, session, deadline):
+        """
+        Return a deferred that fires with the endpoint the sender of
+        ``msg`` last selected, if ``msg`` starts a new session. Fires with
+        ``None`` if it is not remembered or could not be loaded before
+        ``deadline``.
+        """
+        if self.preferences is None or not self.is_new_session(msg, session):
+            return succeed(None)
+        d = deadline.call(
+            self.preference_store(config).get, msg['from_addr'])
+        d.addErrback(self.bookkeeping_failed, "load last endpoint")
+        return d
+
+    def remember_last_endpoint(self, config, user_id, endpoint, deadline):
+        d = deadline.call(
+            self.preference_store(config).remember, user_id, endpoint)
+        d.addErrback(self.bookkeeping_failed, "remember last endpoint")
+        return d
+
+    @inlineCallbacks
+    def setup_tenants(self, tenancy):
+        self.tenants = None
+        self._tenant_refresh = None
+        if not tenancy:
+            return
+        self.tenants = TenantRegistry(
+            self.CONFIG_CLASS, self.config, self.redis.sub_manager('tenants'),
+            tenancy.get('tenants'))
+        yield self.tenants.load()
+        self._tenant_refresh = LoopingCall(self.refresh_tenants)
+        self._tenant_refresh.clock = self.clock
+        self._tenant_refresh.start(
+            tenancy.get('refresh_interval', 30), now=False)
+
+    def refresh_tenants(self):
+        d = self.tenants.load()
+        d.addErrback(log.err, "Failed to reload tenants")
+        return d
+
+    def teardown_worker(self):
+        d = self.drain()
+        d.addCallback(lambda _: self.teardown_dispatcher())
+        return d
+
+    @inlineCallbacks
+    def drain(self):
+        """
+        Stop consuming messages and wait for the messages in flight to be
+        processed, for at most ``drain_timeout`` seconds. Messages waiting
+        for a batch are processed right away.
+        """
+        deadline = Deadline(
+            self.clock, self.get_static_config().drain_timeout)
+        try:
+            yield deadline.call(self.pause_connectors)
+            if self.batcher is not None:
+                self.batcher.stop()
+            # Chained so that timing out does not cancel the messages.
+            waiting = Deferred()
+            DeferredList(list(self.in_flight)).chainDeferred(waiting)
+            yield deadline.call(lambda: waiting)
+        except DeadlineExceeded:
+            log.warning("Timed out waiting for %s in-flight messages" % (
+                len(self.in_flight),))
+
+    def teardown_dispatcher(self):
+        if self._tenant_refresh is not None and self._tenant_refresh.running:
+            self._tenant_refresh.stop()
+        if self.session_expiry is not None:
+            self.session_expiry.stop()
+        for limiter in self.rate_limiters.values():
+            limiter.stop()
+        self.metrics.stop()
+        self.teardown_profiling()
+        d = succeed(None)
+        if self.analytics is not None:
+            self._analytics_flush.stop()
+            d = self.flush_analytics()
+        d.addCallback(lambda _: self.redis_manager.close_manager())
+        return d
+
+    def get_config(self, msg, ctxt=None):
+        """
+        Return the message config. It is resolved once into an immutable
+        snapshot that is shared by all messages until
+        :meth:`invalidate_config` is called.
+
+        In multi-tenant mode, this is the config of the tenant the message
+        belongs to, if any.
+        """
+        if self.tenants is not None:
+            config = self.tenants.match(msg)
+            if config is not None:
+                return succeed(config)
+        return succeed(self.default_config())
 
-    def make_error_reply(self, msg, config):
-        return msg.reply(config.error_message, continue_session=False)
+    def default_config(self):
+        if self._config_snapshot is None:
+            self._config_snapshot = ConfigSnapshot(
+                self.CONFIG_CLASS(self.config), tenant=None)
+        return self._config_snapshot
+
+    def invalidate_config(self):
+        """
+        Discard the config snapshots. This must be called whenever
+        ``self.config`` is changed.
+        """
+        self._config_snapshot = None
+        if self.tenants is not None:
+            self.tenants.rebuild(self.tenants.tenant_data, self.config)
+
+    def setup_rate_limiters(self, rate_limits, queueing):
+        """
+        Build the rate limiters. Without a concurrency window, a message
+        waiting for capacity would hold up every other message, so none
+        are queued unless ``queueing`` is true.
+        """
+        limiters = {}
+        for connector_name, endpoints in rate_limits.items():
+            for endpoint, limit in endpoints.items():
+                name = '%s.%s' % (connector_name, endpoint)
+                queue_size = limit.get('queue_size', 0)
+                if queue_size and not queueing:
+                    log.warning(
+                        "Ignoring queue_size for rate limit %s, "
+                        "max_concurrent_messages is 1" % (name,))
+                    queue_size = 0
+                redis = None
+                if limit.get('shared'):
+                    redis = self.redis.sub_manager('ratelimit')
+                limiters[(connector_name, endpoint)] = RateLimiter(
+                    name, self.clock, limit['rate'], limit.get('burst'),
+                    queue_size, redis,
+                    lambda outcome, name=name: self.increment_metric(
+                        'ratelimit.%s.%s' % (name, outcome)))
+        return limiters
+
+    def wait_until(self, deadline, d, action):
+        """
+        Wait for the bookkeeping in ``d`` until ``deadline`` at most. The
+        bookkeeping itself is started before this is called and is not
+        cancelled, so it is still done if the deadline runs out.
+        """
+        def wait():
+            waiting = Deferred()
+            d.addBoth(
+                lambda result: waiting.called or waiting.callback(result))
+            return waiting
+        waiting = deadline.call(wait)
+        waiting.addErrback(self.bookkeeping_failed, action)
+        return waiting
+
+    def bookkeeping_failed(self, failure, action):
+        if failure.check(DeadlineExceeded):
+            log.warning("Deadline exceeded, did not %s" % (action,))
+        else:
+            log.err(failure, "Failed to %s" % (action,))
+
+    def mk_deadline(self):
+        return Deadline(
+            self.clock, self.get_static_config().deadlines.get('timeout'))
+
+    def deadline_outcome(self, stage, default):
+        return self.get_static_config().deadlines.get(stage, default)
+
+    def remember_endpoint(self, user_id, endpoint):
+        """
+        Keep track of recently used endpoints, for routing messages when
+        the session is unavailable.
+        """
+        self.last_endpoints.pop(user_id, None)
+        self.last_endpoints[user_id] = endpoint
+        if len(self.last_endpoints) > self.MAX_REMEMBERED_ENDPOINTS:
+            self.last_endpoints.popitem(last=False)
+
+    def increment_metric(self, name):
+        if name not in self.metrics:
+            self.metrics.register(Count(name))
+        self.metrics[name].inc()
+
+    def record_metric(self, name, value):
+        if name not in self.metrics:
+            self.metrics.register(Metric(name, aggregators=[AVG, MAX]))
+        self.metrics[name].set(value)
+
+    def publish_inbound(self, msg, connector_name, endpoint):
+        if self.tracer is not None:
+            self.tracer.inbound_sent(
+                msg, '%s.%s' % (connector_name, endpoint))
+        return super(ApplicationDispatcher, self).publish_inbound(
+            msg, connector_name, endpoint)
+
+    def publish_outbound(self, msg, connector_name, endpoint):
+        if self.tracer is not None:
+            traced = self.tracer.outbound_sent(msg)
+            if traced is not None:
+                key, round_trip, router = traced
+                self.record_metric(
+                    'tracing.%s.round_trip' % (key,), round_trip)
+                self.record_metric('tracing.%s.router' % (key,), router)
+        return super(ApplicationDispatcher, self).publish_outbound(
+            msg, connector_name, endpoint)
+
+    def session_manager(self, config):
+        redis = self.redis
+        tenant = getattr(config, 'tenant', None)
+        if tenant is not None:
+            redis = self.tenants.namespace(tenant)
+        session_manager = SessionManager(
+            redis, max_session_length=config.session_expiry)
+        if self.session_cache is not None and redis is self.redis:
+            return self.session_cache.wrap(session_manager)
+        return session_manager
+
+    def max_cached_menu_plans(self):
+        size = self.MAX_CACHED_MENU_PLANS
+        if self.tenants is not None:
+            size += 2 * len(self.tenants)
+        if self.shadow is not None:
+            size += 2
+        return size
+
+    def hidden_endpoints(self):
+        if self.health is None:
+            return frozenset()
+        return self.health.hidden_endpoints()
+
+    def endpoint_available(self, endpoint):
+        return self.health is None or self.health.is_available(endpoint)
+
+    def wait_for_capacity(self, target, deadline):
+        """
+        Wait until the rate limit for ``target``, if any, allows another
+        message. Fires with ``False`` if the message should be rejected,
+        which it is straight away if it would have to wait past
+        ``deadline``.
+        """
+        limiter = self.rate_limiters.get(tuple(target))
+        if limiter is None:
+            return succeed(True)
+        d = deadline.call(limiter.acquire, deadline.remaining())
+        d.addErrback(self.capacity_timed_out, limiter)
+        return d
+
+    def capacity_timed_out(self, failure, limiter):
+        failure.trap(DeadlineExceeded)
+        self.increment_metric('ratelimit.%s.expired' % (limiter.name,))
+        return failure
 
     def find_target(self, config, msg, connector_name, session={}):
         endpoint_name = session.get(
@@ -220,68 +992,368 @@ class ApplicationDispatcher(Dispatcher):
             return None
         return target
 
-    @inlineCallbacks
     def process_inbound(self, config, msg, connector_name):
+        if self.tracer is not None:
+            self.tracer.inbound_received(msg)
+        return self.windowed(self.handle_inbound, config, msg, connector_name)
+
+    def handle_inbound(self, config, msg, connector_name):
         log.msg("Processing inbound message: %s" % (msg,))
+        if not self.admission.admit(msg):
+            return self.shed_inbound(config, msg, connector_name)
+        deadline = self.mk_deadline()
+        if self.batcher is not None:
+            d = self.batcher.add((config, msg, connector_name, deadline))
+        elif self.user_serializer is None:
+            d = self.route_inbound(config, msg, connector_name, deadline)
+        else:
+            user_id = msg['from_addr']
+            if not self.owns_user(user_id):
+                log.warning("User %s does not belong to partition %s" % (
+                    user_id, self.partition[0]))
+                self.increment_metric('partition.misrouted')
+            d = self.user_serializer.run(
+                user_id, self.route_inbound, config, msg, connector_name,
+                deadline)
+        d.addErrback(self.inbound_timed_out, config, msg, connector_name)
+        return self.admission.track(d)
+
+    def publish_direct_reply(self, config, reply_msg, connector_name):
+        """
+        Publish a reply generated by the router without going through
+        send_outbound, so that no Redis calls are made.
+        """
+        target = self.find_target(config, reply_msg, connector_name)
+        if target is None:
+            return succeed(None)
+        return self.publish_outbound(reply_msg, target[0], target[1])
+
+    def shed_inbound(self, config, msg, connector_name):
+        """
+        Turn away a new session while overloaded.
+        """
+        log.msg("Overloaded, refusing new session for user %s" % (
+            msg['from_addr'],))
+        self.increment_metric('load_shedding.rejected')
+        return self.publish_direct_reply(
+            config, self.make_busy_reply(msg, config), connector_name)
+
+    def inbound_timed_out(self, failure, config, msg, connector_name):
+        failure.trap(DeadlineExceeded)
+        self.increment_metric('deadline.inbound.timeouts')
+        user_id = msg['from_addr']
+        outcome = self.deadline_outcome('inbound', 'error')
+        log.warning("Deadline exceeded for inbound message from user %s, "
+                    "outcome: %s" % (user_id, outcome))
+        if outcome == 'drop':
+            return
+        endpoint = self.last_endpoints.get(user_id)
+        if outcome == 'route' and endpoint is not None:
+            target = self.find_target(
+                config, msg, connector_name, {'active_endpoint': endpoint})
+            if target is not None:
+                return self.publish_inbound(msg, target[0], target[1])
+        return self.publish_direct_reply(
+            config, self.make_error_reply(msg, config), connector_name)
+
+    @inlineCallbacks
+    def is_duplicate(self, msg, deadline):
+        if self.dedup is None:
+            returnValue(False)
+        self.increment_metric('dedup.checked')
+        duplicate = yield deadline.call(
+            self.dedup.is_duplicate, msg['message_id'])
+        if duplicate:
+            log.msg("Dropping duplicate inbound message %s" % (
+                msg['message_id'],))
+            self.increment_metric('dedup.duplicates')
+            if self.dedup.approximate:
+                self.increment_metric('dedup.duplicates.approximate')
+        returnValue(duplicate)
+
+    @inlineCallbacks
+    def route_inbound(self, config, msg, connector_name, deadline):
+        stages = None
+        if self.slow_messages is not None:
+            stages = self.slow_messages.timer()
+        if (yield self.is_duplicate(msg, deadline)):
+            return
         user_id = msg['from_addr']
         session_manager = yield self.session_manager(config)
-        session = yield session_manager.load_session(user_id)
-        session_event = msg['session_event']
-        if not session or session_event == TransportUserMessage.SESSION_NEW:
-            log.msg("Creating session for user %s" % user_id)
-            session = {}
-            state = self.STATE_START
-            yield session_manager.create_session(user_id, state=state)
-        elif session_event == TransportUserMessage.SESSION_CLOSE:
-            yield self.handle_session_close(
-                config, session, msg, connector_name)
+        session_manager = deadline.bind(session_manager)
+        if stages is not None:
+            stages.mark('dedup')
+        session = yield self.admission.timed(
+            session_manager.load_session(user_id))
+        if stages is not None:
+            stages.mark('load_session')
+        last_endpoint = yield self.get_last_endpoint(
+            config, msg, session, deadline)
+        decision = self.begin(config, msg, session, last_endpoint)
+        if not decision.closed:
+            if decision.created:
+                yield session_manager.create_session(
+                    user_id, state=decision.state)
+                decision.created = False
+            try:
+                # We must assume the state handlers might be async, even if
+                # the current implementations aren't. There is at least one
+                # test that depends on asynchrony here to hook into the
+                # state transition.
+                state_resp = yield self.handlers[decision.state](
+                    config, decision.session, msg)
+                self.conclude(decision, state_resp)
+            except Exception:
+                self.fail(config, decision)
+        if stages is not None:
+            stages.mark('decide')
+        if self.shadow is not None and config.tenant is None:
+            self.evaluate_shadow(msg, session, decision, last_endpoint)
+        yield self.apply_decision(
+            config, decision, connector_name, session_manager, deadline)
+        if stages is not None:
+            stages.mark('apply')
+            self.slow_messages.record(msg, stages)
+
+    def evaluate_shadow(self, msg, session, decision, last_endpoint=None):
+        divergences, seconds = self.shadow.evaluate(
+            msg, session, decision, last_endpoint)
+        self.increment_metric('shadow.evaluated')
+        self.record_metric('shadow.seconds', seconds)
+        for divergence in divergences:
+            self.increment_metric('shadow.divergence.%s' % (divergence,))
+        if divergences:
+            log.msg("Shadow config diverged for user %s: %s" % (
+                msg['from_addr'], ', '.join(divergences)))
+
+    def route_batch(self, items):
+        """
+        Route a batch of ``(config, msg, connector_name, deadline)``
+        inbound messages. Returns a deferred for each message.
+        """
+        results = [Deferred() for _ in items]
+        groups = OrderedDict()
+        for item, result in zip(items, results):
+            groups.setdefault(id(item[0]), []).append((item, result))
+        for group in groups.values():
+            d = self.route_batch_group(group)
+            d.addErrback(self.batch_failed, group)
+        return results
+
+    def batch_failed(self, failure, group):
+        for _, result in group:
+            if not result.called:
+                result.errback(failure)
+
+    @inlineCallbacks
+    def route_batch_group(self, group):
+        """
+        Route a batch of messages that share the same config. Sessions are
+        loaded concurrently, so that the requests are pipelined on the
+        Redis connection, and the messages are then decided together.
+        Messages from the same user are applied in order.
+        """
+        config = group[0][0][0]
+        session_manager = yield self.session_manager(config)
+
+        checked = yield DeferredList([
+            self.is_duplicate(msg, deadline)
+            for (_, msg, _, deadline), _ in group], consumeErrors=True)
+        group = self.batch_outcomes(group, checked, lambda duplicate: (
+            None if duplicate else True))
+
+        loaded = yield DeferredList([
+            self.admission.timed(deadline.bind(session_manager).load_session(
+                msg['from_addr']))
+            for (_, msg, _, deadline), _, _ in group], consumeErrors=True)
+        group = self.batch_outcomes(group, loaded, lambda session: session)
+
+        last_endpoints = yield gatherResults([
+            self.get_last_endpoint(config, item[1], session, item[3])
+            for item, _, session in group])
+        decisions = self.decide_batch(
+            config, [item[1] for item, _, _ in group],
+            [session for _, _, session in group], last_endpoints)
+
+        users = OrderedDict()
+        for ((_, _, connector_name, deadline), result, _), decision in zip(
+                group, decisions):
+            users.setdefault(decision.user_id, []).append(
+                (decision, connector_name, deadline, result))
+        yield DeferredList([
+            self.apply_decisions(config, session_manager, user_decisions)
+            for user_decisions in users.values()])
+
+    def batch_outcomes(self, group, outcomes, value):
+        """
+        Fire the results of the messages in ``group`` that failed or are
+        done according to ``value``, and return the rest along with their
+        value.
+        """
+        remaining = []
+        for (success, outcome), entry in zip(outcomes, group):
+            item, result = entry[:2]
+            if not success:
+                result.errback(outcome)
+                continue
+            outcome = value(outcome)
+            if outcome is None:
+                result.callback(None)
+            else:
+                remaining.append((item, result, outcome))
+        return remaining
+
+    @inlineCallbacks
+    def apply_decisions(self, config, session_manager, user_decisions):
+        for decision, connector_name, deadline, result in user_decisions:
+            d = self.apply_decision(
+                config, decision, connector_name,
+                deadline.bind(session_manager), deadline)
+            d.chainDeferred(result)
+            yield d
+
+    @inlineCallbacks
+    def apply_decision(self, config, decision, connector_name,
+                       session_manager, deadline):
+        """
+        Carry out ``decision``: update the session, forward messages to
+        applications and send replies.
+        """
+        user_id = decision.user_id
+        analytics = self.analytics_for(config)
+        if decision.closed:
+            for msg, endpoint in decision.inbound:
+                target = self.find_target(
+                    config, msg, connector_name, decision.session)
+                yield self.publish_inbound(msg, target[0], target[1])
+                if analytics is not None:
+                    analytics.forwarded(endpoint, user_id)
+            yield session_manager.clear_session(user_id)
+            if self.session_expiry is not None:
+                yield self.untrack_session_expiry(
+                    config, decision, deadline)
+            if analytics is not None:
+                analytics.record(decision)
             return
-        else:
-            log.msg("Loading session for user %s: %s" % (user_id, session,))
-            state = session['state']
 
         try:
-            # We must assume the state handlers might be async, even if the
-            # current implementations aren't. There is at least one test that
-            # depends on asynchrony here to hook into the state transition.
-            state_resp = yield self.handlers[state](config, session, msg)
-
-            if state_resp.next_state is None:
-                # Session terminated (right now, just in the case of a
-                # administrator-initiated configuration change
+            if decision.cleared:
                 yield session_manager.clear_session(user_id)
-            else:
-                session['state'] = state_resp.next_state
-                session.update(state_resp.session_update)
-                if state != state_resp.next_state:
-                    log.msg("State transition for user %s: %s => %s" %
-                            (user_id, state, state_resp.next_state))
-                yield session_manager.save_session(user_id, session)
-
-            for msg, endpoint in state_resp.inbound:
+            elif decision.created:
+                yield session_manager.create_session(
+                    user_id, **decision.session)
+            elif decision.session_update:
+                yield session_manager.save_session(
+                    user_id, decision.session_update)
+            state = decision.session_update.get('state')
+            if state in self.session_state_expiry:
+                yield session_manager.schedule_session_expiry(
+                    user_id, self.session_state_expiry[state])
+            elif (state is not None and not decision.created and
+                    decision.state in self.session_state_expiry):
+                # Leaving a state with its own expiry, so the session gets
+                # back what is left of the expiry it was created with.
+                yield session_manager.schedule_session_expiry(
+                    user_id, self.remaining_session_expiry(
+                        config, decision.session))
+            if self.session_expiry is not None:
+                if decision.cleared:
+                    yield self.untrack_session_expiry(
+                        config, decision, deadline)
+                else:
+                    yield self.track_session_expiry(
+                        config, decision, connector_name, deadline)
+            if not decision.cleared and 'active_endpoint' in decision.session:
+                self.remember_endpoint(
+                    user_id, decision.session['active_endpoint'])
+            if (self.preferences is not None and not decision.cleared and
+                    'active_endpoint' in decision.session_update):
+                yield self.remember_last_endpoint(
+                    config, user_id,
+                    decision.session_update['active_endpoint'], deadline)
+
+            for msg, endpoint in decision.inbound:
                 target = self.find_target(
-                    config, msg, connector_name, session)
+                    config, msg, connector_name, decision.session)
+                if not (yield self.wait_for_capacity(target, deadline)):
+                    log.msg("Endpoint '%s' busy, ending session for user %s"
+                            % (endpoint, user_id))
+                    yield session_manager.clear_session(user_id)
+                    if self.session_expiry is not None:
+                        yield self.untrack_session_expiry(
+                            config, decision, deadline)
+                    decision.clear('busy')
+                    yield self.send_outbound(
+                        config, self.make_busy_reply(msg, config),
+                        connector_name, deadline)
+                    continue
                 yield self.publish_inbound(msg, target[0], target[1])
-            for msg in state_resp.outbound:
-                yield self.process_outbound(config, msg, connector_name)
+                if self.health is not None:
+                    self.health.message_forwarded(endpoint, msg['message_id'])
+                if analytics is not None:
+                    analytics.forwarded(endpoint, user_id)
+            for msg in decision.outbound:
+                yield self.send_outbound(
+                    config, msg, connector_name, deadline)
+            if analytics is not None:
+                analytics.record(decision)
+        except DeadlineExceeded:
+            raise
         except:
             log.err()
             yield session_manager.clear_session(user_id)
-            yield self.process_outbound(
-                config, self.make_error_reply(msg, config), connector_name)
+            if self.session_expiry is not None:
+                yield self.untrack_session_expiry(
+                    config, decision, deadline)
+            yield self.send_outbound(
+                config, self.make_error_reply(decision.msg, config),
+                connector_name, deadline)
 
-    @inlineCallbacks
     def process_outbound(self, config, msg, connector_name):
+        if self.tracer is not None:
+            self.tracer.outbound_received(msg)
+        return self.windowed(self.send_outbound, config, msg, connector_name)
+
+    def send_outbound(self, config, msg, connector_name, deadline=None):
         log.msg("Processing outbound message: %s" % (msg,))
+        if self.health is not None and msg['in_reply_to']:
+            self.health.reply_received(msg['in_reply_to'])
+        if deadline is None:
+            deadline = self.mk_deadline()
+        d = self.route_outbound(config, msg, connector_name, deadline)
+        d.addErrback(self.outbound_timed_out, config, msg, connector_name)
+        return d
+
+    def outbound_timed_out(self, failure, config, msg, connector_name):
+        failure.trap(DeadlineExceeded)
+        self.increment_metric('deadline.outbound.timeouts')
+        outcome = self.deadline_outcome('outbound', 'route')
+        log.warning("Deadline exceeded for outbound message to user %s, "
+                    "outcome: %s" % (msg['to_addr'], outcome))
+        if outcome == 'drop':
+            return
+        target = self.find_target(config, msg, connector_name)
+        if target is not None:
+            return self.publish_outbound(msg, target[0], target[1])
+
+    @inlineCallbacks
+    def route_outbound(self, config, msg, connector_name, deadline):
         user_id = msg['to_addr']
         session_event = msg['session_event']
         session_manager = yield self.session_manager(config)
-        session = yield session_manager.load_session(user_id)
+        session_manager = deadline.bind(session_manager)
+        session = yield self.admission.timed(
+            session_manager.load_session(user_id))
         if session and (session_event == TransportUserMessage.SESSION_CLOSE):
             yield session_manager.clear_session(user_id)
+            if (self.session_expiry is not None and
+                    session.get('state') == self.STATE_SELECTED):
+                yield self.untrack_user_session_expiry(
+                    config, user_id, deadline)
 
-        yield self.cache_outbound_user_id(msg['message_id'],
-                                          msg['to_addr'])
+        yield deadline.call(
+            self.cache_outbound_user_id, msg['message_id'], msg['to_addr'],
+            getattr(config, 'tenant', None))
         target = self.find_target(config, msg, connector_name)
         if target is None:
             return
@@ -291,24 +1363,66 @@ class ApplicationDispatcher(Dispatcher):
         return ':'.join(['cache', message_id])
 
     @inlineCallbacks
-    def cache_outbound_user_id(self, message_id, user_id):
+    def cache_outbound_user_id(self, message_id, user_id, tenant=None):
         key = self.mk_msg_key(message_id)
+        if tenant is not None:
+            user_id = json.dumps([tenant, user_id])
         yield self.redis.setex(
             key, self.get_static_config().message_expiry, user_id)
 
-    def get_cached_user_id(self, message_id):
-        return self.redis.get(self.mk_msg_key(message_id))
+    @inlineCallbacks
+    def get_cached_user(self, message_id):
+        """
+        Return the tenant (or ``None``) and the user id of the user a
+        message was sent to.
+        """
+        value = yield self.redis.get(self.mk_msg_key(message_id))
+        if value is not None and value.startswith('['):
+            returnValue(tuple(json.loads(value)))
+        returnValue((None, value))
 
     @inlineCallbacks
+    def get_cached_user_id(self, message_id):
+        _, user_id = yield self.get_cached_user(message_id)
+        returnValue(user_id)
+
+    def is_failed_event(self, event):
+        return (event['event_type'] == 'nack' or
+                event.get('delivery_status') == 'failed')
+
     def process_event(self, config, event, connector_name):
-        user_id = yield self.get_cached_user_id(event['user_message_id'])
+        return self.windowed(self.handle_event, config, event, connector_name)
+
+    def handle_event(self, config, event, connector_name):
+        d = self.route_event(config, event, connector_name, self.mk_deadline())
+        d.addErrback(self.event_timed_out, event)
+        return d
+
+    def event_timed_out(self, failure, event):
+        failure.trap(DeadlineExceeded)
+        self.increment_metric('deadline.event.timeouts')
+        log.warning("Deadline exceeded for event %s, dropping it." % (
+            event['event_id'],))
+
+    @inlineCallbacks
+    def route_event(self, config, event, connector_name, deadline):
+        tenant, user_id = yield deadline.call(
+            self.get_cached_user, event['user_message_id'])
+        if (tenant is not None and self.tenants is not None and
+                tenant in self.tenants):
+            config = self.tenants.config(tenant)
         session_manager = yield self.session_manager(config)
-        session = yield session_manager.load_session(user_id)
+        session_manager = deadline.bind(session_manager)
+        session = yield self.admission.timed(
+            session_manager.load_session(user_id))
 
         if not session.get('active_endpoint'):
             target = None
         else:
             target = self.find_target(config, event, connector_name, session)
+            if self.health is not None:
+                self.health.event_received(
+                    session['active_endpoint'], self.is_failed_event(event))
 
         if target is None:
             return
@@ -325,24 +1439,24 @@ class MessengerApplicationDispatcher(ApplicationDispatcher):
 
     CONFIG_CLASS = MessengerApplicationDispatcherConfig
 
-    def make_first_reply(self, config, session, msg):
-        msg = super(MessengerApplicationDispatcher, self).make_first_reply(
-            config, session, msg)
+    def make_menu_reply(self, config, session, msg, page):
+        msg = super(MessengerApplicationDispatcher, self).make_menu_reply(
+            config, session, msg, page)
 
         # Magically render a Messenger menu if less than 3 items.
-        if len(config.entries) <= 3:
+        if len(page.labels) <= 3:
             msg['helper_metadata']['messenger'] = {
                 'template_type': 'generic',
-                'title': config.menu_title,
+                'title': page.title,
                 'subtitle': config.sub_title,
                 'image_url': urlunparse(config.image_url),
                 'buttons': [{
-                    'title': entry['label'],
+                    'title': label,
                     'payload': {
                         "content": str(index + 1),
                         "in_reply_to": msg['message_id'],
                     }
-                } for (index, entry) in enumerate(config.entries)]
+                } for (index, label) in enumerate(page.labels)]
             }
         return msg
 
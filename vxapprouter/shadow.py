@@ -0,0 +1,101 @@
+# -*- test-case-name: vxapprouter.tests.test_shadow -*-
+import time
+
+from twisted.internet.defer import Deferred
+
+from vxapprouter.snapshot import ConfigSnapshot
+
+
+class ShadowEvaluator(object):
+    """
+    Decides inbound messages again with a candidate config and reports
+    how the decisions differ from the live ones.
+
+    The candidate decision is never carried out, or logged. Its state
+    handlers are the live ones, called with the candidate config and a
+    copy of the session the live decision started from. If the user is on
+    a page of the live menu, the copy is moved to the page the candidate
+    menu has at the same place, so that only changes to that page or the
+    choices on it are reported.
+    """
+
+    DIVERGENCES = ('target', 'terminate', 'reply', 'error')
+
+    def __init__(self, machine, config_class, base_config, candidate):
+        self.machine = machine
+        self.live_config = ConfigSnapshot(
+            config_class(dict(base_config)), tenant=None)
+        config_data = dict(base_config)
+        config_data.update(candidate)
+        self.config = ConfigSnapshot(
+            config_class(config_data), tenant=None, log_decisions=False)
+        self.evaluated = 0
+        self.seconds = 0.0
+
+    def decide(self, msg, session, last_endpoint=None):
+        """
+        Return the candidate decision, or ``None`` if a state handler
+        failed or is asynchronous.
+        """
+        decision = self.machine.begin(
+            self.config, msg, self.candidate_session(session), last_endpoint)
+        if decision.closed:
+            return decision
+        try:
+            state_resp = self.machine.handlers[decision.state](
+                self.config, decision.session, msg)
+        except Exception:
+            return None
+        if isinstance(state_resp, Deferred):
+            return None
+        return self.machine.conclude(decision, state_resp)
+
+    def candidate_session(self, session):
+        """
+        Return a copy of ``session`` with its live menu page replaced by
+        the matching page of the candidate menu, if there is one.
+        """
+        session = dict(session)
+        live_plan = self.machine.get_menu_plan(self.live_config)
+        if session.get('menu_version') != live_plan.version:
+            return session
+        path = live_plan.page_path(session.get('menu_page'))
+        if path is None:
+            return session
+        plan = self.machine.get_menu_plan(self.config)
+        page_id = plan.follow_path(path)
+        if page_id is not None:
+            session['menu_page'] = page_id
+            session['menu_version'] = plan.version
+        return session
+
+    def evaluate(self, msg, session, live, last_endpoint=None):
+        """
+        Decide ``msg`` with the candidate config and compare the result to
+        the ``live`` decision. Returns the kinds of divergence found, from
+        :attr:`DIVERGENCES`, and the time the evaluation took.
+        """
+        started = time.time()
+        candidate = self.decide(msg, session, last_endpoint)
+        seconds = time.time() - started
+        self.evaluated += 1
+        self.seconds += seconds
+        if candidate is None:
+            return ['error'], seconds
+        divergences = []
+        if endpoints(candidate) != endpoints(live):
+            divergences.append('target')
+        if candidate.cleared and not live.cleared:
+            divergences.append('terminate')
+        if replies(candidate) != replies(live):
+            divergences.append('reply')
+        return divergences, seconds
+
+
+def endpoints(decision):
+    return [endpoint for _, endpoint in decision.inbound]
+
+
+def replies(decision):
+    return [(reply['content'], reply['session_event'])
+            for reply in decision.outbound]
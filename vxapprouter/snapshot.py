@@ -0,0 +1,65 @@
+# -*- test-case-name: vxapprouter.tests.test_snapshot -*-
+
+
+class FrozenDict(dict):
+    """
+    A dict that cannot be modified.
+    """
+
+    def _immutable(self, *args, **kw):
+        raise TypeError("%s is immutable" % (type(self).__name__,))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    """
+    Return an immutable copy of a config value. Dicts become
+    :class:`FrozenDict` and lists become tuples.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class ConfigSnapshot(object):
+    """
+    The resolved values of all the fields of a :class:`vumi.config.Config`.
+
+    Field lookups on a ``Config`` find, clean and (for lists and dicts)
+    deep copy the value every time. A snapshot does that once and then
+    behaves like a plain, read-only object. Any ``extra`` keyword
+    arguments are added as attributes.
+
+    Menus compiled from a snapshot can be cached on it, in the
+    ``_menu_plans`` dict, since its menu fields never change.
+    """
+
+    def __init__(self, config, **extra):
+        values = {}
+        for field in config._get_fields():
+            if config.static and not field.static:
+                continue
+            values[field.name] = freeze(getattr(config, field.name))
+        values['static'] = config.static
+        values.update(extra)
+        values['_menu_plans'] = {}
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config fields are read-only.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Config fields are read-only.")
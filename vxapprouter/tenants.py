@@ -0,0 +1,131 @@
+# -*- test-case-name: vxapprouter.tests.test_tenants -*-
+import json
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi import log
+from vumi.message import TransportEvent
+
+from vxapprouter.snapshot import ConfigSnapshot
+
+
+class TenantRegistry(object):
+    """
+    The router configs of the tenants served by a multi-tenant worker.
+
+    A tenant's config is merged over the worker's own config. It is used
+    for user messages to or from one of the tenant's ``to_addrs`` and, if
+    no tenant claims the address, for messages and events from one of its
+    ``transport_names``.
+
+    Tenants given to :meth:`add` are stored in a hash in ``redis``, so
+    that every worker sharing it picks them up on its next :meth:`load`.
+    Each tenant also gets its own Redis namespace for session data.
+    """
+
+    REDIS_KEY = 'registry'
+    SELECTORS = ('to_addrs', 'transport_names')
+
+    def __init__(self, config_class, base_config, redis, tenants=None):
+        self.config_class = config_class
+        self.base_config = base_config
+        self.redis = redis
+        self.static_tenants = tenants or {}
+        self.tenant_data = {}
+        self.configs = {}
+        self.by_addr = {}
+        self.by_transport = {}
+        self._namespaces = {}
+        self.rebuild(self.static_tenants)
+
+    def __len__(self):
+        return len(self.configs)
+
+    def __contains__(self, name):
+        return name in self.configs
+
+    def build_config(self, name, data):
+        config_data = dict(self.base_config)
+        config_data.update(
+            (k, v) for k, v in data.items() if k not in self.SELECTORS)
+        return ConfigSnapshot(self.config_class(config_data), tenant=name)
+
+    def rebuild(self, tenant_data, base_config=None):
+        """
+        Replace all tenants with the ones in ``tenant_data``. Tenants with
+        an invalid config are logged and left out.
+        """
+        if base_config is not None:
+            self.base_config = base_config
+        configs = {}
+        for name, data in tenant_data.items():
+            try:
+                configs[name] = self.build_config(name, data)
+            except Exception:
+                log.err(None, "Invalid config for tenant %r" % (name,))
+        self.tenant_data = dict(
+            (name, tenant_data[name]) for name in configs)
+        self.configs = configs
+        self.by_addr = self._index('to_addrs')
+        self.by_transport = self._index('transport_names')
+
+    def _index(self, selector):
+        index = {}
+        for name in sorted(self.tenant_data):
+            for value in self.tenant_data[name].get(selector, []):
+                index.setdefault(value, name)
+        return index
+
+    @inlineCallbacks
+    def load(self):
+        """
+        Reload the tenants stored in Redis.
+        """
+        stored = yield self.redis.hgetall(self.REDIS_KEY)
+        tenant_data = dict(self.static_tenants)
+        for name, data in stored.items():
+            tenant_data[name] = json.loads(data)
+        self.rebuild(tenant_data)
+
+    @inlineCallbacks
+    def add(self, name, data):
+        """
+        Add or replace a tenant. Raises a ConfigError if its config is
+        invalid.
+        """
+        self.build_config(name, data)
+        yield self.redis.hset(self.REDIS_KEY, name, json.dumps(data))
+        yield self.load()
+
+    @inlineCallbacks
+    def remove(self, name):
+        """
+        Remove a tenant. Tenants from the worker's config are only removed
+        from this worker.
+        """
+        yield self.redis.hdel(self.REDIS_KEY, name)
+        self.static_tenants.pop(name, None)
+        yield self.load()
+
+    def config(self, name):
+        return self.configs.get(name)
+
+    def match(self, msg):
+        """
+        Return the config of the tenant ``msg`` belongs to, or ``None``.
+        """
+        name = None
+        if not isinstance(msg, TransportEvent):
+            name = (self.by_addr.get(msg.get('to_addr')) or
+                    self.by_addr.get(msg.get('from_addr')))
+        if name is None:
+            name = self.by_transport.get(msg.get('transport_name'))
+        return self.configs.get(name)
+
+    def namespace(self, name):
+        """
+        Return the Redis manager for data belonging to tenant ``name``.
+        """
+        if name not in self._namespaces:
+            self._namespaces[name] = self.redis.sub_manager(name)
+        return self._namespaces[name]
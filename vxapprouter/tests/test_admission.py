@@ -0,0 +1,58 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.tests.helpers import MessageHelper
+
+from vxapprouter.admission import AdmissionController
+
+
+class TestAdmissionController(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.msg_helper = MessageHelper()
+
+    def mk_msg(self, session_event):
+        return self.msg_helper.make_inbound(
+            'hi', session_event=session_event)
+
+    def test_in_flight(self):
+        controller = AdmissionController(self.clock, max_in_flight=1)
+        self.assertTrue(controller.admit(self.mk_msg('new')))
+        d = controller.track(Deferred())
+        self.assertEqual(controller.in_flight, 1)
+        self.assertFalse(controller.admit(self.mk_msg('new')))
+        self.assertTrue(controller.admit(self.mk_msg('resume')))
+        d.callback(None)
+        self.assertEqual(controller.in_flight, 0)
+        self.assertTrue(controller.admit(self.mk_msg('new')))
+
+    def test_redis_latency(self):
+        controller = AdmissionController(
+            self.clock, max_redis_latency=1.0, smoothing=0.5)
+        d = controller.timed(Deferred())
+        self.clock.advance(3)
+        d.callback(None)
+        self.assertEqual(controller.redis_latency, 3.0)
+        self.assertFalse(controller.admit(self.mk_msg('new')))
+        controller.record_latency(0.0)
+        self.assertEqual(controller.redis_latency, 1.5)
+        controller.record_latency(0.0)
+        self.assertEqual(controller.redis_latency, 0.75)
+        self.assertTrue(controller.admit(self.mk_msg('new')))
+
+    def test_stale_latency_ignored(self):
+        controller = AdmissionController(
+            self.clock, max_redis_latency=1.0, latency_window=10)
+        controller.record_latency(5.0)
+        self.assertFalse(controller.admit(self.mk_msg('new')))
+        self.clock.advance(11)
+        self.assertEqual(controller.redis_latency, 0.0)
+        self.assertTrue(controller.admit(self.mk_msg('new')))
+
+    def test_disabled(self):
+        controller = AdmissionController(self.clock)
+        controller.track(Deferred())
+        controller.record_latency(100)
+        self.assertTrue(controller.admit(self.mk_msg('new')))
@@ -0,0 +1,67 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.analytics import RoutingAnalytics
+from vxapprouter.core import Decision
+
+
+class TestRoutingAnalytics(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.clock.advance(7200)
+        self.analytics = RoutingAnalytics(
+            self.clock, self.redis, bucket_size=3600)
+
+    def mk_decision(self, user_id='123'):
+        msg = TransportUserMessage(
+            to_addr='*120*1#', from_addr=user_id, transport_name='transport',
+            transport_type='ussd')
+        return Decision(msg, 'select', {})
+
+    def test_record(self):
+        decision = self.mk_decision()
+        decision.update({'state': 'selected', 'active_endpoint': 'app'})
+        self.analytics.record(decision)
+        decision = self.mk_decision()
+        decision.update({'state': 'bad_input'})
+        self.analytics.record(decision)
+        decision = self.mk_decision()
+        decision.clear('error')
+        self.analytics.record(decision)
+        self.assertEqual(dict(self.analytics.counts), {
+            (7200, 'app', 'selected'): 1,
+            (7200, 'menu', 'bad_input'): 1,
+            (7200, 'menu', 'ended.error'): 1,
+        })
+
+    @inlineCallbacks
+    def test_flush_and_query(self):
+        self.analytics.forwarded('app', '123')
+        self.analytics.forwarded('app', '123')
+        self.analytics.forwarded('app', '456')
+        self.analytics.count('menu', 'bad_input')
+        yield self.analytics.flush()
+        self.assertEqual(dict(self.analytics.counts), {})
+        self.assertEqual(dict(self.analytics.users), {})
+
+        self.clock.advance(3600)
+        self.analytics.forwarded('app', '123')
+        yield self.analytics.flush()
+
+        results = yield self.analytics.query(0, self.clock.seconds())
+        self.assertEqual(results, {
+            7200: {
+                'app': {'forwarded': 3, 'users': 2},
+                'menu': {'bad_input': 1},
+            },
+            10800: {'app': {'forwarded': 1, 'users': 1}},
+        })
+        ttl = yield self.redis.ttl('counts:7200')
+        self.assertTrue(0 < ttl <= self.analytics.ttl)
@@ -0,0 +1,80 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxapprouter.batch import Batcher
+
+
+class TestBatcher(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.batches = []
+
+    def flush(self, items):
+        self.batches.append(items)
+        return [succeed(i * 2) for i in items]
+
+    def test_flush_after_delay(self):
+        batcher = Batcher(self.clock, self.flush, max_size=3, max_delay=1)
+        d1 = batcher.add(1)
+        d2 = batcher.add(2)
+        self.assertEqual(self.batches, [])
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [[1, 2]])
+        self.assertEqual(self.successResultOf(d1), 2)
+        self.assertEqual(self.successResultOf(d2), 4)
+
+    def test_flush_when_full(self):
+        batcher = Batcher(self.clock, self.flush, max_size=2, max_delay=1)
+        batcher.add(1)
+        d = batcher.add(2)
+        self.assertEqual(self.batches, [[1, 2]])
+        self.assertEqual(self.successResultOf(d), 4)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_one_batch_at_a_time(self):
+        results = []
+
+        def flush(items):
+            self.batches.append(items)
+            ds = [Deferred() for _ in items]
+            results.extend(zip(ds, items))
+            return ds
+
+        batcher = Batcher(self.clock, flush, max_size=2, max_delay=1)
+        d1 = batcher.add(1)
+        batcher.add(2)
+        d3 = batcher.add(3)
+        batcher.add(4)
+        batcher.add(5)
+        self.assertEqual(self.batches, [[1, 2]])
+        self.assertNoResult(d1)
+
+        for d, item in results[:2]:
+            d.callback(item)
+        self.assertEqual(self.successResultOf(d1), 1)
+        self.assertEqual(self.batches, [[1, 2], [3, 4]])
+        self.assertNoResult(d3)
+        for d, item in results[2:]:
+            d.callback(item)
+        self.assertEqual(self.successResultOf(d3), 3)
+        self.assertEqual(self.batches, [[1, 2], [3, 4]])
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [[1, 2], [3, 4], [5]])
+
+    def test_flush_errors(self):
+        def flush(items):
+            raise ValueError("bad batch")
+
+        batcher = Batcher(self.clock, flush, max_size=1)
+        d = batcher.add(1)
+        self.failureResultOf(d, ValueError)
+        self.assertFalse(batcher.flushing)
+
+    def test_stop(self):
+        batcher = Batcher(self.clock, self.flush, max_size=3, max_delay=1)
+        d = batcher.add(1)
+        batcher.stop()
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.python import usage
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxapprouter.capacity import (
+    CapacityPlanner, KeyUsage, Options, PlanningDispatcher, project_memory)
+
+
+class SizedPlanner(CapacityPlanner):
+    """
+    FakeRedis has no MEMORY USAGE, so keys are sized by their name.
+    """
+
+    def memory_usage(self, key):
+        return succeed(len(key))
+
+
+class TestCapacityPlanner(VumiTestCase):
+
+    @inlineCallbacks
+    def get_dispatcher(self, **config_extras):
+        config = {
+            'redis_manager': {'FAKE_REDIS': True},
+            'entries': [
+                {'label': 'Flappy Bird', 'endpoint': 'flappy-bird'},
+            ],
+            'routing_table': {
+                'transport': {
+                    'flappy-bird': ['app1', 'default'],
+                    'default': ['transport', 'default'],
+                },
+                'app1': {'default': ['transport', 'default']},
+            },
+            'receive_inbound_connectors': ['transport'],
+            'receive_outbound_connectors': ['app1'],
+        }
+        config.update(config_extras)
+        dispatcher = PlanningDispatcher({}, config)
+        yield dispatcher.setup_dispatcher()
+        self.add_cleanup(dispatcher.teardown_dispatcher)
+        returnValue(dispatcher)
+
+    @inlineCallbacks
+    def test_run(self):
+        dispatcher = yield self.get_dispatcher(session_expiry=300)
+        planner = SizedPlanner(
+            dispatcher, messages_per_session=3, events_per_message=2,
+            samples=2)
+        usages = yield planner.run()
+
+        # Each session gets the menu, then one reply from the application
+        # for each of the two messages forwarded to it.
+        self.assertEqual(planner.outbound_messages, 6)
+        self.assertEqual(planner.events, 12)
+        self.assertEqual(sorted(usages), ['cache', 'session'])
+        self.assertEqual(usages['session'].keys, 1)
+        self.assertTrue(290 <= usages['session'].ttl <= 300)
+        self.assertEqual(
+            usages['session'].bytes,
+            len('application_dispatcher:session:+999000000000'))
+        self.assertEqual(usages['cache'].keys, 3)
+        self.assertTrue(
+            2 * 24 * 60 * 60 - 10 <= usages['cache'].ttl <= 2 * 24 * 60 * 60)
+
+        rates = planner.command_rates(10)
+        self.assertEqual(rates['setex'], 30)
+        self.assertEqual(rates['get'], 60)
+
+        # The sample keys are removed.
+        keys = yield dispatcher.redis.keys()
+        self.assertEqual(keys, [])
+
+    @inlineCallbacks
+    def test_existing_keys(self):
+        """
+        Keys that existed before the sample sessions are neither measured
+        nor removed.
+        """
+        dispatcher = yield self.get_dispatcher(
+            analytics={'flush_interval': 10})
+        yield dispatcher.redis.set('other', 'value')
+        yield dispatcher.redis.hset('session:+999000000001', 'state', 'x')
+        planner = SizedPlanner(dispatcher, messages_per_session=2, samples=2)
+        usages = yield planner.run()
+        self.assertEqual(usages['session'].keys, 0.5)
+        keys = yield dispatcher.redis.keys()
+        self.assertEqual(sorted(keys), ['other', 'session:+999000000001'])
+
+    def test_project_memory(self):
+        usages = {
+            'session': KeyUsage(keys=1, bytes=200, ttl=300),
+            'cache': KeyUsage(keys=3, bytes=100, ttl=3600),
+            'other': KeyUsage(keys=1, bytes=100, ttl=None),
+        }
+        self.assertEqual(project_memory(usages, 10, 60), {
+            'session': (600, 120000),
+            'cache': (108000, 10800000),
+            'other': None,
+        })
+
+
+class TestOptions(VumiTestCase):
+
+    def mk_config(self, redis_manager):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'config.yaml')
+        with open(path, 'w') as f:
+            f.write('redis_manager: %s\n' % (redis_manager,))
+        return path
+
+    def test_options(self):
+        options = Options()
+        options.parseOptions([
+            '--sessions', '2.5', '-m', '3', '--redis', 'localhost:6380/2',
+            self.mk_config('{key_prefix: vumi, host: production}')])
+        self.assertEqual(options['sessions'], 2.5)
+        self.assertEqual(options['messages-per-session'], 3)
+        self.assertEqual(options['session-duration'], None)
+        self.assertEqual(options['config']['redis_manager'], {
+            'host': 'localhost', 'port': 6380, 'db': 2, 'key_prefix': 'vumi'})
+
+    def test_redis_required(self):
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions,
+            [self.mk_config('{}')])
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions,
+            ['--redis', 'localhost:redis', self.mk_config('{}')])
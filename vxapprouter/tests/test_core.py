@@ -0,0 +1,161 @@
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportUserMessage
+
+from vxapprouter import core
+from vxapprouter.core import StateMachine
+from vxapprouter.router import ApplicationDispatcherConfig
+from vxapprouter.snapshot import ConfigSnapshot
+
+
+class TestStateMachine(TestCase):
+
+    CONFIG = {
+        'error_message': 'Oops!',
+        'entries': [{'label': 'Flappy Bird', 'endpoint': 'flappy-bird'}],
+        'routing_table': {},
+        'receive_inbound_connectors': ['transport'],
+        'receive_outbound_connectors': ['app1'],
+    }
+
+    def setUp(self):
+        self.machine = StateMachine()
+        self.machine.setup_state_machine()
+        self.config = ApplicationDispatcherConfig(self.CONFIG)
+        self.version = self.machine.get_menu_plan(self.config).version
+
+    def mk_msg(self, content, session_event='resume', from_addr='123'):
+        return TransportUserMessage(
+            to_addr='*120*1#', from_addr=from_addr, content=content,
+            session_event=session_event, transport_name='transport',
+            transport_type='ussd')
+
+    def test_new_session(self):
+        decision = self.machine.decide(
+            self.config, self.mk_msg(None, 'new'), {})
+        self.assertTrue(decision.created)
+        self.assertEqual(decision.session, {
+            'state': 'select',
+            'menu_page': '0',
+            'menu_version': self.version,
+        })
+        [reply] = decision.outbound
+        self.assertEqual(
+            reply['content'], 'Please select a choice.\n1) Flappy Bird')
+        self.assertEqual(decision.inbound, [])
+
+    def test_select(self):
+        session = {
+            'state': 'select', 'menu_page': '0',
+            'menu_version': self.version,
+        }
+        decision = self.machine.decide(
+            self.config, self.mk_msg('1'), session)
+        self.assertFalse(decision.created)
+        self.assertEqual(decision.session_update, {
+            'state': 'selected',
+            'active_endpoint': 'flappy-bird',
+        })
+        [(msg, endpoint)] = decision.inbound
+        self.assertEqual(endpoint, 'flappy-bird')
+        self.assertEqual(msg['session_event'], 'new')
+
+    def test_close(self):
+        session = {'state': 'selected', 'active_endpoint': 'flappy-bird'}
+        msg = self.mk_msg(None, 'close')
+        decision = self.machine.decide(self.config, msg, session)
+        self.assertTrue(decision.closed)
+        self.assertTrue(decision.cleared)
+        self.assertEqual(decision.inbound, [(msg, 'flappy-bird')])
+
+    def test_handler_error(self):
+        session = {'state': 'selected', 'active_endpoint': 'flappy-bird'}
+
+        def target_endpoints(config):
+            raise RuntimeError("An anomaly has been detected")
+
+        self.patch(self.machine, 'target_endpoints', target_endpoints)
+        decision = self.machine.decide(
+            self.config, self.mk_msg('hi'), session)
+        self.assertTrue(decision.cleared)
+        [reply] = decision.outbound
+        self.assertEqual(reply['content'], 'Oops!')
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_decide_batch(self):
+        decisions = self.machine.decide_batch(self.config, [
+            self.mk_msg(None, 'new'),
+            self.mk_msg(None, 'new', from_addr='456'),
+            self.mk_msg('1'),
+        ], [{}, {}, {}])
+        self.assertEqual(
+            [d.user_id for d in decisions], ['123', '456', '123'])
+        self.assertTrue(decisions[0].created)
+        self.assertTrue(decisions[1].created)
+        self.assertFalse(decisions[2].created)
+        self.assertEqual(decisions[2].session['state'], 'selected')
+
+    def test_returning_user(self):
+        """
+        New sessions for users whose last endpoint is remembered offer it
+        before the menu, or select it straight away.
+        """
+        self.patch(self.machine, 'resume_mode', lambda: 'prompt')
+        decision = self.machine.decide(
+            self.config, self.mk_msg(None, 'new'), {}, 'flappy-bird')
+        self.assertEqual(decision.session, {
+            'state': 'continue', 'last_endpoint': 'flappy-bird'})
+        [reply] = decision.outbound
+        self.assertEqual(reply['content'], '\n'.join([
+            'Welcome back! Continue with Flappy Bird?',
+            '1) Continue',
+            '2) Main menu',
+        ]))
+        decision = self.machine.decide(
+            self.config, self.mk_msg('1'), decision.session)
+        self.assertEqual(decision.session['state'], 'selected')
+        [(_, endpoint)] = decision.inbound
+        self.assertEqual(endpoint, 'flappy-bird')
+
+        self.patch(self.machine, 'resume_mode', lambda: 'route')
+        decision = self.machine.decide(
+            self.config, self.mk_msg(None, 'new'), {}, 'flappy-bird')
+        self.assertEqual(decision.session['state'], 'selected')
+        self.assertEqual(decision.outbound, [])
+        [(msg, endpoint)] = decision.inbound
+        self.assertEqual(endpoint, 'flappy-bird')
+        self.assertEqual(msg['session_event'], 'new')
+
+    def test_returning_user_menu(self):
+        """
+        Returning users can ask for the menu, and are shown it if their
+        last endpoint is no longer on it.
+        """
+        self.patch(self.machine, 'resume_mode', lambda: 'prompt')
+        session = {'state': 'continue', 'last_endpoint': 'flappy-bird'}
+        decision = self.machine.decide(self.config, self.mk_msg('2'), session)
+        self.assertEqual(decision.session['state'], 'select')
+        [reply] = decision.outbound
+        self.assertEqual(
+            reply['content'], 'Please select a choice.\n1) Flappy Bird')
+
+        self.patch(self.machine, 'resume_mode', lambda: 'route')
+        decision = self.machine.decide(
+            self.config, self.mk_msg(None, 'new'), {}, 'angry-birds')
+        self.assertEqual(decision.session['state'], 'select')
+        self.assertEqual(decision.inbound, [])
+
+    def test_snapshot_menu_plan(self):
+        """
+        Menu plans are cached on config snapshots, so that later lookups
+        do not fingerprint the menu.
+        """
+        config = ConfigSnapshot(self.config)
+        plan = self.machine.get_menu_plan(config)
+        hidden = self.machine.get_menu_plan(config, exclude=['flappy-bird'])
+        self.patch(core, 'menu_fingerprint', lambda *a: self.fail())
+        self.assertIs(self.machine.get_menu_plan(config), plan)
+        self.assertIs(self.machine.get_menu_plan(
+            config, exclude=frozenset(['flappy-bird'])), hidden)
+        self.assertEqual(plan.endpoints, frozenset(['flappy-bird']))
+        self.assertEqual(hidden.endpoints, frozenset())
@@ -0,0 +1,75 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxapprouter.deadline import Deadline, DeadlineExceeded
+
+
+class Thing(object):
+    colour = 'red'
+
+    def __init__(self):
+        self.pending = Deferred()
+
+    def slow(self):
+        return self.pending
+
+    def fast(self, value):
+        return succeed(value)
+
+
+class TestDeadline(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_call_completes(self):
+        deadline = Deadline(self.clock, 5)
+        d = deadline.call(lambda x: x * 2, 21)
+        self.assertEqual(self.successResultOf(d), 42)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_call_exceeds_deadline(self):
+        deadline = Deadline(self.clock, 5)
+        pending = Deferred()
+        d = deadline.call(lambda: pending)
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, DeadlineExceeded)
+        self.assertTrue(pending.called)
+
+    def test_call_after_deadline(self):
+        deadline = Deadline(self.clock, 5)
+        self.clock.advance(5)
+        calls = []
+        d = deadline.call(calls.append, 'x')
+        self.failureResultOf(d, DeadlineExceeded)
+        self.assertEqual(calls, [])
+
+    def test_remaining_is_shared(self):
+        deadline = Deadline(self.clock, 5)
+        self.clock.advance(3)
+        self.assertEqual(deadline.remaining(), 2)
+        d = deadline.call(Deferred)
+        self.clock.advance(2)
+        self.failureResultOf(d, DeadlineExceeded)
+
+    def test_no_timeout(self):
+        deadline = Deadline(self.clock)
+        self.assertEqual(deadline.remaining(), None)
+        pending = Deferred()
+        d = deadline.call(lambda: pending)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        pending.callback('done')
+        self.assertEqual(self.successResultOf(d), 'done')
+
+    def test_bind(self):
+        deadline = Deadline(self.clock, 5)
+        thing = Thing()
+        proxy = deadline.bind(thing)
+        self.assertEqual(proxy.colour, 'red')
+        self.assertEqual(self.successResultOf(proxy.fast('x')), 'x')
+        d = proxy.slow()
+        self.clock.advance(5)
+        self.failureResultOf(d, DeadlineExceeded)
@@ -0,0 +1,103 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.dedup import BloomFilter, Deduplicator
+
+
+class TestBloomFilter(VumiTestCase):
+
+    def test_add(self):
+        bloom = BloomFilter(100, 0.01)
+        self.assertFalse('foo' in bloom)
+        bloom.add('foo')
+        self.assertTrue('foo' in bloom)
+        self.assertFalse('bar' in bloom)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('seen-%s' % (i,))
+        self.assertTrue(bloom.full())
+        false_positives = sum(
+            1 for i in range(1000) if 'unseen-%s' % (i,) in bloom)
+        self.assertTrue(false_positives < 30)
+
+
+class TestDeduplicator(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    @inlineCallbacks
+    def test_local(self):
+        dedup = Deduplicator(self.clock, ttl=10)
+        self.assertFalse((yield dedup.is_duplicate(u'msg1')))
+        self.assertTrue((yield dedup.is_duplicate(u'msg1')))
+        self.assertFalse((yield dedup.is_duplicate(u'msg2')))
+
+    @inlineCallbacks
+    def test_expiry(self):
+        dedup = Deduplicator(self.clock, ttl=10)
+        yield dedup.is_duplicate(u'msg1')
+        self.clock.advance(10)
+        self.assertTrue((yield dedup.is_duplicate(u'msg1')))
+        self.clock.advance(10)
+        self.assertFalse((yield dedup.is_duplicate(u'msg1')))
+
+    @inlineCallbacks
+    def test_shared(self):
+        persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield persistence_helper.get_redis_manager()
+        dedup1 = Deduplicator.from_config(self.clock, {'ttl': 10}, redis)
+        dedup2 = Deduplicator.from_config(self.clock, {'ttl': 10}, redis)
+        self.assertFalse((yield dedup1.is_duplicate(u'msg1')))
+        self.assertTrue((yield dedup2.is_duplicate(u'msg1')))
+        self.assertEqual((yield redis.ttl(u'msg1')), 10)
+
+    @inlineCallbacks
+    def test_not_shared(self):
+        persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield persistence_helper.get_redis_manager()
+        dedup1 = Deduplicator.from_config(
+            self.clock, {'shared': False}, redis)
+        dedup2 = Deduplicator.from_config(
+            self.clock, {'shared': False}, redis)
+        self.assertFalse((yield dedup1.is_duplicate(u'msg1')))
+        self.assertFalse((yield dedup2.is_duplicate(u'msg1')))
+
+    @inlineCallbacks
+    def test_approximate(self):
+        """
+        Local ids are only kept in Bloom filters, which have false
+        positives, if that is asked for.
+        """
+        exact = Deduplicator.from_config(
+            self.clock, {'shared': False, 'capacity': 10})
+        approximate = Deduplicator.from_config(
+            self.clock, {'shared': False, 'approximate': True,
+                         'capacity': 10, 'error_rate': 0.5})
+        self.assertFalse(exact.approximate)
+        self.assertTrue(approximate.approximate)
+        dropped = {False: 0, True: 0}
+        for i in range(9):
+            for dedup in (exact, approximate):
+                if (yield dedup.is_duplicate(u'msg%s' % (i,))):
+                    dropped[dedup.approximate] += 1
+        self.assertEqual(dropped[False], 0)
+        self.assertTrue(dropped[True] > 0)
+
+    @inlineCallbacks
+    def test_shared_false_positive(self):
+        """
+        Ids found in the local filters are not duplicates unless Redis
+        has them too.
+        """
+        persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield persistence_helper.get_redis_manager()
+        dedup = Deduplicator.from_config(self.clock, {'ttl': 10}, redis)
+        self.patch(dedup, 'seen_locally', lambda key: True)
+        self.assertFalse((yield dedup.is_duplicate(u'msg1')))
+        self.assertTrue((yield dedup.is_duplicate(u'msg1')))
+        self.assertEqual((yield redis.ttl(u'msg1')), 10)
@@ -0,0 +1,114 @@
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.expiry import SessionExpiry, TimerWheel
+
+
+class TestTimerWheel(TestCase):
+
+    def test_advance(self):
+        wheel = TimerWheel(100, resolution=1, slots=8)
+        wheel.schedule('a', 102.5)
+        wheel.schedule('b', 103)
+        wheel.schedule('c', 120)
+        self.assertEqual(wheel.advance(102.9), [])
+        self.assertEqual(sorted(wheel.advance(103)), ['a', 'b'])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(111), [])
+        self.assertEqual(wheel.advance(125), ['c'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_schedule_in_past(self):
+        """
+        Keys scheduled for a deadline that has passed are due on the next
+        tick.
+        """
+        wheel = TimerWheel(100, resolution=1, slots=8)
+        wheel.schedule('a', 50)
+        self.assertEqual(wheel.advance(100.5), [])
+        self.assertEqual(wheel.advance(101), ['a'])
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel(100, resolution=1, slots=8)
+        wheel.schedule('a', 102)
+        wheel.schedule('a', 105)
+        wheel.schedule('b', 102)
+        wheel.cancel('b')
+        self.assertEqual(wheel.advance(104), [])
+        self.assertTrue('a' in wheel)
+        self.assertEqual(wheel.advance(105), ['a'])
+        self.assertFalse('a' in wheel)
+
+
+class TestSessionExpiry(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.expired = []
+
+    def mk_expiry(self, **kw):
+        expiry = SessionExpiry(
+            self.clock, self.redis,
+            lambda key, record: self.expired.append((key, record)), **kw)
+        self.add_cleanup(expiry.stop)
+        return expiry
+
+    @inlineCallbacks
+    def test_expire(self):
+        expiry = self.mk_expiry()
+        yield expiry.track('123', 1010, {'endpoint': 'app1'})
+        yield expiry.track('456', 1020, {'endpoint': 'app2'})
+        yield expiry.track('789', 1005, {'endpoint': 'app1'})
+        yield expiry.untrack('789')
+        yield expiry.reschedule('456', 1030)
+        self.clock.advance(10)
+        yield expiry.tick()
+        self.assertEqual(self.expired, [('123', {'endpoint': 'app1'})])
+        self.clock.advance(20)
+        yield expiry.tick()
+        self.assertEqual(self.expired[1:], [('456', {'endpoint': 'app2'})])
+        self.assertEqual((yield self.redis.zcard('deadlines')), 0)
+        self.assertEqual((yield self.redis.hgetall('sessions')), {})
+
+    @inlineCallbacks
+    def test_moved_by_other_worker(self):
+        """
+        Sessions are only expired by one worker, at the deadline they have
+        in Redis.
+        """
+        expiry = self.mk_expiry()
+        other = self.mk_expiry()
+        yield expiry.track('123', 1010, {'endpoint': 'app1'})
+        yield other.reschedule('123', 1020)
+        self.clock.advance(10)
+        yield expiry.tick()
+        self.assertEqual(self.expired, [])
+        self.clock.advance(10)
+        yield gatherResults([expiry.tick(), other.tick()])
+        self.assertEqual(self.expired, [('123', {'endpoint': 'app1'})])
+
+    @inlineCallbacks
+    def test_recover(self):
+        """
+        Sessions tracked by a worker that stopped are expired by another
+        once they are overdue.
+        """
+        yield self.mk_expiry().track('123', 1010, {'endpoint': 'app1'})
+        expiry = self.mk_expiry(grace=10, batch_size=2)
+        for i in range(3):
+            yield expiry.redis.zadd('deadlines', **{'u%s' % (i,): 1005})
+            yield expiry.redis.hset('sessions', 'u%s' % (i,), '{}')
+        self.clock.advance(15)
+        yield expiry.recover()
+        self.assertEqual(
+            sorted(key for key, _ in self.expired), ['u0', 'u1', 'u2'])
+        self.clock.advance(5)
+        yield expiry.recover()
+        self.assertEqual(self.expired[3:], [('123', {'endpoint': 'app1'})])
@@ -0,0 +1,84 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxapprouter.health import CircuitBreaker, HealthMonitor
+
+
+class TestHealthMonitor(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_monitor(self, **kw):
+        config = {
+            'reply_timeout': 10,
+            'window': 60,
+            'failure_ratio': 0.5,
+            'minimum_requests': 4,
+            'recovery_time': 30,
+        }
+        config.update(kw)
+        return HealthMonitor.from_config(self.clock, config)
+
+    def test_opens_on_failure_ratio(self):
+        monitor = self.mk_monitor()
+        monitor.event_received('app', failed=False)
+        monitor.event_received('app', failed=True)
+        monitor.event_received('app', failed=False)
+        self.assertTrue(monitor.is_available('app'))
+        monitor.event_received('app', failed=True)
+        self.assertFalse(monitor.is_available('app'))
+        self.assertEqual(monitor.circuit('app').state, CircuitBreaker.OPEN)
+        self.assertTrue(monitor.is_available('other'))
+
+    def test_old_outcomes_expire(self):
+        monitor = self.mk_monitor()
+        for i in range(3):
+            monitor.event_received('app', failed=True)
+        self.clock.advance(61)
+        monitor.event_received('app', failed=True)
+        self.assertTrue(monitor.is_available('app'))
+
+    def test_missing_replies_count_as_failures(self):
+        monitor = self.mk_monitor(minimum_requests=2)
+        monitor.message_forwarded('app', 'msg1')
+        monitor.message_forwarded('app', 'msg2')
+        monitor.message_forwarded('app', 'msg3')
+        monitor.reply_received('msg2')
+        self.clock.advance(9)
+        self.assertTrue(monitor.is_available('app'))
+        self.clock.advance(1)
+        self.assertFalse(monitor.is_available('app'))
+        self.assertEqual(monitor.pending.keys(), [])
+
+    def test_recovery_probe_success(self):
+        monitor = self.mk_monitor(minimum_requests=1)
+        monitor.event_received('app', failed=True)
+        self.assertFalse(monitor.is_available('app'))
+        self.clock.advance(30)
+        self.assertTrue(monitor.is_available('app'))
+        monitor.message_forwarded('app', 'probe')
+        self.assertFalse(monitor.is_available('app'))
+        monitor.reply_received('probe')
+        self.assertTrue(monitor.is_available('app'))
+        self.assertEqual(monitor.circuit('app').state, CircuitBreaker.CLOSED)
+
+    def test_recovery_probe_failure(self):
+        monitor = self.mk_monitor(minimum_requests=1)
+        monitor.event_received('app', failed=True)
+        self.clock.advance(30)
+        self.assertTrue(monitor.is_available('app'))
+        monitor.message_forwarded('app', 'probe')
+        self.clock.advance(10)
+        self.assertFalse(monitor.is_available('app'))
+        self.assertEqual(monitor.circuit('app').state, CircuitBreaker.OPEN)
+        self.clock.advance(30)
+        self.assertTrue(monitor.is_available('app'))
+
+    def test_hidden_endpoints(self):
+        monitor = self.mk_monitor(minimum_requests=1)
+        monitor.event_received('app', failed=True)
+        self.assertEqual(monitor.unavailable_endpoints(), frozenset(['app']))
+        self.assertEqual(monitor.hidden_endpoints(), frozenset())
+        monitor.hide_unavailable = True
+        self.assertEqual(monitor.hidden_endpoints(), frozenset(['app']))
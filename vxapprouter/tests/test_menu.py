@@ -0,0 +1,115 @@
+from twisted.trial.unittest import TestCase
+
+from vxapprouter.menu import MenuPlan, Transition, compile_menu
+
+
+def mk_entries(count, prefix='app'):
+    return [{
+        'label': '%s %s' % (prefix.title(), i),
+        'endpoint': '%s%s' % (prefix, i),
+    } for i in range(count)]
+
+
+class TestCompileMenu(TestCase):
+
+    def test_flat_menu(self):
+        plan = compile_menu('Choose', mk_entries(2))
+        self.assertEqual(plan.root.text, 'Choose\n1) App 0\n2) App 1')
+        self.assertEqual(plan.root.labels, ('App 0', 'App 1'))
+        self.assertEqual(
+            plan.choose(MenuPlan.ROOT, 1),
+            Transition(MenuPlan.ENDPOINT, 'app0'))
+        self.assertEqual(
+            plan.choose(MenuPlan.ROOT, 2),
+            Transition(MenuPlan.ENDPOINT, 'app1'))
+        self.assertEqual(plan.choose(MenuPlan.ROOT, 3), None)
+        self.assertEqual(plan.endpoints, frozenset(['app0', 'app1']))
+
+    def test_sub_menu(self):
+        plan = compile_menu('Choose', [
+            {'label': 'Games', 'entries': mk_entries(2, 'game')},
+            {'label': 'Apps', 'title': 'Pick an app',
+             'entries': mk_entries(1)},
+        ])
+        self.assertEqual(plan.root.text, 'Choose\n1) Games\n2) Apps')
+
+        games = plan.page(plan.choose(MenuPlan.ROOT, 1).target)
+        self.assertEqual(games.text, 'Games\n1) Game 0\n2) Game 1\n3) Back')
+        self.assertEqual(
+            plan.choose(games.page_id, 2),
+            Transition(MenuPlan.ENDPOINT, 'game1'))
+        self.assertEqual(
+            plan.choose(games.page_id, 3),
+            Transition(MenuPlan.PAGE, MenuPlan.ROOT))
+
+        apps = plan.page(plan.choose(MenuPlan.ROOT, 2).target)
+        self.assertEqual(apps.text, 'Pick an app\n1) App 0\n2) Back')
+        self.assertEqual(
+            plan.endpoints, frozenset(['game0', 'game1', 'app0']))
+
+    def test_pagination(self):
+        plan = compile_menu('Choose', mk_entries(5), max_length=32)
+        pages = [plan.root]
+        while 'More' in pages[-1].labels:
+            more = pages[-1].labels.index('More') + 1
+            pages.append(plan.page(
+                plan.choose(pages[-1].page_id, more).target))
+        self.assertEqual([page.text for page in pages], [
+            'Choose\n1) App 0\n2) App 1\n3) More',
+            'Choose\n1) App 2\n2) More\n3) Back',
+            'Choose\n1) App 3\n2) App 4\n3) Back',
+        ])
+        self.assertTrue(all(len(page.text) <= 32 for page in pages))
+        self.assertEqual(
+            plan.choose(pages[2].page_id, 1),
+            Transition(MenuPlan.ENDPOINT, 'app3'))
+        self.assertEqual(
+            plan.choose(pages[2].page_id, 3),
+            Transition(MenuPlan.PAGE, pages[1].page_id))
+
+    def test_pagination_keeps_oversized_entries(self):
+        plan = compile_menu('Choose', mk_entries(2), max_length=5)
+        self.assertEqual(plan.root.text, 'Choose\n1) App 0\n2) More')
+
+    def test_pagination_disabled(self):
+        plan = compile_menu('Choose', mk_entries(20), max_length=0)
+        self.assertEqual(len(plan.pages), 1)
+        self.assertEqual(len(plan.root.labels), 20)
+
+    def test_exclude(self):
+        plan = compile_menu('Choose', [
+            {'label': 'Games', 'entries': mk_entries(1, 'game')},
+        ] + mk_entries(2), exclude=['game0', 'app0'])
+        self.assertEqual(plan.root.text, 'Choose\n1) App 1')
+        self.assertEqual(plan.endpoints, frozenset(['app1']))
+
+    def test_version(self):
+        entries = mk_entries(2)
+        self.assertEqual(
+            compile_menu('Choose', entries).version,
+            compile_menu('Choose', list(entries)).version)
+        self.assertNotEqual(
+            compile_menu('Choose', entries).version,
+            compile_menu('Choose', entries, max_length=10).version)
+        self.assertNotEqual(
+            compile_menu('Choose', entries).version,
+            compile_menu('Choose', entries, exclude=['app0']).version)
+
+    def test_page_path(self):
+        games = {'label': 'Games', 'entries': mk_entries(2, 'game')}
+        plan = compile_menu('Choose', mk_entries(3) + [games], max_length=40)
+        self.assertEqual(
+            plan.root.text, 'Choose\n1) App 0\n2) App 1\n3) More')
+        more = plan.choose(MenuPlan.ROOT, 3).target
+        games_id = plan.choose(more, 2).target
+        self.assertEqual(plan.page_path(games_id), ('More', 'Games'))
+        self.assertEqual(plan.page_path(MenuPlan.ROOT), ())
+        self.assertEqual(plan.page_path('missing'), None)
+
+        other = compile_menu('Choose', [
+            {'label': 'News', 'entries': mk_entries(1, 'news')},
+        ] + mk_entries(2) + [games], max_length=40)
+        games_page = other.page(other.follow_path(('More', 'Games')))
+        self.assertEqual(games_page.labels, ('Game 0', 'Game 1', 'Back'))
+        self.assertEqual(other.follow_path(('News', 'News 0')), None)
+        self.assertEqual(other.follow_path(('Apps',)), None)
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+from twisted.python import usage
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.expiry import SessionExpiry
+from vxapprouter.migrate import Options, SessionMigrator
+
+
+class TestSessionMigrator(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        yield self.redis.hmset('session:1', {
+            'state': 'selected', 'active_endpoint': 'old'})
+        yield self.redis.hmset('session:2', {
+            'state': 'selected', 'active_endpoint': 'gone'})
+        yield self.redis.hmset('session:3', {
+            'state': 'selected', 'active_endpoint': 'other'})
+        yield self.redis.hmset('session:4', {'state': 'select'})
+        yield self.redis.set('cache:abc', '1')
+
+    def mk_migrator(self, **kw):
+        return SessionMigrator(
+            reactor, self.redis, {'old': 'new', 'gone': None},
+            batch_size=2, **kw)
+
+    @inlineCallbacks
+    def test_migrate(self):
+        progress = []
+        migrator = self.mk_migrator(
+            progress=lambda m: progress.append(m.scanned))
+        yield migrator.run()
+        self.assertEqual(
+            (migrator.scanned, migrator.migrated, migrator.removed),
+            (4, 1, 1))
+        self.assertEqual(progress[-1], 4)
+        session = yield self.redis.hgetall('session:1')
+        self.assertEqual(session['active_endpoint'], 'new')
+        self.assertFalse((yield self.redis.exists('session:2')))
+        session = yield self.redis.hgetall('session:3')
+        self.assertEqual(session['active_endpoint'], 'other')
+
+    @inlineCallbacks
+    def test_keeps_expiry(self):
+        yield self.redis.expire('session:1', 300)
+        yield self.mk_migrator().run()
+        self.assertEqual(
+            (yield self.redis.hget('session:1', 'active_endpoint')), 'new')
+        ttl = yield self.redis.ttl('session:1')
+        self.assertTrue(0 < ttl <= 300)
+
+    @inlineCallbacks
+    def test_changed_mid_batch(self):
+        """
+        Sessions that end or move after they are read are left alone.
+        """
+        hgetall = self.redis.hgetall
+
+        @inlineCallbacks
+        def read_then_change(key):
+            session = yield hgetall(key)
+            if key == 'session:1':
+                yield self.redis.delete(key)
+            elif key == 'session:2':
+                yield self.redis.hset(key, 'active_endpoint', 'other')
+            returnValue(session)
+
+        self.patch(self.redis, 'hgetall', read_then_change)
+        migrator = self.mk_migrator()
+        yield migrator.run()
+        self.assertEqual((migrator.migrated, migrator.removed), (0, 0))
+        self.assertFalse((yield self.redis.exists('session:1')))
+        session = yield self.redis.hgetall('session:2')
+        self.assertEqual(session['active_endpoint'], 'other')
+
+    @inlineCallbacks
+    def test_expiry(self):
+        """
+        Sessions expire on the endpoint they were moved to, and removed
+        sessions do not expire.
+        """
+        clock = Clock()
+        expired = []
+        expiry = SessionExpiry(
+            clock, self.redis.sub_manager('expiry'),
+            lambda key, record: expired.append((key, record)))
+        yield expiry.track('1', 10, {'endpoint': 'old'})
+        yield expiry.track('2', 10, {'endpoint': 'gone'})
+        yield self.mk_migrator(expiry=self.redis.sub_manager('expiry')).run()
+        clock.advance(10)
+        yield expiry.tick()
+        self.assertEqual(expired, [('1', {'endpoint': 'new'})])
+        self.assertEqual(
+            (yield self.redis.sub_manager('expiry').zcard('deadlines')), 0)
+
+    @inlineCallbacks
+    def test_dry_run(self):
+        migrator = self.mk_migrator(dry_run=True)
+        yield migrator.run()
+        self.assertEqual((migrator.migrated, migrator.removed), (1, 1))
+        session = yield self.redis.hgetall('session:1')
+        self.assertEqual(session['active_endpoint'], 'old')
+        self.assertTrue((yield self.redis.exists('session:2')))
+
+
+class TestOptions(VumiTestCase):
+
+    def mk_config(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'config.yaml')
+        with open(path, 'w') as f:
+            f.write('redis_manager: {}\n')
+        return path
+
+    def test_mapping(self):
+        options = Options()
+        options.parseOptions([self.mk_config(), 'old=new', 'gone='])
+        self.assertEqual(options['mapping'], {'old': 'new', 'gone': None})
+        self.assertEqual(options['config'], {'redis_manager': {}})
+
+    def test_invalid_mapping(self):
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions,
+            [self.mk_config(), 'old'])
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions, [self.mk_config()])
@@ -0,0 +1,186 @@
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.components.session import SessionManager
+from vumi.dispatchers.tests.helpers import DispatcherHelper
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.partition import (
+    LocalSessionCache, PartitionDispatcher, UserSerializer, partition_for)
+
+
+class TestPartitionFor(VumiTestCase):
+
+    def test_stable(self):
+        self.assertEqual(
+            partition_for('+27831234567', 4),
+            partition_for(u'+27831234567', 4))
+
+    def test_spread(self):
+        counts = [0] * 4
+        for i in range(1000):
+            counts[partition_for('+2783%07d' % (i,), 4)] += 1
+        self.assertTrue(min(counts) > 200, counts)
+
+
+class TestLocalSessionCache(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.cache = LocalSessionCache(
+            self.clock, size=2, owns=lambda user_id: user_id != 'other')
+        self.session_manager = self.cache.wrap(
+            SessionManager(self.redis, max_session_length=60))
+
+    @inlineCallbacks
+    def test_load_cached(self):
+        yield self.redis.hset('session:123', 'state', 'start')
+        session = yield self.session_manager.load_session('123')
+        self.assertEqual(session, {'state': 'start'})
+        yield self.redis.hset('session:123', 'state', 'changed')
+        session = yield self.session_manager.load_session('123')
+        self.assertEqual(session, {'state': 'start'})
+
+    @inlineCallbacks
+    def test_not_owned(self):
+        yield self.redis.hset('session:other', 'state', 'start')
+        yield self.session_manager.load_session('other')
+        yield self.redis.hset('session:other', 'state', 'changed')
+        session = yield self.session_manager.load_session('other')
+        self.assertEqual(session, {'state': 'changed'})
+
+    @inlineCallbacks
+    def test_save_and_clear(self):
+        yield self.session_manager.create_session('123', state='start')
+        yield self.session_manager.save_session('123', {'page': 2})
+        session = yield self.session_manager.load_session('123')
+        self.assertEqual(session['page'], '2')
+        stored = yield self.redis.hgetall('session:123')
+        self.assertEqual(stored, session)
+
+        yield self.session_manager.clear_session('123')
+        self.assertEqual((yield self.session_manager.load_session('123')), {})
+        self.assertEqual((yield self.redis.exists('session:123')), False)
+
+    @inlineCallbacks
+    def test_save_keeps_expiry(self):
+        yield self.session_manager.create_session('123', state='start')
+        self.clock.advance(20)
+        yield self.redis.persist('session:123')
+        yield self.session_manager.save_session('123', {'state': 'select'})
+        ttl = yield self.redis.ttl('session:123')
+        self.assertTrue(39 <= ttl <= 40)
+
+    @inlineCallbacks
+    def test_save_cleared_elsewhere(self):
+        """
+        A session cleared by another partition is not brought back by a
+        write through the cache.
+        """
+        yield self.session_manager.create_session('123', state='start')
+        yield SessionManager(self.redis).clear_session('123')
+        yield self.session_manager.save_session('123', {'state': 'select'})
+        self.assertEqual((yield self.redis.exists('session:123')), False)
+        self.assertEqual((yield self.session_manager.load_session('123')), {})
+
+    @inlineCallbacks
+    def test_expiry(self):
+        yield self.session_manager.create_session('123', state='start')
+        self.clock.advance(60)
+        yield self.redis.delete('session:123')
+        self.assertEqual((yield self.session_manager.load_session('123')), {})
+
+    @inlineCallbacks
+    def test_expiry_from_redis_ttl(self):
+        yield self.redis.hset('session:123', 'state', 'start')
+        yield self.redis.expire('session:123', 10)
+        yield self.session_manager.load_session('123')
+        self.clock.advance(10)
+        yield self.redis.delete('session:123')
+        self.assertEqual((yield self.session_manager.load_session('123')), {})
+
+    @inlineCallbacks
+    def test_size(self):
+        for user_id in ['1', '2', '3']:
+            yield self.session_manager.load_session(user_id)
+        self.assertEqual(self.cache.sessions.keys(), ['2', '3'])
+
+
+class TestUserSerializer(VumiTestCase):
+
+    def test_per_user_order(self):
+        serializer = UserSerializer()
+        calls = []
+        first = Deferred()
+
+        def work(name, result=None):
+            calls.append(name)
+            return result
+
+        d1 = serializer.run('123', work, 'a1', first)
+        d2 = serializer.run('123', work, 'a2')
+        d3 = serializer.run('456', work, 'b1')
+        self.assertEqual(calls, ['a1', 'b1'])
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.assertEqual(self.successResultOf(d3), None)
+        self.assertEqual(len(serializer), 1)
+
+        first.callback('done')
+        self.assertEqual(self.successResultOf(d1), 'done')
+        self.assertEqual(calls, ['a1', 'b1', 'a2'])
+        self.successResultOf(d2)
+        self.assertEqual(len(serializer), 0)
+
+
+class TestPartitionDispatcher(VumiTestCase):
+
+    def setUp(self):
+        self.disp_helper = self.add_helper(
+            DispatcherHelper(PartitionDispatcher))
+
+    def ch(self, connector_name):
+        return self.disp_helper.get_connector_helper(connector_name)
+
+    def get_dispatcher(self):
+        return self.disp_helper.get_dispatcher({
+            'receive_inbound_connectors': ['transport'],
+            'receive_outbound_connectors': ['router.0', 'router.1'],
+            'partition_connectors': ['router.0', 'router.1'],
+        })
+
+    def user_for(self, index):
+        return next(
+            '+2783%07d' % (i,) for i in range(100)
+            if partition_for('+2783%07d' % (i,), 2) == index)
+
+    @inlineCallbacks
+    def test_inbound_partitioned(self):
+        yield self.get_dispatcher()
+        for index in [0, 1, 0]:
+            yield self.ch('transport').make_dispatch_inbound(
+                'hi', from_addr=self.user_for(index),
+                transport_name='transport')
+        self.assertEqual(
+            [m['from_addr'] for m in
+             self.ch('router.0').get_dispatched_inbound()],
+            [self.user_for(0), self.user_for(0)])
+        [msg] = self.ch('router.1').get_dispatched_inbound()
+        self.assertEqual(msg['from_addr'], self.user_for(1))
+
+    @inlineCallbacks
+    def test_outbound_and_events(self):
+        yield self.get_dispatcher()
+        msg = yield self.ch('router.1').make_dispatch_outbound(
+            'hi', transport_name='transport')
+        [outbound] = self.ch('transport').get_dispatched_outbound()
+        self.assertEqual(outbound['message_id'], msg['message_id'])
+
+        yield self.ch('transport').make_dispatch_ack(msg)
+        [event] = (
+            self.ch('router.0').get_dispatched_events() +
+            self.ch('router.1').get_dispatched_events())
+        self.assertEqual(event['user_message_id'], msg['message_id'])
@@ -0,0 +1,51 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.preferences import PreferenceStore
+
+
+class TestPreferenceStore(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = PreferenceStore(self.redis, buckets=16, ttl=3600)
+
+    @inlineCallbacks
+    def test_remember(self):
+        self.assertEqual((yield self.store.get('123')), None)
+        yield self.store.remember('123', 'flappy-bird')
+        yield self.store.remember('456', 'angry-birds')
+        self.assertEqual((yield self.store.get('123')), 'flappy-bird')
+        self.assertEqual((yield self.store.get('456')), 'angry-birds')
+        yield self.store.remember('123', 'angry-birds')
+        self.assertEqual((yield self.store.get('123')), 'angry-birds')
+
+    @inlineCallbacks
+    def test_compact_buckets(self):
+        """
+        Users are stored as endpoint indexes in hashes that expire.
+        """
+        yield self.store.remember('123', 'flappy-bird')
+        key = self.store.bucket_key('123')
+        self.assertEqual((yield self.redis.hget(key, '123')), '1')
+        ttl = yield self.redis.ttl(key)
+        self.assertTrue(3590 <= ttl <= 3600)
+        for i in range(100):
+            self.assertTrue(self.store.bucket_key('+2783%07d' % (i,)) in [
+                'last:%s' % (bucket,) for bucket in range(16)])
+
+    @inlineCallbacks
+    def test_shared_indexes(self):
+        """
+        Endpoint indexes assigned by one worker are picked up by others.
+        """
+        other = PreferenceStore(self.redis, buckets=16)
+        yield self.store.remember('123', 'flappy-bird')
+        yield other.remember('456', 'angry-birds')
+        yield other.remember('789', 'flappy-bird')
+        self.assertEqual(other.indexes, {'flappy-bird': 1, 'angry-birds': 2})
+        self.assertEqual((yield other.get('123')), 'flappy-bird')
+        self.assertEqual((yield self.store.get('456')), 'angry-birds')
@@ -0,0 +1,80 @@
+import os
+import shutil
+import sys
+import tempfile
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportUserMessage
+
+from vxapprouter.profiling import (
+    SamplingProfiler, SlowMessageLog, StageTimer, collapse)
+
+
+class TestCollapse(TestCase):
+
+    def test_collapse(self):
+        stack = collapse(sys._getframe()).split(';')
+        self.assertTrue(
+            stack[-1].startswith('test_collapse (test_profiling.py:'))
+
+
+class TestSamplingProfiler(TestCase):
+
+    def busy(self, count):
+        return sum(i * i for i in xrange(count))
+
+    def test_sample(self):
+        profiler = SamplingProfiler(0.001)
+        profiler.start()
+        self.addCleanup(profiler.stop)
+        self.assertTrue(profiler.running)
+        while not profiler.stacks:
+            self.busy(10000)
+        stacks = profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertTrue(any('busy (test_profiling.py' in stack
+                            for stack in stacks))
+
+    def test_dump(self):
+        profiler = SamplingProfiler()
+        profiler.stacks.update({'a;b': 2, 'a;c': 1})
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'stacks.txt')
+        profiler.dump(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'a;b 2\na;c 1\n')
+
+
+class TestSlowMessageLog(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_stage_timer(self):
+        timer = StageTimer(self.clock)
+        self.clock.advance(1)
+        timer.mark('first')
+        self.clock.advance(2)
+        timer.mark('second')
+        self.assertEqual(timer.stages, [('first', 1), ('second', 2)])
+        self.assertEqual(timer.total, 3)
+
+    def test_record(self):
+        slow = SlowMessageLog(self.clock, threshold=1)
+        msg = TransportUserMessage(
+            to_addr='*120*1#', from_addr='123', transport_name='transport',
+            transport_type='ussd')
+        fast = slow.timer()
+        fast.mark('only')
+        slow.record(msg, fast)
+        self.assertEqual(list(slow.messages), [])
+
+        timer = slow.timer()
+        self.clock.advance(1)
+        timer.mark('only')
+        slow.record(msg, timer)
+        self.assertEqual(
+            list(slow.messages), [(msg['message_id'], 1, [('only', 1)])])
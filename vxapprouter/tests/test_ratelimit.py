@@ -0,0 +1,125 @@
+from twisted.internet.defer import CancelledError, inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.ratelimit import RateLimiter, TokenBucket
+
+
+class TestTokenBucket(VumiTestCase):
+
+    def test_consume_and_refill(self):
+        clock = Clock()
+        bucket = TokenBucket(clock, rate=2, burst=2)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertEqual(bucket.delay(), 0.5)
+        clock.advance(0.5)
+        self.assertTrue(bucket.consume())
+        clock.advance(10)
+        self.assertEqual(bucket.delay(), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+
+class TestRateLimiter(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.throttled = []
+
+    def mk_limiter(self, **kw):
+        kw.setdefault('on_throttled', self.throttled.append)
+        return RateLimiter('app.default', self.clock, **kw)
+
+    def test_allows_within_rate(self):
+        limiter = self.mk_limiter(rate=1, burst=2)
+        self.assertTrue(self.successResultOf(limiter.acquire()))
+        self.assertTrue(self.successResultOf(limiter.acquire()))
+        self.assertEqual(self.throttled, [])
+
+    def test_rejects_without_queue(self):
+        limiter = self.mk_limiter(rate=1)
+        self.assertTrue(self.successResultOf(limiter.acquire()))
+        self.assertFalse(self.successResultOf(limiter.acquire()))
+        self.assertEqual(self.throttled, ['rejected'])
+
+    def test_queues_in_order(self):
+        limiter = self.mk_limiter(rate=1, queue_size=2)
+        self.assertTrue(self.successResultOf(limiter.acquire()))
+        d1 = limiter.acquire()
+        d2 = limiter.acquire()
+        self.assertFalse(self.successResultOf(limiter.acquire()))
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.clock.advance(1)
+        self.assertTrue(self.successResultOf(d1))
+        self.assertNoResult(d2)
+        self.clock.advance(1)
+        self.assertTrue(self.successResultOf(d2))
+        self.assertEqual(self.throttled, ['queued', 'queued', 'rejected'])
+
+    def test_cancel_waiting(self):
+        limiter = self.mk_limiter(rate=1, queue_size=1)
+        limiter.acquire()
+        d = limiter.acquire()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(list(limiter.waiting), [])
+        d = limiter.acquire()
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.throttled, ['queued', 'queued'])
+
+    def test_rejects_past_max_wait(self):
+        limiter = self.mk_limiter(rate=1, queue_size=2)
+        limiter.acquire()
+        d = limiter.acquire(max_wait=1)
+        self.assertNoResult(d)
+        self.assertFalse(self.successResultOf(limiter.acquire(max_wait=1)))
+        self.assertEqual(self.throttled, ['queued', 'rejected'])
+
+    def test_stop_rejects_waiting(self):
+        limiter = self.mk_limiter(rate=1, queue_size=1)
+        limiter.acquire()
+        d = limiter.acquire()
+        limiter.stop()
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_shared_limit(self):
+        persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield persistence_helper.get_redis_manager()
+        limiter1 = self.mk_limiter(rate=2, burst=5, redis=redis)
+        limiter2 = self.mk_limiter(rate=2, burst=5, redis=redis)
+        self.assertTrue((yield limiter1.acquire()))
+        self.assertTrue((yield limiter2.acquire()))
+        self.assertFalse((yield limiter1.acquire()))
+        self.assertFalse((yield limiter2.acquire()))
+        self.clock.advance(1)
+        self.assertTrue((yield limiter2.acquire()))
+
+    @inlineCallbacks
+    def test_shared_limit_redis_error(self):
+        """
+        Messages waiting in the queue fail instead of waiting forever if
+        Redis fails while they are released.
+        """
+        persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield persistence_helper.get_redis_manager()
+        limiter = self.mk_limiter(rate=1, queue_size=2, redis=redis)
+        self.assertTrue((yield limiter.acquire()))
+        d1 = limiter.acquire()
+        d2 = limiter.acquire()
+
+        def incr(key):
+            raise RuntimeError("Redis is down")
+
+        self.patch(redis, 'incr', incr)
+        self.clock.advance(1)
+        yield self.assertFailure(d1, RuntimeError)
+        yield self.assertFailure(d2, RuntimeError)
+        self.assertEqual(list(limiter.waiting), [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,26 @@
+from twisted.internet.defer import succeed
+from twisted.trial.unittest import TestCase
+
+from vxapprouter.redisutils import send_command
+
+
+class RecordingClient(object):
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.sent = []
+
+    def _send(self, *args):
+        self.sent.append(args)
+
+    def getResponse(self):
+        return succeed(self.reply)
+
+
+class TestSendCommand(TestCase):
+
+    def test_send_command(self):
+        client = RecordingClient(42)
+        d = send_command(client, 'MEMORY', 'USAGE', 'session:123')
+        self.assertEqual(self.successResultOf(d), 42)
+        self.assertEqual(client.sent, [('MEMORY', 'USAGE', 'session:123')])
@@ -1,14 +1,29 @@
-import json
 import copy
+import os
+import shutil
+import tempfile
+import time
 
 from vumi.components.session import SessionManager
+from vumi.config import ConfigError
 from vumi.dispatchers.tests.helpers import DispatcherHelper
+from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.tests.utils import LogCatcher
 
+from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, succeed, Deferred, returnValue)
+    inlineCallbacks, succeed, Deferred, DeferredList, returnValue,
+    gatherResults)
+from twisted.internet.task import Clock
 
-from vxapprouter.router import ApplicationDispatcher
+from vxapprouter.menu import MenuPlan, compile_menu
+from vxapprouter.partition import partition_for
+from vxapprouter.router import (
+    ApplicationDispatcher, ApplicationDispatcherConfig)
+
+
+SESSION_MANAGER = ApplicationDispatcher.session_manager
 
 
 class DummyError(Exception):
@@ -75,11 +90,28 @@ class TestApplicationRouter(VumiTestCase):
     def setup_session(self, user_id, data):
         return self.session_manager.save_session(user_id, data)
 
+    def menu_session(self, state, menu_page=MenuPlan.ROOT, **fields):
+        config = ApplicationDispatcherConfig(self.DISPATCHER_CONFIG)
+        plan = compile_menu(
+            config.menu_title, config.entries, config.menu_max_length,
+            config.more_label, config.back_label)
+        session = {
+            'state': state,
+            'menu_page': menu_page,
+            'menu_version': plan.version,
+        }
+        session.update(fields)
+        return session
+
     def get_dispatcher(self, **config_extras):
         config = self.DISPATCHER_CONFIG.copy()
         config.update(config_extras)
         return self.disp_helper.get_dispatcher(config)
 
+    def wait_for_paused(self, dispatcher):
+        return DeferredList([
+            connector.pause() for connector in dispatcher.connectors.values()])
+
     @inlineCallbacks
     def test_new_session_display_menu(self):
         yield self.get_dispatcher()
@@ -94,10 +126,8 @@ class TestApplicationRouter(VumiTestCase):
                 "1) Flappy Bird",
             ]))
 
-        yield self.assert_session(msg['from_addr'], {
-            'state': ApplicationDispatcher.STATE_SELECT,
-            'endpoints': json.dumps(['flappy-bird']),
-        })
+        yield self.assert_session(msg['from_addr'], self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
 
     @inlineCallbacks
     def test_select_application_endpoint(self):
@@ -105,10 +135,8 @@ class TestApplicationRouter(VumiTestCase):
         Retrieve endpoint choice from user and set currently active
         endpoint.
         """
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
         yield self.get_dispatcher()
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -126,11 +154,9 @@ class TestApplicationRouter(VumiTestCase):
         [msg] = self.ch("transport").get_dispatched_outbound()
         self.assertEqual(msg['content'], 'Flappy Flappy!')
 
-        yield self.assert_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.assert_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
 
     @inlineCallbacks
     def test_session_with_selected_endpoint(self):
@@ -139,11 +165,9 @@ class TestApplicationRouter(VumiTestCase):
         """
         yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -164,11 +188,9 @@ class TestApplicationRouter(VumiTestCase):
         self.assertEqual(msg['content'],
                          'Game Over!\n1) Try Again!')
 
-        yield self.assert_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.assert_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
 
     @inlineCallbacks
     def test_bad_input_for_endpoint_choice(self):
@@ -177,10 +199,8 @@ class TestApplicationRouter(VumiTestCase):
         """
         yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -192,10 +212,8 @@ class TestApplicationRouter(VumiTestCase):
         self.assertEqual(msg['content'],
                          'Bad choice.\n\n1. Try Again')
 
-        yield self.assert_session('123', {
-            'state': ApplicationDispatcher.STATE_BAD_INPUT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.assert_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_BAD_INPUT))
 
     @inlineCallbacks
     def test_state_bad_input_for_bad_input_prompt(self):
@@ -205,10 +223,8 @@ class TestApplicationRouter(VumiTestCase):
         """
         yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_BAD_INPUT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_BAD_INPUT))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -220,10 +236,8 @@ class TestApplicationRouter(VumiTestCase):
         self.assertEqual(msg['content'],
                          'Bad choice.\n\n1. Try Again')
 
-        yield self.assert_session('123', {
-            'state': ApplicationDispatcher.STATE_BAD_INPUT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.assert_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_BAD_INPUT))
 
     @inlineCallbacks
     def test_state_good_input_for_bad_input_prompt(self):
@@ -233,10 +247,8 @@ class TestApplicationRouter(VumiTestCase):
         """
         yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_BAD_INPUT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_BAD_INPUT))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -248,10 +260,8 @@ class TestApplicationRouter(VumiTestCase):
         self.assertEqual(msg['content'],
                          'Please select a choice.\n1) Flappy Bird')
 
-        yield self.assert_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.assert_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
 
     @inlineCallbacks
     def test_runtime_exception_in_selected_handler(self):
@@ -264,11 +274,9 @@ class TestApplicationRouter(VumiTestCase):
         # Make worker.target_endpoints raise an exception
         self.patch(dispatcher, 'target_endpoints', raise_error)
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -297,11 +305,9 @@ class TestApplicationRouter(VumiTestCase):
         config = copy.deepcopy(self.DISPATCHER_CONFIG)
         config['entries'][0]['endpoint'] = 'mama'
         yield self.get_dispatcher(**config)
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -322,11 +328,9 @@ class TestApplicationRouter(VumiTestCase):
         """
         yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -353,10 +357,8 @@ class TestApplicationRouter(VumiTestCase):
         """
         yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECT,
-            'endpoints': '["flappy-bird"]'
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -383,11 +385,9 @@ class TestApplicationRouter(VumiTestCase):
         """
         yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
 
         # msg sent from user
         msg = yield self.ch("transport").make_dispatch_inbound(
@@ -444,6 +444,89 @@ class TestApplicationRouter(VumiTestCase):
         self.assertEqual(
             text, 'Please select a choice.\n1) Flappy Bird\n2) Mama')
 
+    @inlineCallbacks
+    def test_select_sub_menu(self):
+        """
+        Choosing a sub-menu shows its page and only stores the page id in
+        the session. Choosing an entry on it switches to its endpoint.
+        """
+        routing_table = copy.deepcopy(self.DISPATCHER_CONFIG['routing_table'])
+        routing_table['transport']['mama'] = ['app2', 'default']
+        yield self.get_dispatcher(
+            entries=[{
+                'label': 'Flappy Bird',
+                'endpoint': 'flappy-bird',
+            }, {
+                'label': 'Health',
+                'title': 'Health services',
+                'entries': [{'label': 'Mama', 'endpoint': 'mama'}],
+            }],
+            routing_table=routing_table)
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            '2', from_addr='123', session_event='resume',
+            transport_name='transport')
+        [_, msg] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(
+            msg['content'], 'Health services\n1) Mama\n2) Back')
+        session = yield self.session_manager.load_session('123')
+        self.assertEqual(session['state'], ApplicationDispatcher.STATE_SELECT)
+        self.assertEqual(session['menu_page'], '1')
+
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        [msg] = self.ch("app2").get_dispatched_inbound()
+        self.assertEqual(msg['session_event'], 'new')
+        session = yield self.session_manager.load_session('123')
+        self.assertEqual(session['active_endpoint'], 'mama')
+
+    @inlineCallbacks
+    def test_paginated_menu(self):
+        """
+        Menus that are too long are split into pages linked by a 'more'
+        choice.
+        """
+        yield self.get_dispatcher(
+            menu_max_length=40,
+            entries=[{
+                'label': 'Application %s' % (i,),
+                'endpoint': 'flappy-bird',
+            } for i in range(3)])
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            '2', from_addr='123', session_event='resume',
+            transport_name='transport')
+        [first, second] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(
+            first['content'],
+            'Please select a choice.\n1) Application 0\n2) More')
+        self.assertEqual(
+            second['content'],
+            'Please select a choice.\n1) Application 1\n2) More\n3) Back')
+
+    @inlineCallbacks
+    def test_menu_change_restarts_menu(self):
+        """
+        If the menu changed since it was shown to the user, their choice
+        is discarded and the current menu is shown again.
+        """
+        yield self.get_dispatcher(menu_title='What would you like?')
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
+
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        self.assertEqual([], self.ch("app1").get_dispatched_inbound())
+        [msg] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(
+            msg['content'], 'What would you like?\n1) Flappy Bird')
+
     @inlineCallbacks
     def test_new_session_stores_valid_session_data(self):
         """
@@ -480,20 +563,16 @@ class TestApplicationRouter(VumiTestCase):
         self.assertEqual(msg['content'],
                          'Please select a choice.\n1) Flappy Bird')
         # assert that session data updated correctly
-        yield self.assert_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECT,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.assert_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
 
     @inlineCallbacks
     def test_inbound_event_routing(self):
         dispatcher = yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'active_endpoint': 'flappy-bird',
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
         yield dispatcher.cache_outbound_user_id(
             'message_id', '123')
 
@@ -507,10 +586,8 @@ class TestApplicationRouter(VumiTestCase):
     def test_event_routing_without_active_endpoint(self):
         dispatcher = yield self.get_dispatcher()
 
-        yield self.setup_session('123', {
-            'state': ApplicationDispatcher.STATE_SELECTED,
-            'endpoints': '["flappy-bird"]',
-        })
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED))
         yield dispatcher.cache_outbound_user_id(
             'message_id', '123')
 
@@ -519,3 +596,1056 @@ class TestApplicationRouter(VumiTestCase):
         self.assert_rkeys_used('transport.event')
         self.assertEqual(
             self.ch('app1').get_dispatched_events(), [])
+
+    @inlineCallbacks
+    def test_event_routing_tenant_without_tenancy(self):
+        """
+        Events for messages sent to a tenant's user while tenancy was on
+        are routed with the default config once it is off.
+        """
+        dispatcher = yield self.get_dispatcher()
+
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+        yield dispatcher.cache_outbound_user_id(
+            'message_id', '123', tenant='acme')
+
+        event = yield self.ch('transport').make_dispatch_ack(
+            {'message_id': 'message_id'})
+        self.assert_dispatched_endpoint(
+            event, 'default', self.ch('app1').get_dispatched_events())
+
+    @inlineCallbacks
+    def test_warm_startup(self):
+        """
+        Menus are compiled before the dispatcher starts consuming, and it
+        reports how long each startup phase took.
+        """
+        dispatcher = yield self.get_dispatcher()
+        timings = yield dispatcher.ready
+        self.assertEqual(
+            timings.keys(), ['redis', 'metrics', 'tenants', 'warm_up'])
+        self.assertEqual(len(dispatcher._menu_plans), 1)
+
+    @inlineCallbacks
+    def test_invalid_routing_table(self):
+        """
+        The dispatcher refuses to start if a route targets an unknown
+        connector.
+        """
+        routing_table = dict(self.DISPATCHER_CONFIG['routing_table'])
+        routing_table['app1'] = {'default': ['nowhere', 'default']}
+        yield self.assertFailure(
+            self.get_dispatcher(routing_table=routing_table), ConfigError)
+
+    @inlineCallbacks
+    def test_config_snapshot(self):
+        dispatcher = yield self.get_dispatcher()
+        config1 = yield dispatcher.get_config(None)
+        config2 = yield dispatcher.get_config(None)
+        self.assertTrue(config1 is config2)
+        self.assertEqual(config1.error_message, 'Oops! Sorry!')
+
+        dispatcher.config['error_message'] = 'Eek!'
+        config3 = yield dispatcher.get_config(None)
+        self.assertTrue(config3 is config1)
+        dispatcher.invalidate_config()
+        config4 = yield dispatcher.get_config(None)
+        self.assertEqual(config4.error_message, 'Eek!')
+
+    @inlineCallbacks
+    def test_forwarded_message(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.disp_helper.make_inbound(
+            '1', helper_metadata={'session': {'id': 'abc'}})
+        original = copy.deepcopy(msg.payload)
+        forwarded = dispatcher.forwarded_message(
+            msg, content=None, session_event='new')
+        self.assertTrue(isinstance(forwarded, TransportUserMessage))
+        self.assertEqual(forwarded['content'], None)
+        self.assertEqual(forwarded['session_event'], 'new')
+        self.assertEqual(forwarded['message_id'], msg['message_id'])
+        self.assertTrue(
+            forwarded['helper_metadata']['session'] is
+            msg['helper_metadata']['session'])
+
+        forwarded.set_routing_endpoint('app')
+        forwarded['helper_metadata']['tracking'] = 'x'
+        forwarded['transport_metadata']['extra'] = 'y'
+        self.assertEqual(msg.payload, original)
+
+    def test_reexports(self):
+        from vxapprouter import core, menu, router
+        self.assertIs(router.StateResponse, core.StateResponse)
+        self.assertIs(router.clean, core.clean)
+        self.assertIs(router.mkmenu, menu.mkmenu)
+
+    @inlineCallbacks
+    def test_multi_tenant(self):
+        """
+        Tenants get their own menu and their own sessions, and events are
+        routed with the config of the tenant that sent the message.
+        """
+        self.patch(
+            ApplicationDispatcher, 'session_manager', SESSION_MANAGER)
+        dispatcher = yield self.get_dispatcher(tenancy={'tenants': {
+            'mama': {
+                'to_addrs': ['*120*2#'],
+                'entries': [{'label': 'Mama', 'endpoint': 'mama'}],
+                'routing_table': {
+                    'transport': {
+                        'mama': ['app2', 'default'],
+                        'default': ['transport', 'default'],
+                    },
+                    'app2': {'default': ['transport', 'default']},
+                },
+            },
+        }})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', to_addr='*120*1#', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', to_addr='*120*2#', session_event='new',
+            transport_name='transport')
+        [default_reply, tenant_reply] = (
+            self.ch("transport").get_dispatched_outbound())
+        self.assertEqual(
+            default_reply['content'],
+            'Please select a choice.\n1) Flappy Bird')
+        self.assertEqual(
+            tenant_reply['content'], 'Please select a choice.\n1) Mama')
+
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', to_addr='*120*2#', session_event='resume',
+            transport_name='transport')
+        [msg] = self.ch("app2").get_dispatched_inbound()
+        self.assertEqual(msg['session_event'], 'new')
+        self.assertEqual(self.ch("app1").get_dispatched_inbound(), [])
+
+        default_session = yield dispatcher.redis.hgetall('session:123')
+        self.assertEqual(default_session['state'], 'select')
+        tenant_session = yield dispatcher.tenants.namespace('mama').hgetall(
+            'session:123')
+        self.assertEqual(tenant_session['active_endpoint'], 'mama')
+
+        reply = yield self.ch("app2").make_dispatch_reply(msg, 'Hi')
+        self.disp_helper.clear_all_dispatched()
+        yield self.ch("transport").make_dispatch_ack(reply)
+        [event] = self.ch("app2").get_dispatched_events()
+        self.assertEqual(event['user_message_id'], reply['message_id'])
+
+    @inlineCallbacks
+    def test_partitioned(self):
+        """
+        A partition caches the sessions of the users it owns and counts
+        messages from users that belong to another partition.
+        """
+        self.patch(
+            ApplicationDispatcher, 'session_manager', SESSION_MANAGER)
+        dispatcher = yield self.get_dispatcher(
+            partition={'index': partition_for('123', 2), 'count': 2})
+        other = next(
+            str(i) for i in range(100) if not dispatcher.owns_user(str(i)))
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        # Only the cached session still shows the menu page.
+        yield dispatcher.redis.hset('session:123', 'menu_page', 'gone')
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['session_event'], 'new')
+        session = yield dispatcher.redis.hgetall('session:123')
+        self.assertEqual(session['active_endpoint'], 'flappy-bird')
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr=other, session_event='new',
+            transport_name='transport')
+        [(_, value)] = dispatcher.metrics['partition.misrouted'].poll()
+        self.assertEqual(value, 1.0)
+
+    @inlineCallbacks
+    def test_session_state_expiry(self):
+        """
+        The expiry of a session is reset to the one for its state every
+        time it is saved in a state with its own expiry.
+        """
+        yield self.get_dispatcher(
+            session_state_expiry={'select': 30, 'selected': 600})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new')
+        ttl = yield self.redis.ttl('session:123')
+        self.assertEqual(ttl, 30)
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume')
+        ttl = yield self.redis.ttl('session:123')
+        self.assertEqual(ttl, 600)
+
+    @inlineCallbacks
+    def test_session_state_expiry_unlisted(self):
+        """
+        Sessions that leave a state with its own expiry for one without
+        get back what is left of the expiry they were created with.
+        """
+        yield self.get_dispatcher(
+            session_expiry=300, session_state_expiry={'select': 20})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new')
+        ttl = yield self.redis.ttl('session:123')
+        self.assertEqual(ttl, 20)
+        yield self.redis.hset('session:123', 'created_at', time.time() - 100)
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume')
+        session = yield self.redis.hgetall('session:123')
+        self.assertEqual(session['state'], 'selected')
+        ttl = yield self.redis.ttl('session:123')
+        self.assertTrue(195 <= ttl <= 200)
+
+    @inlineCallbacks
+    def test_invalid_session_state_expiry(self):
+        yield self.assertFailure(
+            self.get_dispatcher(session_state_expiry={'menu': 30}),
+            ConfigError)
+        yield self.assertFailure(
+            self.get_dispatcher(session_state_expiry={'select': 0}),
+            ConfigError)
+
+    @inlineCallbacks
+    def test_session_close_on_expiry(self):
+        """
+        The application a session was routed to is sent a session close
+        when the session expires.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            session_expiry=60, session_close_on_expiry={'resolution': 5})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        self.ch("app1").clear_all_dispatched()
+        self.assertTrue('123' in dispatcher.session_expiry.wheel)
+        # The session manager used here sets no expiry in Redis.
+        yield self.redis.delete('session:123')
+        clock.advance(60)
+        yield dispatcher.session_expiry.tick()
+        [msg] = yield self.ch("app1").wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['session_event'], 'close')
+        self.assertEqual(msg['from_addr'], '123')
+        self.assertEqual(msg['transport_name'], 'transport')
+
+    @inlineCallbacks
+    def test_session_close_not_on_expiry_after_close(self):
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            session_expiry=60, session_close_on_expiry={'resolution': 5})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new')
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume')
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='close')
+        self.ch("app1").clear_all_dispatched()
+        self.assertEqual(len(dispatcher.session_expiry.wheel), 0)
+        clock.advance(60)
+        yield dispatcher.session_expiry.tick()
+        self.assertEqual(self.ch("app1").get_dispatched_inbound(), [])
+
+    @inlineCallbacks
+    def test_session_close_not_on_expiry_after_app_close(self):
+        """
+        Applications that close a session themselves are not sent another
+        close when it would have expired.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            session_expiry=60, session_close_on_expiry={'resolution': 5})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        yield self.ch("app1").make_dispatch_reply(
+            msg, 'Bye', continue_session=False)
+        yield self.assert_session('123', {})
+        self.ch("app1").clear_all_dispatched()
+        self.assertEqual(len(dispatcher.session_expiry.wheel), 0)
+        clock.advance(60)
+        yield dispatcher.session_expiry.tick()
+        yield dispatcher.session_expiry.recover()
+        self.assertEqual(self.ch("app1").get_dispatched_inbound(), [])
+
+    @inlineCallbacks
+    def test_session_close_on_expiry_extended(self):
+        """
+        Sessions that are still there when their deadline passes are
+        tracked again instead of being closed.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            session_expiry=60, session_close_on_expiry={'resolution': 5})
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+        record = {
+            'endpoint': 'flappy-bird', 'connector': 'transport',
+            'to_addr': '*120*1#', 'transport_name': 'transport',
+            'transport_type': 'ussd',
+        }
+        yield dispatcher.session_expired('123', record)
+        self.assertEqual(self.ch("app1").get_dispatched_inbound(), [])
+        self.assertTrue('123' in dispatcher.session_expiry.wheel)
+
+        yield self.redis.delete('session:123')
+        yield dispatcher.session_expired('123', record)
+        [msg] = yield self.ch("app1").wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['session_event'], 'close')
+
+    @inlineCallbacks
+    def test_session_expiry_deadline(self):
+        """
+        Tracking session expiry is subject to the message deadline, so a
+        slow Redis does not hold the message back.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            deadlines={'timeout': 5},
+            session_close_on_expiry={'resolution': 5})
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
+        tracking = Deferred()
+
+        def zadd(*args, **kw):
+            reactor.callLater(0, tracking.callback, None)
+            return Deferred()
+        self.patch(dispatcher.session_expiry.redis, 'zadd', zadd)
+
+        self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        yield tracking
+        self.assertEqual(self.ch("app1").get_dispatched_inbound(), [])
+        clock.advance(5)
+        [msg] = yield self.ch("app1").wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['session_event'], 'new')
+        self.assertTrue('123' in dispatcher.session_expiry.wheel)
+
+    @inlineCallbacks
+    def test_preferences(self):
+        """
+        The endpoint a user selects is remembered after their session ends
+        and offered to them when they dial again.
+        """
+        dispatcher = yield self.get_dispatcher(preferences={'ttl': 3600})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new')
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume')
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='close')
+        self.ch("app1").clear_all_dispatched()
+        self.ch("transport").clear_all_dispatched()
+        store = dispatcher.preference_store(dispatcher.default_config())
+        self.assertEqual((yield store.get('123')), 'flappy-bird')
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new')
+        [reply] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(reply['content'], '\n'.join([
+            'Welcome back! Continue with Flappy Bird?',
+            '1) Continue',
+            '2) Main menu',
+        ]))
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume')
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['session_event'], 'new')
+        yield self.assert_session('123', {
+            'state': 'selected',
+            'last_endpoint': 'flappy-bird',
+            'active_endpoint': 'flappy-bird',
+        })
+
+    @inlineCallbacks
+    def test_preferences_route(self):
+        """
+        In route mode, new sessions for returning users are forwarded to
+        their last endpoint without showing the menu.
+        """
+        dispatcher = yield self.get_dispatcher(preferences={'mode': 'route'})
+        store = dispatcher.preference_store(dispatcher.default_config())
+        yield store.remember('123', 'flappy-bird')
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new')
+        self.assertEqual(self.ch("transport").get_dispatched_outbound(), [])
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['session_event'], 'new')
+        yield self.assert_session('123', {
+            'state': 'selected',
+            'active_endpoint': 'flappy-bird',
+        })
+
+    @inlineCallbacks
+    def test_preferences_batching(self):
+        dispatcher = yield self.get_dispatcher(
+            preferences={'mode': 'route'},
+            batching={'max_size': 2, 'max_delay': 60},
+            max_concurrent_messages=2)
+        store = dispatcher.preference_store(dispatcher.default_config())
+        yield store.remember('123', 'flappy-bird')
+        msgs = [
+            self.disp_helper.make_inbound(
+                None, from_addr=user_id, session_event='new',
+                transport_name='transport')
+            for user_id in ['123', '456']]
+        config = yield dispatcher.get_config(msgs[0])
+        yield gatherResults([
+            dispatcher.process_inbound(config, msg, 'transport')
+            for msg in msgs])
+        yield gatherResults(list(dispatcher.in_flight))
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['from_addr'], '123')
+        [reply] = yield self.ch("transport").wait_for_dispatched_outbound(1)
+        self.assertEqual(reply['to_addr'], '456')
+
+    @inlineCallbacks
+    def test_preferences_deadline(self):
+        """
+        Loading the last endpoint is subject to the message deadline, so
+        a slow preference store does not hold the reply back.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            deadlines={'timeout': 5}, preferences={'ttl': 3600})
+        store = dispatcher.preference_store(dispatcher.default_config())
+        loading = Deferred()
+
+        def get(user_id):
+            reactor.callLater(0, loading.callback, None)
+            return Deferred()
+        self.patch(store, 'get', get)
+
+        self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield loading
+        self.assertEqual(self.ch("transport").get_dispatched_outbound(), [])
+        clock.advance(5)
+        [msg] = yield self.ch("transport").wait_for_dispatched_outbound(1)
+        self.assertEqual(msg['content'], 'Oops! Sorry!')
+        self.assertEqual(dispatcher.admission.in_flight, 0)
+
+    @inlineCallbacks
+    def test_invalid_preferences_mode(self):
+        yield self.assertFailure(
+            self.get_dispatcher(preferences={'mode': 'menu'}), ConfigError)
+
+    @inlineCallbacks
+    def test_unavailable_endpoint_fast_fails(self):
+        """
+        Selecting an endpoint whose circuit is open ends the session with
+        the unavailable message instead of forwarding the message.
+        """
+        dispatcher = yield self.get_dispatcher(
+            circuit_breaker={'minimum_requests': 1},
+            unavailable_message='Try later.')
+        dispatcher.health.event_received('flappy-bird', failed=True)
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
+
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+
+        self.assertEqual([], self.ch("app1").get_dispatched_inbound())
+        [msg] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(msg['content'], 'Try later.')
+        self.assertEqual(msg['session_event'], 'close')
+        yield self.assert_session('123', {})
+
+    @inlineCallbacks
+    def test_unavailable_endpoint_hidden_from_menu(self):
+        dispatcher = yield self.get_dispatcher(
+            circuit_breaker={'minimum_requests': 1, 'hide_unavailable': True},
+            entries=[{
+                'label': 'Flappy Bird',
+                'endpoint': 'flappy-bird',
+            }, {
+                'label': 'Mama',
+                'endpoint': 'mama',
+            }])
+        dispatcher.health.event_received('flappy-bird', failed=True)
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', transport_name='transport')
+        [msg] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(msg['content'], 'Please select a choice.\n1) Mama')
+
+    @inlineCallbacks
+    def test_missing_replies_open_circuit(self):
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            circuit_breaker={'minimum_requests': 2, 'reply_timeout': 10})
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+
+        msg1 = yield self.ch("transport").make_dispatch_inbound(
+            'a', from_addr='123', session_event='resume',
+            transport_name='transport')
+        yield self.ch("app1").make_dispatch_reply(msg1, 'reply')
+        yield self.ch("transport").make_dispatch_inbound(
+            'b', from_addr='123', session_event='resume',
+            transport_name='transport')
+        clock.advance(10)
+        self.assertFalse(dispatcher.endpoint_available('flappy-bird'))
+
+    @inlineCallbacks
+    def test_rate_limit_busy_reply(self):
+        """
+        Messages over an endpoint's rate limit get the busy message and
+        their session is ended.
+        """
+        dispatcher = yield self.get_dispatcher(
+            rate_limits={'app1': {'default': {'rate': 1}}},
+            busy_message='Too busy.')
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+        yield self.setup_session('456', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+
+        yield self.ch("transport").make_dispatch_inbound(
+            'a', from_addr='123', session_event='resume',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            'b', from_addr='456', session_event='resume',
+            transport_name='transport')
+
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['from_addr'], '123')
+        [msg] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(msg['content'], 'Too busy.')
+        self.assertEqual(msg['to_addr'], '456')
+        yield self.assert_session('456', {})
+        [(_, value)] = dispatcher.metrics[
+            'ratelimit.app1.default.rejected'].poll()
+        self.assertEqual(value, 1.0)
+
+    @inlineCallbacks
+    def test_rate_limit_queue(self):
+        """
+        A message waiting for capacity on one endpoint does not hold up
+        messages for other endpoints. Messages that would have to wait
+        past their deadline get the busy message straight away.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        routing_table = copy.deepcopy(self.DISPATCHER_CONFIG['routing_table'])
+        routing_table['transport']['mama'] = ['app2', 'default']
+        dispatcher = yield self.get_dispatcher(
+            entries=[
+                {'label': 'Flappy Bird', 'endpoint': 'flappy-bird'},
+                {'label': 'Mama', 'endpoint': 'mama'},
+            ],
+            routing_table=routing_table,
+            rate_limits={
+                'app1': {'default': {'rate': 0.25, 'queue_size': 2}}},
+            max_concurrent_messages=3, deadlines={'timeout': 5},
+            busy_message='Too busy.')
+        for user_id, endpoint in [
+                ('123', 'flappy-bird'), ('456', 'flappy-bird'),
+                ('789', 'mama'), ('999', 'flappy-bird')]:
+            yield self.setup_session(user_id, self.menu_session(
+                ApplicationDispatcher.STATE_SELECTED,
+                active_endpoint=endpoint))
+
+        yield self.ch("transport").make_dispatch_inbound(
+            'a', from_addr='123', session_event='resume',
+            transport_name='transport')
+        yield self.ch("app1").wait_for_dispatched_inbound(1)
+        yield self.ch("transport").make_dispatch_inbound(
+            'b', from_addr='456', session_event='resume',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            'c', from_addr='789', session_event='resume',
+            transport_name='transport')
+        [msg] = yield self.ch("app2").wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['from_addr'], '789')
+        limiter = dispatcher.rate_limiters[('app1', 'default')]
+        self.assertEqual(len(limiter.waiting), 1)
+
+        yield self.ch("transport").make_dispatch_inbound(
+            'd', from_addr='999', session_event='resume',
+            transport_name='transport')
+        [msg] = yield self.ch("transport").wait_for_dispatched_outbound(1)
+        self.assertEqual(msg['content'], 'Too busy.')
+        self.assertEqual(msg['to_addr'], '999')
+        yield self.assert_session('999', {})
+
+        clock.advance(4)
+        [_, msg] = yield self.ch("app1").wait_for_dispatched_inbound(2)
+        self.assertEqual(msg['from_addr'], '456')
+        self.assertEqual(len(limiter.waiting), 0)
+
+    @inlineCallbacks
+    def test_load_shedding(self):
+        """
+        While Redis is slow, new sessions get the busy message without a
+        session being created, but existing sessions are still served.
+        """
+        dispatcher = yield self.get_dispatcher(
+            load_shedding={'max_redis_latency': 1.0},
+            busy_message='Too busy.')
+        dispatcher.admission.record_latency(2.0)
+        yield self.setup_session('456', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        [msg] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(msg['content'], 'Too busy.')
+        self.assertEqual(msg['session_event'], 'close')
+        yield self.assert_session('123', {})
+
+        yield self.ch("transport").make_dispatch_inbound(
+            'a', from_addr='456', session_event='resume',
+            transport_name='transport')
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['content'], 'a')
+
+    @inlineCallbacks
+    def test_load_shedding_in_flight(self):
+        """
+        New sessions get the busy message while 'max_in_flight' messages
+        are being processed.
+        """
+        dispatcher = yield self.get_dispatcher(
+            load_shedding={'max_in_flight': 1}, max_concurrent_messages=2,
+            busy_message='Too busy.')
+        routing = Deferred()
+        self.patch(dispatcher, 'route_inbound', lambda *a: routing)
+        yield self.ch("transport").make_dispatch_inbound(
+            'a', from_addr='456', session_event='resume',
+            transport_name='transport')
+        self.assertEqual(dispatcher.admission.in_flight, 1)
+
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        [msg] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(msg['content'], 'Too busy.')
+        self.assertEqual(msg['to_addr'], '123')
+        routing.callback(None)
+        self.assertEqual(dispatcher.admission.in_flight, 0)
+
+    @inlineCallbacks
+    def test_load_shedding_in_flight_without_window(self):
+        """
+        'max_in_flight' is ignored when messages are processed one at a
+        time.
+        """
+        with LogCatcher(message='Ignoring load_shedding') as lc:
+            dispatcher = yield self.get_dispatcher(
+                load_shedding={'max_in_flight': 1})
+        self.assertEqual(len(lc.messages()), 1)
+        self.assertEqual(dispatcher.admission.max_in_flight, None)
+
+    @inlineCallbacks
+    def test_inbound_deadline_exceeded(self):
+        """
+        If the session cannot be loaded in time, the user gets the error
+        message instead of waiting for the transport to time out.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(deadlines={'timeout': 5})
+        self.patch(self.session_manager, 'load_session', lambda *a: Deferred())
+
+        self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").wait_for_dispatched_outbound(0)
+        self.assertEqual(self.ch("transport").get_dispatched_outbound(), [])
+        clock.advance(5)
+        [msg] = yield self.ch("transport").wait_for_dispatched_outbound(1)
+        self.assertEqual(msg['content'], 'Oops! Sorry!')
+        self.assertEqual(msg['session_event'], 'close')
+        [(_, value)] = dispatcher.metrics['deadline.inbound.timeouts'].poll()
+        self.assertEqual(value, 1.0)
+
+    @inlineCallbacks
+    def test_inbound_deadline_routes_to_last_endpoint(self):
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            deadlines={'timeout': 5, 'inbound': 'route'})
+        dispatcher.remember_endpoint('123', 'flappy-bird')
+        self.patch(self.session_manager, 'load_session', lambda *a: Deferred())
+
+        self.ch("transport").make_dispatch_inbound(
+            'a', from_addr='123', session_event='resume',
+            transport_name='transport')
+        yield self.ch("app1").wait_for_dispatched_inbound(0)
+        clock.advance(5)
+        [msg] = yield self.ch("app1").wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], 'a')
+
+    @inlineCallbacks
+    def test_duplicate_inbound_dropped(self):
+        dispatcher = yield self.get_dispatcher(deduplication={'ttl': 60})
+        msg = yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").dispatch_inbound(msg)
+
+        [reply] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(
+            reply['content'], 'Please select a choice.\n1) Flappy Bird')
+        [(_, value)] = dispatcher.metrics['dedup.duplicates'].poll()
+        self.assertEqual(value, 1.0)
+        self.assertEqual(
+            sum(v for _, v in dispatcher.metrics['dedup.checked'].poll()),
+            2.0)
+
+    @inlineCallbacks
+    def test_duplicate_inbound_approximate(self):
+        """
+        Messages dropped by the Bloom filters are counted separately, since
+        some of them may not be duplicates.
+        """
+        dispatcher = yield self.get_dispatcher(
+            deduplication={'shared': False, 'approximate': True})
+        msg = yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").dispatch_inbound(msg)
+        [_] = self.ch("transport").get_dispatched_outbound()
+        [(_, value)] = dispatcher.metrics[
+            'dedup.duplicates.approximate'].poll()
+        self.assertEqual(value, 1.0)
+
+    @inlineCallbacks
+    def test_concurrent_messages(self):
+        """
+        Up to max_concurrent_messages messages are processed at the same
+        time, so the consumer does not wait for each one to finish.
+        """
+        dispatcher = yield self.get_dispatcher(max_concurrent_messages=2)
+        routing = {}
+
+        def route_inbound(config, msg, connector_name, deadline):
+            routing[msg['from_addr']] = d = Deferred()
+            return d
+
+        self.patch(dispatcher, 'route_inbound', route_inbound)
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='456', session_event='new',
+            transport_name='transport')
+        self.assertEqual(sorted(routing), ['123', '456'])
+        self.assertEqual(len(dispatcher.window), 2)
+        for d in routing.values():
+            d.callback(None)
+        self.assertEqual(len(dispatcher.window), 0)
+
+    @inlineCallbacks
+    def test_drain(self):
+        """
+        On shutdown, the dispatcher waits for in-flight messages to be
+        processed.
+        """
+        dispatcher = yield self.get_dispatcher(max_concurrent_messages=2)
+        routing = Deferred()
+        self.patch(dispatcher, 'route_inbound', lambda *a: routing)
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        self.assertEqual(len(dispatcher.in_flight), 1)
+
+        d = dispatcher.drain()
+        yield self.wait_for_paused(dispatcher)
+        self.assertNoResult(d)
+        routing.callback(None)
+        yield d
+        self.assertEqual(len(dispatcher.in_flight), 0)
+
+    @inlineCallbacks
+    def test_drain_timeout(self):
+        """
+        The dispatcher waits at most drain_timeout seconds for in-flight
+        messages.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            max_concurrent_messages=2, drain_timeout=5)
+        routing = Deferred()
+        self.patch(dispatcher, 'route_inbound', lambda *a: routing)
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+
+        d = dispatcher.drain()
+        yield self.wait_for_paused(dispatcher)
+        self.assertNoResult(d)
+        clock.advance(5)
+        yield d
+        self.assertEqual(len(dispatcher.in_flight), 1)
+        self.assertNoResult(routing)
+        routing.callback(None)
+
+    @inlineCallbacks
+    def test_batching(self):
+        """
+        Messages in a batch are decided together, and messages from the
+        same user in a batch see each other's session updates.
+        """
+        dispatcher = yield self.get_dispatcher(
+            batching={'max_size': 3, 'max_delay': 60},
+            max_concurrent_messages=3, amqp_prefetch_count=3)
+        # The fake broker waits for each message to be processed before
+        # delivering the next, so we hand the messages to the dispatcher
+        # directly.
+        msgs = [
+            self.disp_helper.make_inbound(
+                None, from_addr='123', session_event='new',
+                transport_name='transport'),
+            self.disp_helper.make_inbound(
+                None, from_addr='456', session_event='new',
+                transport_name='transport'),
+            self.disp_helper.make_inbound(
+                '1', from_addr='123', session_event='resume',
+                transport_name='transport'),
+        ]
+        config = yield dispatcher.get_config(msgs[0])
+        ds = [dispatcher.process_inbound(config, msg, 'transport')
+              for msg in msgs]
+        self.assertEqual(len(dispatcher.batcher.pending), 0)
+        yield gatherResults(ds)
+        yield gatherResults(list(dispatcher.in_flight))
+        replies = yield self.ch("transport").wait_for_dispatched_outbound(2)
+        self.assertEqual(
+            sorted(msg['to_addr'] for msg in replies), ['123', '456'])
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['from_addr'], '123')
+        self.assertEqual(msg['session_event'], 'new')
+        yield self.assert_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+
+    @inlineCallbacks
+    def test_batching_without_window(self):
+        """
+        Batching cannot group messages that are processed one at a time,
+        so it is refused without a concurrency window.
+        """
+        yield self.assertFailure(
+            self.get_dispatcher(batching={'max_size': 3}), ConfigError)
+
+    @inlineCallbacks
+    def test_tracing(self):
+        """
+        Traced requests and their replies are stamped with the times they
+        passed through the router, and their latencies are recorded.
+        """
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(tracing={'sample_rate': 1})
+        yield self.ch("transport").make_dispatch_inbound(
+            "1", session_event='resume', from_addr='123')
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        trace = msg['helper_metadata']['trace']
+        self.assertEqual(trace['ingress'], 0)
+        self.assertEqual(trace['egress'], 0)
+
+        clock.advance(2)
+        yield self.ch("app1").make_dispatch_reply(msg, 'Flappy Flappy!')
+        [reply] = self.ch("transport").get_dispatched_outbound()
+        self.assertEqual(reply['helper_metadata']['trace'], {
+            'id': trace['id'], 'ingress': 2, 'egress': 2})
+        [(_, value)] = dispatcher.metrics[
+            'tracing.app1.default.round_trip'].poll()
+        self.assertEqual(value, 2)
+        [(_, value)] = dispatcher.metrics[
+            'tracing.app1.default.router'].poll()
+        self.assertEqual(value, 0)
+        self.assertEqual(dispatcher.tracer.pending, {})
+
+    @inlineCallbacks
+    def test_profiling(self):
+        """
+        Profiles are written after the configured duration, and the stages
+        of slow messages are recorded.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        dispatcher = yield self.get_dispatcher(profiling={
+            'duration': 5, 'output_dir': output_dir,
+            'slow_message_threshold': 0})
+        dispatcher.start_profiling()
+        self.assertTrue(dispatcher.profiler.running)
+        clock.advance(5)
+        self.assertFalse(dispatcher.profiler.running)
+        [path] = os.listdir(output_dir)
+        self.assertTrue(path.endswith('.collapsed'))
+
+        msg = yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        [(message_id, _, stages)] = dispatcher.slow_messages.messages
+        self.assertEqual(message_id, msg['message_id'])
+        self.assertEqual(
+            [stage[0] for stage in stages],
+            ['dedup', 'load_session', 'decide', 'apply'])
+
+    @inlineCallbacks
+    def test_shadow(self):
+        """
+        Messages are also decided with the shadow config, and divergences
+        are counted without affecting the live decision.
+        """
+        yield self.setup_session('123', {
+            'state': ApplicationDispatcher.STATE_SELECTED,
+            'active_endpoint': 'flappy-bird',
+        })
+        dispatcher = yield self.get_dispatcher(
+            shadow={'config': {'entries': []}})
+        yield self.ch("transport").make_dispatch_inbound(
+            'Flap', session_event='resume', from_addr='123')
+        [msg] = self.ch("app1").get_dispatched_inbound()
+        self.assertEqual(msg['content'], 'Flap')
+        self.assertEqual(self.ch("transport").get_dispatched_outbound(), [])
+        for name in ['shadow.evaluated', 'shadow.divergence.target',
+                     'shadow.divergence.terminate']:
+            [(_, value)] = dispatcher.metrics[name].poll()
+            self.assertEqual(value, 1)
+
+    @inlineCallbacks
+    def test_analytics(self):
+        """
+        Routing decisions are counted in memory and flushed to Redis
+        periodically.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            analytics={'flush_interval': 10})
+        yield self.ch("transport").make_dispatch_inbound(
+            None, from_addr='123', session_event='new',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        self.assertEqual(dict(dispatcher.analytics.counts), {
+            (0, 'flappy-bird', 'selected'): 1,
+            (0, 'flappy-bird', 'forwarded'): 1,
+        })
+        yield dispatcher.flush_analytics()
+        self.assertEqual(dict(dispatcher.analytics.counts), {})
+        results = yield dispatcher.analytics.query(0, 0)
+        self.assertEqual(results, {0: {'flappy-bird': {
+            'selected': 1, 'forwarded': 1, 'users': 1}}})
+
+    @inlineCallbacks
+    def test_analytics_unavailable(self):
+        """
+        Sessions ended because the selected endpoint is unavailable are
+        counted as such.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            circuit_breaker={'minimum_requests': 1},
+            analytics={'flush_interval': 10})
+        dispatcher.health.event_received('flappy-bird', failed=True)
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='123', session_event='resume',
+            transport_name='transport')
+        self.assertEqual(dict(dispatcher.analytics.counts), {
+            (0, 'menu', 'ended.unavailable'): 1,
+        })
+
+    @inlineCallbacks
+    def test_analytics_busy(self):
+        """
+        Selections turned away because the endpoint is busy are counted as
+        ended sessions, not selections.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            rate_limits={'app1': {'default': {'rate': 1}}},
+            analytics={'flush_interval': 10})
+        yield self.setup_session('123', self.menu_session(
+            ApplicationDispatcher.STATE_SELECTED,
+            active_endpoint='flappy-bird'))
+        yield self.setup_session('456', self.menu_session(
+            ApplicationDispatcher.STATE_SELECT))
+        yield self.ch("transport").make_dispatch_inbound(
+            'a', from_addr='123', session_event='resume',
+            transport_name='transport')
+        yield self.ch("transport").make_dispatch_inbound(
+            '1', from_addr='456', session_event='resume',
+            transport_name='transport')
+        self.assertEqual(dict(dispatcher.analytics.counts), {
+            (0, 'flappy-bird', 'forwarded'): 1,
+            (0, 'menu', 'ended.busy'): 1,
+        })
+
+    @inlineCallbacks
+    def test_analytics_tenants(self):
+        """
+        Only routing with the default config is counted.
+        """
+        clock = Clock()
+        self.patch(ApplicationDispatcher, 'clock', clock)
+        dispatcher = yield self.get_dispatcher(
+            analytics={'flush_interval': 10}, tenancy={'tenants': {'mama': {
+                'to_addrs': ['*120*2#'],
+                'entries': [{'label': 'Mama', 'endpoint': 'mama'}],
+                'routing_table': {
+                    'transport': {
+                        'mama': ['app2', 'default'],
+                        'default': ['transport', 'default'],
+                    },
+                    'app2': {'default': ['transport', 'default']},
+                },
+            }}})
+        for to_addr in ['*120*1#', '*120*2#']:
+            yield self.ch("transport").make_dispatch_inbound(
+                None, from_addr='123', to_addr=to_addr, session_event='new',
+                transport_name='transport')
+            yield self.ch("transport").make_dispatch_inbound(
+                '1', from_addr='123', to_addr=to_addr,
+                session_event='resume', transport_name='transport')
+        self.assertEqual(len(self.ch("app2").get_dispatched_inbound()), 1)
+        self.assertEqual(dict(dispatcher.analytics.counts), {
+            (0, 'flappy-bird', 'selected'): 1,
+            (0, 'flappy-bird', 'forwarded'): 1,
+        })
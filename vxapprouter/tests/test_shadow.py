@@ -0,0 +1,117 @@
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportUserMessage
+from vumi.tests.utils import LogCatcher
+
+from vxapprouter.core import StateMachine
+from vxapprouter.router import ApplicationDispatcherConfig
+from vxapprouter.shadow import ShadowEvaluator
+from vxapprouter.snapshot import ConfigSnapshot
+
+
+class TestShadowEvaluator(TestCase):
+
+    CONFIG = {
+        'error_message': 'Oops!',
+        'entries': [
+            {'label': 'Flappy Bird', 'endpoint': 'flappy-bird'},
+            {'label': 'Mama', 'endpoint': 'mama'},
+        ],
+        'routing_table': {},
+        'receive_inbound_connectors': ['transport'],
+        'receive_outbound_connectors': ['app1'],
+    }
+
+    def setUp(self):
+        self.machine = StateMachine()
+        self.machine.setup_state_machine()
+        self.config = ConfigSnapshot(ApplicationDispatcherConfig(self.CONFIG))
+
+    def mk_shadow(self, **candidate):
+        return ShadowEvaluator(
+            self.machine, ApplicationDispatcherConfig, self.CONFIG,
+            candidate)
+
+    def mk_msg(self, content, session_event='resume'):
+        return TransportUserMessage(
+            to_addr='*120*1#', from_addr='123', content=content,
+            session_event=session_event, transport_name='transport',
+            transport_type='ussd')
+
+    def evaluate(self, shadow, msg, session):
+        live = self.machine.decide(self.config, msg, dict(session))
+        return shadow.evaluate(msg, session, live)[0]
+
+    def test_same_config(self):
+        shadow = self.mk_shadow()
+        divergences = self.evaluate(
+            shadow, self.mk_msg(None, 'new'), {})
+        self.assertEqual(divergences, [])
+        self.assertEqual(shadow.evaluated, 1)
+
+    def test_quiet(self):
+        """
+        Candidate decisions are not logged, but live ones still are.
+        """
+        version = self.machine.get_menu_plan(self.config).version
+        shadow = self.mk_shadow(menu_title='Pick one.')
+        session = {
+            'state': 'select', 'menu_page': '0', 'menu_version': version}
+        msg = self.mk_msg('1')
+        with LogCatcher() as lc:
+            live = self.machine.decide(self.config, msg, dict(session))
+        self.assertEqual(len(lc.messages()), 3)
+        with LogCatcher() as lc:
+            shadow.evaluate(msg, session, live)
+        self.assertEqual(lc.messages(), [])
+
+    def test_reply(self):
+        shadow = self.mk_shadow(menu_title='Pick one.')
+        divergences = self.evaluate(
+            shadow, self.mk_msg(None, 'new'), {})
+        self.assertEqual(divergences, ['reply'])
+
+    def test_target(self):
+        version = self.machine.get_menu_plan(self.config).version
+        shadow = self.mk_shadow(entries=list(reversed(
+            self.CONFIG['entries'])))
+        session = {
+            'state': 'select', 'menu_page': '0', 'menu_version': version}
+        divergences = self.evaluate(shadow, self.mk_msg('1'), session)
+        self.assertEqual(divergences, ['target'])
+
+    def test_unrelated_entry(self):
+        """
+        Users on a menu page choose from the same page of the candidate
+        menu, so adding an entry does not change their other choices.
+        """
+        games = {'label': 'Games', 'entries': [
+            {'label': 'Chess', 'endpoint': 'chess'}]}
+        news = {'label': 'News', 'entries': [
+            {'label': 'Sport', 'endpoint': 'sport'}]}
+        base = dict(self.CONFIG, entries=self.CONFIG['entries'] + [games])
+        self.config = ConfigSnapshot(ApplicationDispatcherConfig(base))
+        version = self.machine.get_menu_plan(self.config).version
+        shadow = ShadowEvaluator(
+            self.machine, ApplicationDispatcherConfig, base,
+            {'entries': self.CONFIG['entries'] + [news, games]})
+        for page, content in [('0', '2'), ('1', '1')]:
+            session = {
+                'state': 'select', 'menu_page': page,
+                'menu_version': version}
+            self.assertEqual(
+                self.evaluate(shadow, self.mk_msg(content), session), [])
+
+    def test_terminate(self):
+        shadow = self.mk_shadow(entries=self.CONFIG['entries'][:1])
+        session = {'state': 'selected', 'active_endpoint': 'mama'}
+        divergences = self.evaluate(shadow, self.mk_msg('hi'), session)
+        self.assertEqual(divergences, ['target', 'terminate', 'reply'])
+
+    def test_error(self):
+        shadow = self.mk_shadow()
+        self.patch(shadow.machine, 'handlers', {'select': lambda *a: 1 / 0})
+        session = {'state': 'select'}
+        live = self.machine.begin(self.config, self.mk_msg('1'), session)
+        self.assertEqual(
+            shadow.evaluate(self.mk_msg('1'), session, live)[0], ['error'])
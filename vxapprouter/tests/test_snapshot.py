@@ -0,0 +1,61 @@
+import copy
+import pickle
+
+from twisted.trial.unittest import TestCase
+
+from vumi.config import Config, ConfigDict, ConfigInt, ConfigList
+
+from vxapprouter.snapshot import ConfigSnapshot, FrozenDict, freeze
+
+
+class ExampleConfig(Config):
+    port = ConfigInt("Port", default=80, static=True)
+    routes = ConfigDict("Routes", default={})
+    entries = ConfigList("Entries", default=[])
+
+
+class TestFreeze(TestCase):
+
+    def test_freeze(self):
+        value = freeze({'a': [{'b': 1}], 'c': 'd'})
+        self.assertEqual(value, {'a': ({'b': 1},), 'c': 'd'})
+        self.assertTrue(isinstance(value, FrozenDict))
+        self.assertTrue(isinstance(value['a'][0], FrozenDict))
+
+    def test_frozen_dict_immutable(self):
+        value = FrozenDict({'a': 1})
+        self.assertRaises(TypeError, value.__setitem__, 'a', 2)
+        self.assertRaises(TypeError, value.__delitem__, 'a')
+        self.assertRaises(TypeError, value.update, {'b': 2})
+        self.assertRaises(TypeError, value.setdefault, 'b', 2)
+        self.assertRaises(TypeError, value.pop, 'a')
+        self.assertEqual(value, {'a': 1})
+
+    def test_frozen_dict_copy(self):
+        value = FrozenDict({'a': 1})
+        self.assertTrue(copy.deepcopy(value) is value)
+        self.assertEqual(pickle.loads(pickle.dumps(value)), value)
+
+
+class TestConfigSnapshot(TestCase):
+
+    def test_snapshot(self):
+        snapshot = ConfigSnapshot(ExampleConfig({
+            'routes': {'a': ['b', 'c']},
+            'entries': [{'label': 'x'}],
+        }))
+        self.assertEqual(snapshot.port, 80)
+        self.assertEqual(snapshot.routes, {'a': ('b', 'c')})
+        self.assertEqual(snapshot.entries, ({'label': 'x'},))
+        self.assertFalse(snapshot.static)
+
+    def test_snapshot_read_only(self):
+        snapshot = ConfigSnapshot(ExampleConfig({}))
+        self.assertRaises(AttributeError, setattr, snapshot, 'port', 1)
+        self.assertRaises(AttributeError, delattr, snapshot, 'port')
+
+    def test_static_snapshot(self):
+        snapshot = ConfigSnapshot(ExampleConfig({}, static=True))
+        self.assertEqual(snapshot.port, 80)
+        self.assertTrue(snapshot.static)
+        self.assertFalse(hasattr(snapshot, 'routes'))
@@ -0,0 +1,408 @@
+"""
+A soak test of ApplicationDispatcher under sustained load.
+
+Simulated users run sessions against the dispatcher through the fake
+broker, and a simulated application replies to what is forwarded to it.
+Every Redis command is delayed by a random latency and a small fraction
+of them fail. Memory use, in-flight messages, session keys and their
+states, routing latency and error replies are sampled as it runs, and the
+test fails if they grow faster than the thresholds on :class:`TestSoak`.
+
+It is skipped unless VXAPPROUTER_SOAK is set to the number of seconds
+to run for. Runs of less than ten minutes are dominated by warm-up. The
+samples are written as CSV to VXAPPROUTER_SOAK_OUTPUT, if it is set.
+Set VUMITEST_REDIS_DB to soak against a real Redis server instead of
+FakeRedis:
+
+    VXAPPROUTER_SOAK=14400 VXAPPROUTER_SOAK_OUTPUT=soak.csv \
+        py.test vxapprouter/tests/test_soak.py
+"""
+import csv
+import os
+import random
+import resource
+import time
+from collections import Counter, namedtuple
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredList, fail, gatherResults, inlineCallbacks, maybeDeferred,
+    returnValue)
+from twisted.internet.task import LoopingCall, deferLater
+
+from txredis.exceptions import ResponseError
+
+from vumi import log
+from vumi.dispatchers.tests.helpers import DispatcherHelper
+from vumi.message import TransportUserMessage
+from vumi.persist.fake_redis import FakeRedis
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.router import ApplicationDispatcher
+
+
+SOAK_DURATION = float(os.environ.get('VXAPPROUTER_SOAK', 0))
+SOAK_OUTPUT = os.environ.get('VXAPPROUTER_SOAK_OUTPUT')
+
+
+Sample = namedtuple('Sample', [
+    'elapsed', 'rss', 'in_flight', 'sessions', 'states', 'messages',
+    'error_replies', 'stuck', 'latency', 'logged_errors'])
+
+
+class InjectedFault(ResponseError):
+    """A Redis error injected by :class:`FaultyRedisClient`."""
+
+
+class FaultyRedisClient(object):
+    """
+    Wraps a Redis client. Every command is delayed by an exponentially
+    distributed latency with a mean of ``latency`` seconds, and
+    ``error_rate`` of them fail.
+    """
+
+    def __init__(self, client, latency, error_rate, rng):
+        self.client = client
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kw):
+            if self.rng.random() < self.error_rate:
+                return fail(InjectedFault("Injected fault in %s" % (name,)))
+            return deferLater(
+                reactor, self.rng.expovariate(1.0 / self.latency),
+                maybeDeferred, attr, *args, **kw)
+        return call
+
+
+def prune_fake_redis(client):
+    """
+    Drop what FakeRedis keeps about commands that have run and keys that
+    have expired, so that its memory use does not hide the dispatcher's.
+    """
+    client._delayed_calls = [
+        delayed for delayed in client._delayed_calls if delayed.active()]
+    for key, delayed in client._expiries.items():
+        if not delayed.active():
+            del client._expiries[key]
+    for key in client._known_key_existence.keys():
+        if key not in client._data:
+            del client._known_key_existence[key]
+
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes. Where
+    /proc is not available, this is the maximum resident set size.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def growth(samples, field):
+    """
+    Return the least squares slope of ``field`` over ``samples``, per
+    hour and relative to its mean.
+    """
+    xs = [sample.elapsed for sample in samples]
+    ys = [float(getattr(sample, field)) for sample in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance == 0 or mean_y == 0:
+        return 0.0
+    slope = sum(
+        (x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+    return slope * 3600 / mean_y
+
+
+class SoakHarness(object):
+    """
+    Drives sessions through ``dispatcher`` from the ``transport``
+    connector helper, with ``app`` as the application, and samples the
+    dispatcher as it goes.
+
+    A session is a new session message, a menu choice, ``resumes``
+    messages to the application and a session close, with a think time
+    of up to ``think_time`` seconds before each message. Sessions are
+    started for ``users`` users in turn. Messages that are neither
+    forwarded nor replied to within ``stuck_after`` seconds are counted
+    as stuck.
+    """
+
+    def __init__(self, dispatcher, transport, app, rng, error_message,
+                 sessions_per_second=5, resumes=3, think_time=2,
+                 stuck_after=30, users=10000):
+        self.dispatcher = dispatcher
+        self.transport = transport
+        self.app = app
+        self.rng = rng
+        self.error_message = error_message
+        self.sessions_per_second = sessions_per_second
+        self.resumes = resumes
+        self.think_time = think_time
+        self.stuck_after = stuck_after
+        self.users = users
+        self.sessions = 0
+        self.running = set()
+        self.sent = {}
+        self.latencies = []
+        self.messages = 0
+        self.error_replies = 0
+        self.samples = []
+        self.started = None
+        self._traffic = LoopingCall(self.start_sessions)
+        self._publish_inbound = dispatcher.publish_inbound
+        self._publish_outbound = dispatcher.publish_outbound
+        dispatcher.publish_inbound = self.publish_inbound
+        dispatcher.publish_outbound = self.publish_outbound
+
+    def start(self, tick=0.1):
+        self.started = time.time()
+        self._owed = 0.0
+        self._traffic.start(tick, now=False)
+
+    @inlineCallbacks
+    def stop(self):
+        """
+        Stop starting sessions, and wait for the running ones and the
+        application replies they lead to.
+        """
+        self._traffic.stop()
+        while self.running:
+            yield DeferredList(list(self.running))
+
+    def track(self, d):
+        self.running.add(d)
+        d.addErrback(log.err)
+        d.addBoth(lambda _: self.running.discard(d))
+        return d
+
+    def start_sessions(self):
+        self._owed += self.sessions_per_second * self._traffic.interval
+        while self._owed >= 1:
+            self._owed -= 1
+            self.sessions += 1
+            self.track(self.run_session(
+                '+2783%07d' % (self.sessions % self.users,)))
+
+    def pause(self):
+        return deferLater(
+            reactor, self.rng.uniform(0, self.think_time), lambda: None)
+
+    @inlineCallbacks
+    def send(self, user_id, content, session_event):
+        yield self.pause()
+        msg = self.transport.msg_helper.make_inbound(
+            content, from_addr=user_id, session_event=session_event)
+        if session_event != TransportUserMessage.SESSION_CLOSE:
+            self.sent[msg['message_id']] = time.time()
+        self.messages += 1
+        yield self.transport.worker_helper.dispatch_inbound(msg)
+
+    @inlineCallbacks
+    def run_session(self, user_id):
+        yield self.send(user_id, None, TransportUserMessage.SESSION_NEW)
+        yield self.send(user_id, '1', TransportUserMessage.SESSION_RESUME)
+        for i in range(self.resumes):
+            yield self.send(
+                user_id, 'Hello', TransportUserMessage.SESSION_RESUME)
+        yield self.send(user_id, None, TransportUserMessage.SESSION_CLOSE)
+
+    def answered(self, message_id):
+        sent = self.sent.pop(message_id, None)
+        if sent is not None:
+            self.latencies.append(time.time() - sent)
+
+    def publish_inbound(self, msg, connector_name, endpoint):
+        self.answered(msg['message_id'])
+        d = self._publish_inbound(msg, connector_name, endpoint)
+        if msg['session_event'] != TransportUserMessage.SESSION_CLOSE:
+            self.track(deferLater(
+                reactor, self.rng.uniform(0, self.think_time),
+                self.app.make_dispatch_reply, msg, 'Reply'))
+        return d
+
+    def publish_outbound(self, msg, connector_name, endpoint):
+        self.answered(msg['in_reply_to'])
+        if msg['content'] == self.error_message:
+            self.error_replies += 1
+        return self._publish_outbound(msg, connector_name, endpoint)
+
+    def count_stuck(self):
+        cutoff = time.time() - self.stuck_after
+        stuck = [message_id for message_id, sent in self.sent.items()
+                 if sent < cutoff]
+        for message_id in stuck:
+            del self.sent[message_id]
+        return len(stuck)
+
+    @inlineCallbacks
+    def session_states(self, client):
+        pattern = '%s:session:*' % (self.dispatcher.redis.get_key_prefix(),)
+        keys = yield maybeDeferred(client.keys, pattern)
+        states = yield gatherResults([
+            maybeDeferred(client.hget, key, 'state') for key in keys])
+        returnValue(Counter(states))
+
+    @inlineCallbacks
+    def sample(self, client, logged_errors=0):
+        """
+        Record a :class:`Sample` of the dispatcher, reading sessions with
+        ``client`` so that no faults are injected.
+        """
+        states = yield self.session_states(client)
+        latencies, self.latencies = self.latencies, []
+        sample = Sample(
+            elapsed=time.time() - self.started,
+            rss=current_rss(),
+            in_flight=len(self.dispatcher.in_flight),
+            sessions=sum(states.values()),
+            states=states,
+            messages=self.messages,
+            error_replies=self.error_replies,
+            stuck=self.count_stuck(),
+            latency=percentile(latencies, 95),
+            logged_errors=logged_errors)
+        self.messages = self.error_replies = 0
+        self.samples.append(sample)
+        log.msg("Soak sample: %s" % (sample,))
+        returnValue(sample)
+
+    def write_csv(self, path):
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(Sample._fields)
+            for sample in self.samples:
+                writer.writerow(sample._replace(states=' '.join(
+                    '%s=%s' % item for item in sorted(sample.states.items()))))
+
+
+class TestSoak(VumiTestCase):
+
+    if not SOAK_DURATION:
+        skip = "Set VXAPPROUTER_SOAK to the number of seconds to soak for."
+
+    DISPATCHER_CONFIG = {
+        'invalid_input_message': 'Bad choice.',
+        'error_message': 'Oops! Sorry!',
+        'entries': [
+            {'label': 'Flappy Bird', 'endpoint': 'flappy-bird'},
+        ],
+        'routing_table': {
+            'transport': {
+                'flappy-bird': ['app1', 'default'],
+                'default': ['transport', 'default'],
+            },
+            'app1': {
+                'default': ['transport', 'default'],
+            },
+        },
+        'receive_inbound_connectors': ['transport'],
+        'receive_outbound_connectors': ['app1'],
+        'max_concurrent_messages': 50,
+        'amqp_prefetch_count': 50,
+        # FakeRedis lives in this process, so message ids are only cached
+        # for long enough to plateau within the run.
+        'message_expiry': 60,
+    }
+
+    SESSIONS_PER_SECOND = 5
+    REDIS_LATENCY = 0.005
+    REDIS_ERROR_RATE = 0.001
+    SAMPLES = 60
+
+    # Growth is the trend per hour, relative to the mean, over the
+    # samples after the first quarter of the run.
+    MAX_RSS_GROWTH = 0.1
+    MAX_SESSION_GROWTH = 0.2
+    MAX_LATENCY_GROWTH = 0.5
+    MAX_IN_FLIGHT = 500
+    MAX_ERROR_REPLY_RATE = 0.05
+    MAX_STUCK_RATE = 0.01
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.disp_helper = self.add_helper(
+            DispatcherHelper(ApplicationDispatcher))
+        self.dispatcher = yield self.disp_helper.get_dispatcher(
+            self.persistence_helper.mk_config(self.DISPATCHER_CONFIG))
+        self.rng = random.Random(0)
+
+    def inject_faults(self):
+        proxy = self.dispatcher.redis._client_proxy
+        client = proxy.client
+        proxy.client = FaultyRedisClient(
+            client, self.REDIS_LATENCY, self.REDIS_ERROR_RATE, self.rng)
+        self.add_cleanup(setattr, proxy, 'client', client)
+        return client
+
+    def assert_below(self, name, value, threshold):
+        self.assertTrue(
+            value <= threshold,
+            "%s of %.3f is above the threshold of %.3f" % (
+                name, value, threshold))
+
+    @inlineCallbacks
+    def test_soak(self):
+        client = self.inject_faults()
+        harness = SoakHarness(
+            self.dispatcher,
+            self.disp_helper.get_connector_helper('transport'),
+            self.disp_helper.get_connector_helper('app1'), self.rng,
+            self.DISPATCHER_CONFIG['error_message'],
+            sessions_per_second=self.SESSIONS_PER_SECOND)
+        harness.start()
+        interval = SOAK_DURATION / self.SAMPLES
+        for i in range(self.SAMPLES):
+            yield deferLater(reactor, interval, lambda: None)
+            # Trial keeps logged errors until the end of the test, so they
+            # are counted and dropped as we go.
+            logged_errors = len(self.flushLoggedErrors())
+            self.disp_helper.clear_all_dispatched()
+            if isinstance(client, FakeRedis):
+                prune_fake_redis(client)
+            yield harness.sample(client, logged_errors)
+        yield harness.stop()
+        self.flushLoggedErrors()
+        if SOAK_OUTPUT:
+            harness.write_csv(SOAK_OUTPUT)
+
+        samples = harness.samples[len(harness.samples) // 4:]
+        messages = sum(sample.messages for sample in samples)
+        self.assert_below("RSS growth", growth(samples, 'rss'),
+                          self.MAX_RSS_GROWTH)
+        self.assert_below("Session growth", growth(samples, 'sessions'),
+                          self.MAX_SESSION_GROWTH)
+        self.assert_below("Latency growth", growth(samples, 'latency'),
+                          self.MAX_LATENCY_GROWTH)
+        self.assert_below(
+            "In-flight messages",
+            max(sample.in_flight for sample in samples), self.MAX_IN_FLIGHT)
+        self.assert_below(
+            "Error reply rate",
+            sum(sample.error_replies for sample in samples) / float(messages),
+            self.MAX_ERROR_REPLY_RATE)
+        self.assert_below(
+            "Stuck message rate",
+            sum(sample.stuck for sample in samples) / float(messages),
+            self.MAX_STUCK_RATE)
+
+    test_soak.timeout = SOAK_DURATION + 120
@@ -0,0 +1,107 @@
+import json
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.config import ConfigError
+from vumi.message import TransportEvent, TransportUserMessage
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxapprouter.router import ApplicationDispatcherConfig
+from vxapprouter.tenants import TenantRegistry
+
+
+class TestTenantRegistry(VumiTestCase):
+
+    BASE_CONFIG = {
+        'menu_title': 'Base',
+        'routing_table': {'transport': {}},
+        'receive_inbound_connectors': ['transport'],
+        'receive_outbound_connectors': ['app'],
+    }
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+
+    def mk_registry(self, tenants=None):
+        return TenantRegistry(
+            ApplicationDispatcherConfig, self.BASE_CONFIG, self.redis,
+            tenants)
+
+    def mk_msg(self, **kw):
+        fields = {
+            'to_addr': '*120*1#',
+            'from_addr': '+27831234567',
+            'transport_name': 'transport',
+            'transport_type': 'ussd',
+        }
+        fields.update(kw)
+        return TransportUserMessage(**fields)
+
+    def test_static_tenants(self):
+        registry = self.mk_registry({
+            'a': {'menu_title': 'A', 'to_addrs': ['*120*1#']},
+        })
+        self.assertEqual(len(registry), 1)
+        config = registry.config('a')
+        self.assertEqual(config.menu_title, 'A')
+        self.assertEqual(config.tenant, 'a')
+        self.assertEqual(config.routing_table, {'transport': {}})
+
+    def test_match(self):
+        registry = self.mk_registry({
+            'a': {'menu_title': 'A', 'to_addrs': ['*120*1#']},
+            'b': {'menu_title': 'B', 'transport_names': ['transport']},
+        })
+        self.assertEqual(registry.match(self.mk_msg()).tenant, 'a')
+        reply = self.mk_msg().reply('hi')
+        self.assertEqual(registry.match(reply).tenant, 'a')
+        self.assertEqual(
+            registry.match(self.mk_msg(to_addr='*120*2#')).tenant, 'b')
+        self.assertEqual(
+            registry.match(self.mk_msg(
+                to_addr='*120*2#', transport_name='other')), None)
+        event = TransportEvent(
+            event_type='ack', user_message_id='1', sent_message_id='1',
+            transport_name='transport')
+        self.assertEqual(registry.match(event).tenant, 'b')
+
+    def test_invalid_tenant_skipped(self):
+        registry = self.mk_registry({'a': {'menu_max_length': 'lots'}})
+        self.assertEqual(len(registry), 0)
+        [err] = self.flushLoggedErrors(ConfigError)
+
+    @inlineCallbacks
+    def test_add_and_remove(self):
+        registry = self.mk_registry()
+        other = self.mk_registry()
+        yield registry.add('a', {'menu_title': 'A', 'to_addrs': ['*120*1#']})
+        self.assertEqual(registry.match(self.mk_msg()).menu_title, 'A')
+        stored = yield self.redis.hget(TenantRegistry.REDIS_KEY, 'a')
+        self.assertEqual(json.loads(stored)['menu_title'], 'A')
+
+        self.assertFalse('a' in other)
+        yield other.load()
+        self.assertTrue('a' in other)
+
+        yield registry.remove('a')
+        self.assertFalse('a' in registry)
+        yield other.load()
+        self.assertFalse('a' in other)
+
+    @inlineCallbacks
+    def test_add_invalid(self):
+        registry = self.mk_registry()
+        yield self.assertFailure(
+            registry.add('a', {'menu_max_length': 'lots'}), ConfigError)
+        self.assertEqual(
+            (yield self.redis.hgetall(TenantRegistry.REDIS_KEY)), {})
+
+    def test_namespace(self):
+        registry = self.mk_registry()
+        namespace = registry.namespace('a')
+        self.assertTrue(namespace is registry.namespace('a'))
+        self.assertEqual(
+            namespace._key('session:123'),
+            self.redis._key('a:session:123'))
@@ -0,0 +1,50 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportUserMessage
+
+from vxapprouter.tracing import HopTracer
+
+
+class TestHopTracer(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_msg(self):
+        return TransportUserMessage(
+            to_addr='*120*1#', from_addr='123', transport_name='transport',
+            transport_type='ussd')
+
+    def test_round_trip(self):
+        tracer = HopTracer(self.clock, sample_rate=1)
+        msg = self.mk_msg()
+        tracer.inbound_received(msg)
+        self.clock.advance(0.5)
+        tracer.inbound_sent(msg, 'app1')
+        self.clock.advance(2)
+        reply = msg.reply('hi')
+        tracer.outbound_received(reply)
+        self.clock.advance(0.25)
+        self.assertEqual(tracer.outbound_sent(reply), ('app1', 2.75, 0.75))
+        self.assertEqual(
+            reply['helper_metadata']['trace']['id'],
+            msg['helper_metadata']['trace']['id'])
+
+    def test_not_sampled(self):
+        tracer = HopTracer(self.clock, sample_rate=0)
+        msg = self.mk_msg()
+        tracer.inbound_received(msg)
+        tracer.inbound_sent(msg, 'app1')
+        self.assertEqual(msg['helper_metadata'], {})
+        reply = msg.reply('hi')
+        tracer.outbound_received(reply)
+        self.assertEqual(tracer.outbound_sent(reply), None)
+
+    def test_max_pending(self):
+        tracer = HopTracer(self.clock, sample_rate=1, max_pending=1)
+        first, second = self.mk_msg(), self.mk_msg()
+        for msg in [first, second]:
+            tracer.inbound_received(msg)
+            tracer.inbound_sent(msg, 'app1')
+        self.assertEqual(tracer.pending.keys(), [second['message_id']])
@@ -0,0 +1,40 @@
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from vxapprouter.window import ConcurrencyWindow
+
+
+class TestConcurrencyWindow(TestCase):
+
+    def test_run_returns_once_started(self):
+        window = ConcurrencyWindow(2)
+        work = Deferred()
+        d = window.run(lambda: work)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(len(window), 1)
+        work.callback('done')
+        self.assertEqual(len(window), 0)
+
+    def test_run_waits_when_full(self):
+        window = ConcurrencyWindow(2)
+        works = [Deferred() for _ in range(3)]
+        started = []
+
+        def process(i):
+            started.append(i)
+            return works[i]
+
+        ds = [window.run(process, i) for i in range(3)]
+        self.assertEqual(started, [0, 1])
+        self.assertNoResult(ds[2])
+        works[1].callback(None)
+        self.assertEqual(started, [0, 1, 2])
+        self.assertEqual(self.successResultOf(ds[2]), None)
+
+    def test_failures_logged(self):
+        window = ConcurrencyWindow(1)
+        d = window.run(lambda: 1 / 0)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+        self.assertEqual(len(window), 0)
+        self.successResultOf(window.run(lambda: None))
@@ -0,0 +1,75 @@
+# -*- test-case-name: vxapprouter.tests.test_tracing -*-
+import random
+from collections import OrderedDict, namedtuple
+from uuid import uuid4
+
+
+Hop = namedtuple('Hop', ['key', 'trace_id', 'ingress', 'egress'])
+
+
+class HopTracer(object):
+    """
+    Measures the latency of sampled request and reply pairs.
+
+    A sampled inbound message gets a ``trace`` dict in its
+    ``helper_metadata`` with a trace id and the times it reached and left
+    the router. Once it has been forwarded, the reply to it (found by its
+    ``in_reply_to``) gets the same treatment. When the reply leaves the
+    router, its round trip time and the part of that spent in the router
+    are returned, along with the key the request was sent with.
+
+    At most ``max_pending`` forwarded requests are remembered while
+    waiting for a reply.
+    """
+
+    def __init__(self, clock, sample_rate=0.01, max_pending=10000):
+        self.clock = clock
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+
+    @classmethod
+    def from_config(cls, clock, config):
+        return cls(clock, **config)
+
+    def sampled(self):
+        return random.random() < self.sample_rate
+
+    def inbound_received(self, msg):
+        if self.sampled():
+            msg['helper_metadata']['trace'] = {
+                'id': uuid4().hex, 'ingress': self.clock.seconds()}
+
+    def inbound_sent(self, msg, key):
+        trace = msg['helper_metadata'].get('trace')
+        if trace is None or 'egress' in trace:
+            return
+        trace['egress'] = self.clock.seconds()
+        self.pending[msg['message_id']] = Hop(
+            key, trace['id'], trace['ingress'], trace['egress'])
+        if len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+
+    def outbound_received(self, msg):
+        request = self.pending.get(msg['in_reply_to'])
+        if request is not None:
+            msg['helper_metadata']['trace'] = {
+                'id': request.trace_id, 'ingress': self.clock.seconds()}
+
+    def outbound_sent(self, msg):
+        """
+        Record the latency of the request ``msg`` replies to, if it was
+        traced. Returns the key, the round trip time and the time spent in
+        the router, or ``None``.
+        """
+        trace = msg['helper_metadata'].get('trace')
+        if trace is None:
+            return None
+        request = self.pending.pop(msg['in_reply_to'], None)
+        if request is None or request.trace_id != trace['id']:
+            return None
+        trace['egress'] = self.clock.seconds()
+        round_trip = trace['egress'] - request.ingress
+        router = ((request.egress - request.ingress) +
+                  (trace['egress'] - trace['ingress']))
+        return request.key, round_trip, router
@@ -0,0 +1,46 @@
+# -*- test-case-name: vxapprouter.tests.test_window -*-
+from twisted.internet.defer import DeferredSemaphore, maybeDeferred
+
+from vumi import log
+
+
+class ConcurrencyWindow(object):
+    """
+    Lets up to ``size`` messages be processed at the same time.
+
+    vumi's AMQP consumers wait for each message to be processed before
+    they read the next one. :meth:`run` starts processing a message and
+    returns as soon as it has started, so the consumer can move on, unless
+    ``size`` messages are already being processed, in which case it waits
+    for one of them to finish first.
+
+    Since the consumer acknowledges a message once :meth:`run` returns,
+    messages that are still being processed when the worker dies are lost.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.semaphore = DeferredSemaphore(size)
+        self.in_progress = set()
+
+    def __len__(self):
+        return len(self.in_progress)
+
+    def run(self, func, *args, **kw):
+        """
+        Call ``func`` once there is room in the window. Returns a deferred
+        that fires once it has been called. Failures are logged.
+        """
+        return self.semaphore.acquire().addCallback(
+            self._start, func, args, kw)
+
+    def _start(self, _, func, args, kw):
+        d = maybeDeferred(func, *args, **kw)
+        self.in_progress.add(d)
+        d.addErrback(log.err)
+        d.addBoth(self._done, d)
+
+    def _done(self, result, d):
+        self.in_progress.discard(d)
+        self.semaphore.release()
+        return result